@@ -0,0 +1,151 @@
+#!/usr/bin/env python3
+""" Vectorized post-processing of policy actions before encoding
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+
+import numpy as np
+
+from encoder import quantize
+
+
+def channel_mask(selected_channels: int, n_channels: int = 12) -> np.ndarray:
+    """Return boolean mask of the channels set in `m-selectedChannels`.
+    """
+
+    return np.array([bool(selected_channels >> i & 1)
+                     for i in range(n_channels)])
+
+
+class ActionFilter(object):
+    """Clip, low-pass and slew-rate limit 12 channel control inputs.
+
+    Works on one (n_channels,) action or a batch of (N, n_channels)
+    actions with the same NumPy ops, so N environments cost one call.
+    Per step the output moves towards the clipped input by the low-pass
+    factor, and by at most `max_rate * dt` per channel. Channels not set
+    in `selected_channels` are held at `neutral`, since FlightAxis Link
+    ignores them anyway.
+
+    After every call `changed` tells, per environment, whether any
+    channel differs from the previous output once quantized to the
+    `%.4f` resolution of ExchangeData.
+
+    Args:
+        num_envs: Batch size N; None filters single actions.
+        n_channels: Channels per action.
+        dt: Control period in seconds.
+        max_rate: Largest change per second, scalar or per channel;
+            None disables slew-rate limiting.
+        cutoff_hz: First-order low-pass cutoff; None disables it.
+        selected_channels: Bitmask as sent in `m-selectedChannels`.
+        neutral: Initial and masked channel value.
+    """
+
+    def __init__(self, num_envs: int = None, n_channels: int = 12,
+                 dt: float = 0.01, max_rate=None, cutoff_hz: float = None,
+                 selected_channels: int = 4095, neutral: float = 0.5):
+        shape = (n_channels,) if num_envs is None else (num_envs, n_channels)
+        self.neutral = neutral
+        self.selected_channels = selected_channels
+        self.mask = channel_mask(selected_channels, n_channels)
+        self.alpha = None
+        if cutoff_hz is not None:
+            rc = 1.0 / (2.0 * math.pi * cutoff_hz)
+            self.alpha = dt / (rc + dt)
+        self.max_step = None
+        if max_rate is not None:
+            self.max_step = np.broadcast_to(
+                np.asarray(max_rate, dtype=float) * dt, (n_channels,)).copy()
+        self.output = np.full(shape, neutral)
+        self.changed = np.ones(shape[:-1], dtype=bool)
+        self._input = np.zeros(shape)
+        self._delta = np.zeros(shape)
+        self._ticks = np.full(shape, -1, dtype=np.intp)
+
+    def reset(self, index=None) -> None:
+        """Return outputs to `neutral`, all of them or rows `index`.
+        """
+
+        if index is None:
+            index = Ellipsis
+        self.output[index] = self.neutral
+        self._ticks[index] = -1
+
+    def __call__(self, control_input) -> np.ndarray:
+        """Filter `control_input` and return the output array.
+
+        The returned array is reused by the next call.
+        """
+
+        x = self._input
+        np.clip(control_input, 0.0, 1.0, out=x)
+        y = self.output
+        if self.alpha is not None or self.max_step is not None:
+            delta = self._delta
+            np.subtract(x, y, out=delta)
+            if self.alpha is not None:
+                delta *= self.alpha
+            if self.max_step is not None:
+                np.clip(delta, -self.max_step, self.max_step, out=delta)
+            np.add(y, delta, out=x)
+        np.copyto(y, x, where=self.mask)
+
+        ticks = quantize(y)
+        np.any(ticks != self._ticks, axis=-1, out=self.changed)
+        self._ticks = ticks
+        return y
+
+
+if __name__ == "__main__":
+    import time
+
+    # slew limit and masking
+    f = ActionFilter(max_rate=10.0, dt=0.01, selected_channels=0b1111)
+    out = f(np.ones(12))
+    assert np.allclose(out[:4], 0.6) and np.allclose(out[4:], 0.5)
+    assert f.changed
+    f = ActionFilter()
+    f(np.full(12, 0.3))
+    f(np.full(12, 0.30001))
+    assert not f.changed
+    # halfway between ticks, rounded the way the encoder renders it
+    f(np.full(12, 0.00004))
+    f(np.full(12, 0.00005))
+    assert f.changed
+
+    rng = np.random.default_rng(0)
+    print("{:>5} {:>14} {:>14}".format("N", "batched us", "per-env us"))
+    for n in (1, 4, 16, 64, 256, 1024):
+        actions = rng.random((n, 12))
+        batched = ActionFilter(n, max_rate=5.0, cutoff_hz=10.0)
+        singles = [ActionFilter(max_rate=5.0, cutoff_hz=10.0)
+                   for _ in range(n)]
+        reps = max(10, 20000 // n)
+        t0 = time.perf_counter()
+        for _ in range(reps):
+            batched(actions)
+        t_batched = (time.perf_counter() - t0) / reps
+        reps = max(3, reps // 10)
+        t0 = time.perf_counter()
+        for _ in range(reps):
+            for i, single in enumerate(singles):
+                single(actions[i])
+        t_single = (time.perf_counter() - t0) / reps
+        print("{:>5} {:>14.1f} {:>14.1f}".format(n, t_batched * 1e6,
+                                                 t_single * 1e6))
@@ -0,0 +1,317 @@
+#!/usr/bin/env python3
+""" Asyncio connector for many concurrent FlightAxis Link instances
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import asyncio
+import socket
+import time
+
+from connector import ACTION_FMT, FlightAxisConnector
+from transport import (ConnectorConfig, LatencyCounter, TransportError,
+                       cache_address, cached_address, encode_frame,
+                       parse_content_length)
+
+
+async def resolve(host: str, port: int, ttl: float = 300.0,
+                  refresh: bool = False) -> tuple:
+    """`transport.resolve` for coroutines, sharing its DNS cache.
+
+    A lookup runs in the event loop's executor, so it does not block
+    the other connectors.
+    """
+
+    address = None if refresh else cached_address(host, port)
+    if address is None:
+        address = cache_address(
+            host, port, ttl, await asyncio.get_running_loop().getaddrinfo(
+                host, port, type=socket.SOCK_STREAM))
+    return address
+
+
+class AsyncFlightAxisTransport(object):
+    """Keep-alive connection to FlightAxis Link on asyncio streams.
+
+    Mirrors `FlightAxisTransport`: one request in flight, Content-Length
+    framing, cached DNS resolution, reconnect and resend on failure.
+    Every request, including connecting, is bounded by `config.timeout`.
+    """
+
+    def __init__(self, config: ConnectorConfig):
+        self.config = config
+        self._reader = None  # type: asyncio.StreamReader
+        self._writer = None  # type: asyncio.StreamWriter
+        self._lock = asyncio.Lock()
+        self.latency = {}  # type: dict
+        self.connects = 0
+        self.reconnects = 0
+        self.retries = 0
+        self.timeouts = 0
+        self.capture = None  # e.g. capture.CaptureWriter
+
+    @property
+    def connected(self) -> bool:
+        return self._writer is not None
+
+    async def connect(self) -> None:
+        if self._writer is not None:
+            return
+        config = self.config
+        _, sockaddr = await resolve(config.host, config.port, config.dns_ttl)
+        try:
+            self._reader, self._writer = await asyncio.wait_for(
+                asyncio.open_connection(*sockaddr[:2]),
+                config.connect_timeout)
+        except (OSError, asyncio.TimeoutError):
+            # the address may have moved; look it up again next time
+            await resolve(config.host, config.port, config.dns_ttl,
+                          refresh=True)
+            raise
+        sock = self._writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if self.connects:
+            self.reconnects += 1
+        self.connects += 1
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._writer.close()
+            self._reader = self._writer = None
+
+    async def request(self, action: str, body: bytes = b"",
+                      frame: bytes = None) -> bytes:
+        """Send one SOAP request and return the reply body.
+
+        Concurrent calls on the same transport are serialized, since
+        FlightAxis Link answers one request at a time.
+        """
+
+        if frame is None:
+            frame = encode_frame(action, body)
+        replies = await self.request_many([(action, frame)])
+        return replies[0]
+
+    async def request_many(self, requests) -> list:
+        """Send (action, frame) pairs back to back and return the replies.
+
+        Like `FlightAxisTransport.request_many`, the batch costs one
+        round-trip and is resent as a whole on failure.
+        """
+
+        async with self._lock:
+            attempt = 0
+            while True:
+                t0 = time.perf_counter()
+                try:
+                    replies = await asyncio.wait_for(
+                        self._exchange(requests), self.config.timeout)
+                except (OSError, TransportError, asyncio.TimeoutError,
+                        asyncio.IncompleteReadError) as e:
+                    if isinstance(e, asyncio.TimeoutError):
+                        self.timeouts += 1
+                    self.close()
+                    if attempt >= self.config.max_retries:
+                        raise
+                    attempt += 1
+                    self.retries += 1
+                    continue
+                dt = time.perf_counter() - t0
+                for (action, frame), reply in zip(requests, replies):
+                    self.counter(action).record(dt)
+                    if self.capture is not None:
+                        self.capture.write(action, frame, reply, dt)
+                return replies
+
+    def counter(self, action: str) -> LatencyCounter:
+        counter = self.latency.get(action)
+        if counter is None:
+            counter = self.latency[action] = LatencyCounter()
+        return counter
+
+    async def _exchange(self, requests) -> list:
+        await self.connect()
+        for _, frame in requests:
+            self._writer.write(frame)
+        await self._writer.drain()
+        return [await self._read_reply() for _ in requests]
+
+    async def _read_reply(self) -> bytes:
+        header = []
+        while True:
+            line = await self._reader.readline()
+            if not line:
+                raise TransportError("connection closed by FlightAxis Link")
+            if line in (b"\r\n", b"\n"):
+                break
+            header.append(line)
+        content_length = parse_content_length(b"".join(header))
+        return await self._reader.readexactly(content_length)
+
+
+class AsyncFlightAxisConnector(FlightAxisConnector):
+    """`FlightAxisConnector` with coroutine `exchange_data`.
+
+    State, encoding and parsing are shared with the blocking connector;
+    only the round-trips are awaited, so one event loop can step many
+    simulators at once.
+    """
+
+    def __init__(self, host: str = FlightAxisConnector._URL,
+                 port: int = FlightAxisConnector._PORT,
+                 timeout: float = 1.0, state=None,
+                 config: ConnectorConfig = None):
+        if config is None:
+            config = ConnectorConfig(host, port, timeout=timeout)
+        super().__init__(host, port, state, config)
+        self.transport = AsyncFlightAxisTransport(config)
+
+    async def warm(self) -> None:
+        """Resolve and connect now rather than on the first step.
+        """
+
+        await self.transport.connect()
+
+    async def exchange_data(self, control_input) -> None:
+        if self.needs_controller():
+            await self.inject_controller(restore=True)
+
+        reply = await self.transport.request(
+            "ExchangeData", frame=bytes(self.encode_controls(control_input)))
+        if reply:
+            self.update_state(reply)
+
+    async def inject_controller(self, restore: bool = True) -> None:
+        requests = self.injection_requests(restore)
+        if self.config.pipeline_requests:
+            await self.transport.request_many(requests)
+            self.controller_injected(1)
+        else:
+            for action, frame in requests:
+                await self.transport.request(action, frame=frame)
+            self.controller_injected(len(requests))
+
+    async def reset_episode(self, control_input=None):
+        t0 = time.perf_counter()
+        self.state.reset()
+        self._reset_pressed = False
+        await self.inject_controller(restore=self.needs_controller())
+        await self.exchange_data(self.servos if control_input is None
+                                 else control_input)
+        self.reset_latency.record(time.perf_counter() - t0)
+        self.resets += 1
+        return self.state
+
+    async def soap_request(self, action: str, body: str = "") -> bytes:
+        if not body:
+            frame = self._frames.get(action)
+            if frame is not None:
+                return await self.transport.request(action, frame=frame)
+            body = ACTION_FMT[action]
+        if isinstance(body, str):
+            body = body.encode("utf_8", errors="strict")
+        return await self.transport.request(action, body)
+
+
+async def exchange_all(connectors, control_inputs,
+                       max_in_flight: int = None) -> list:
+    """Step every connector once, concurrently.
+
+    Args:
+        connectors: `AsyncFlightAxisConnector` instances.
+        control_inputs: One control vector per connector.
+        max_in_flight: Upper bound on simultaneous round-trips; None
+            steps all connectors at once.
+    Returns:
+        One entry per connector: None on success, else the exception
+        that connector raised. A failing simulator does not cancel the
+        others.
+    """
+
+    if max_in_flight is None:
+        steps = [c.exchange_data(u)
+                 for c, u in zip(connectors, control_inputs)]
+    else:
+        semaphore = asyncio.Semaphore(max_in_flight)
+
+        async def step(connector, control_input):
+            async with semaphore:
+                await connector.exchange_data(control_input)
+
+        steps = [step(c, u) for c, u in zip(connectors, control_inputs)]
+    return await asyncio.gather(*steps, return_exceptions=True)
+
+
+async def _serve_stand_in(reader, writer, reply: bytes, delay_s: float):
+    """Answer every request with `reply` after `delay_s`.
+    """
+
+    response = (b"HTTP/1.1 200 OK\r\n"
+                b"Content-Length: " + str(len(reply)).encode() + b"\r\n"
+                b"\r\n" + reply)
+    try:
+        while True:
+            header = []
+            while True:
+                line = await reader.readline()
+                if not line:
+                    return
+                if line in (b"\r\n", b"\n"):
+                    break
+                header.append(line)
+            await reader.readexactly(parse_content_length(b"".join(header)))
+            await asyncio.sleep(delay_s)
+            writer.write(response)
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+
+async def _benchmark(delay_s: float, duration_s: float = 1.0):
+    from state import AircraftState
+    from state_parser import render_reply
+
+    import numpy as np
+
+    state = AircraftState()
+    state["m-flightAxisControllerIsActive"] = True
+    reply = render_reply(state.as_dict())
+    server = await asyncio.start_server(
+        lambda r, w: _serve_stand_in(r, w, reply, delay_s), "127.0.0.1", 0)
+    host, port = server.sockets[0].getsockname()[:2]
+
+    print("stand-in latency {:.1f} ms".format(delay_s * 1e3))
+    for n in (1, 2, 4, 8, 16, 32):
+        connectors = [AsyncFlightAxisConnector(host, port) for _ in range(n)]
+        control_inputs = np.full((n, 12), 0.5)
+        steps = 0
+        t0 = time.perf_counter()
+        while time.perf_counter() - t0 < duration_s:
+            await exchange_all(connectors, control_inputs)
+            steps += n
+        dt = time.perf_counter() - t0
+        print("N={:>2}: {:>7.0f} steps/s".format(n, steps / dt))
+        for c in connectors:
+            c.transport.close()
+        await asyncio.sleep(0.01)  # let the stand-in see the disconnects
+    server.close()
+    await server.wait_closed()
+
+
+if __name__ == "__main__":
+    asyncio.run(_benchmark(0.002))
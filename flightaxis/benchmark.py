@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+""" Step latency benchmark of FlightAxisConnector
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from connector import FlightAxisConnector
+from emulator import FlightAxisEmulator
+from transport import ConnectorConfig
+
+
+def run(connector: FlightAxisConnector, steps: int,
+        warmup: int = 100) -> dict:
+    """Step `connector` with hover controls and return latency stats.
+    """
+
+    connector.warm()
+    control_input = np.full(12, 0.5)
+    control_input[2] = 0.55
+    for _ in range(warmup):
+        connector.exchange_data(control_input)
+
+    latency = np.empty(steps)
+    t_start = time.perf_counter()
+    for i in range(steps):
+        t0 = time.perf_counter()
+        connector.exchange_data(control_input)
+        latency[i] = time.perf_counter() - t0
+    elapsed = time.perf_counter() - t_start
+
+    return {
+        "steps": steps,
+        "steps_per_s": steps / elapsed,
+        "mean_ms": latency.mean() * 1e3,
+        "p50_ms": np.percentile(latency, 50) * 1e3,
+        "p99_ms": np.percentile(latency, 99) * 1e3,
+        "max_ms": latency.max() * 1e3,
+    }
+
+
+def run_episodes(connector: FlightAxisConnector, episodes: int,
+                 steps: int = 10) -> dict:
+    """Run short episodes and return the connector's controller stats.
+    """
+
+    control_input = np.full(12, 0.5)
+    for _ in range(episodes):
+        connector.reset_episode(control_input)
+        for _ in range(steps):
+            connector.exchange_data(control_input)
+    return connector.controller_stats()
+
+
+def report(name: str, stats: dict) -> None:
+    print("{:<24} {:>9.0f} steps/s  p50 {:>7.3f} ms  p99 {:>7.3f} ms  "
+          "max {:>7.3f} ms".format(name, stats["steps_per_s"],
+                                   stats["p50_ms"], stats["p99_ms"],
+                                   stats["max_ms"]))
+
+
+if __name__ == "__main__":
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", type=str, default=None,
+                    help="FlightAxis Link host; default runs local emulator")
+    ap.add_argument("--port", type=int, default=18083)
+    ap.add_argument("--steps", type=int, default=5000)
+    args = ap.parse_args()
+
+    if args.host is not None:
+        connector = FlightAxisConnector(args.host, args.port)
+        report("{}:{}".format(args.host, args.port),
+               run(connector, args.steps))
+    else:
+        for latency_ms, jitter_ms in ((0, 0), (1, 0), (1, 1), (5, 2)):
+            emulator = FlightAxisEmulator(latency_s=latency_ms / 1e3,
+                                          jitter_s=jitter_ms / 1e3,
+                                          physics_dt=1 / 300).start()
+            connector = FlightAxisConnector(*emulator.address)
+            steps = args.steps if latency_ms == 0 else args.steps // 10
+            report("emulator {}+{} ms".format(latency_ms, jitter_ms),
+                   run(connector, steps))
+            connector.transport.close()
+            emulator.stop()
+
+        emulator = FlightAxisEmulator(latency_s=0.001).start()
+        for pipeline in (False, True):
+            config = ConnectorConfig(*emulator.address,
+                                     pipeline_requests=pipeline)
+            connector = FlightAxisConnector(config=config)
+            stats = run_episodes(connector, 100)
+            print("{:<24} reset {:>7.3f} ms  {:.2f} extra round-trips per "
+                  "episode".format("resets, pipelined" if pipeline
+                                   else "resets", stats["reset_mean_ms"],
+                                   stats["extra_round_trips_per_reset"]))
+            connector.transport.close()
+        emulator.stop()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+""" Record and replay raw FlightAxis Link SOAP traffic
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import struct
+import threading
+import time
+
+from emulator import SoapRequestHandler, SoapServer
+
+MAGIC = b"FAXCAP1\n"
+# reply wall time, round-trip, action length, request length, reply length
+_RECORD = struct.Struct("<ddHII")
+
+Exchange = collections.namedtuple(
+    "Exchange", ["t", "latency_s", "action", "request", "reply"])
+
+
+class CaptureWriter(object):
+    """Append raw request/reply pairs to a capture file.
+
+    Set as `transport.capture` to record every successful request of a
+    connector. Each record stores the reply wall time, the round-trip,
+    the SOAP action, the complete request frame and the reply body.
+    """
+
+    def __init__(self, path: str):
+        self._f = open(path, "wb")
+        self._f.write(MAGIC)
+        self._lock = threading.Lock()
+        self.count = 0
+
+    def write(self, action: str, request: bytes, reply: bytes,
+              latency_s: float) -> None:
+        action = action.encode("ascii")
+        header = _RECORD.pack(time.time(), latency_s, len(action),
+                              len(request), len(reply))
+        with self._lock:
+            self._f.write(header)
+            self._f.write(action)
+            self._f.write(request)
+            self._f.write(reply)
+            self.count += 1
+
+    def close(self) -> None:
+        self._f.close()
+
+
+def read_capture(path: str):
+    """Yield every `Exchange` of a capture file in recording order.
+    """
+
+    with open(path, "rb") as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("{} is not a FlightAxis capture".format(path))
+        while True:
+            header = f.read(_RECORD.size)
+            if len(header) < _RECORD.size:
+                return
+            t, latency_s, n_action, n_request, n_reply = \
+                _RECORD.unpack(header)
+            action = f.read(n_action).decode("ascii")
+            request = f.read(n_request)
+            reply = f.read(n_reply)
+            yield Exchange(t, latency_s, action, request, reply)
+
+
+class ReplayBackend(object):
+    """Serve captured replies in recording order, per SOAP action.
+
+    Every reply is delayed by its recorded round-trip divided by
+    `speed`; a `speed` of 0 replies immediately. With `loop` the capture
+    restarts when exhausted, otherwise the last reply is repeated.
+    """
+
+    def __init__(self, exchanges, speed: float = 1.0, loop: bool = True):
+        self.speed = speed
+        self.loop = loop
+        self.replies = collections.defaultdict(list)
+        for exchange in exchanges:
+            self.replies[exchange.action].append(
+                (exchange.latency_s, exchange.reply))
+        self._cursor = collections.Counter()
+        self._lock = threading.Lock()
+        self.served = 0
+
+    def handle(self, action: str, body: bytes) -> bytes:
+        entries = self.replies.get(action)
+        if not entries:
+            return b""
+        with self._lock:
+            i = self._cursor[action]
+            if i >= len(entries):
+                i = 0 if self.loop else len(entries) - 1
+            self._cursor[action] = i + 1
+            self.served += 1
+        latency_s, reply = entries[i]
+        if self.speed:
+            time.sleep(latency_s / self.speed)
+        return reply
+
+
+class ReplayServer(object):
+    """Local FlightAxis Link stand-in replaying a capture file.
+    """
+
+    def __init__(self, path: str, host: str = "127.0.0.1", port: int = 0,
+                 speed: float = 1.0, loop: bool = True):
+        self.backend = ReplayBackend(read_capture(path), speed, loop)
+        self._server = SoapServer((host, port), SoapRequestHandler)
+        self._server.backend = self.backend
+
+    @property
+    def address(self) -> tuple:
+        return self._server.server_address[:2]
+
+    def start(self) -> "ReplayServer":
+        threading.Thread(target=self._server.serve_forever,
+                         daemon=True).start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+
+if __name__ == "__main__":
+    import argparse
+    import math
+
+    import numpy as np
+
+    from benchmark import report, run
+    from connector import FlightAxisConnector
+    from emulator import FlightAxisEmulator
+    from state import AircraftState
+    from state_parser import StateParser
+
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="command")
+    rec = sub.add_parser("record", help="capture a session")
+    rec.add_argument("path")
+    rec.add_argument("--host", type=str, default=None,
+                     help="FlightAxis Link host; default runs local emulator")
+    rec.add_argument("--port", type=int, default=18083)
+    rec.add_argument("--steps", type=int, default=3000)
+    rep = sub.add_parser("replay", help="benchmark against a capture")
+    rep.add_argument("path")
+    rep.add_argument("--speed", type=float, default=0.0,
+                     help="1 for original timing, 0 for no delay")
+    rep.add_argument("--steps", type=int, default=3000)
+    args = ap.parse_args()
+
+    if args.command == "record":
+        emulator = None
+        if args.host is None:
+            emulator = FlightAxisEmulator().start()
+            host, port = emulator.address
+        else:
+            host, port = args.host, args.port
+        connector = FlightAxisConnector(host, port)
+        writer = CaptureWriter(args.path)
+        connector.transport.capture = writer
+        control_input = np.full(12, 0.5)
+        for i in range(args.steps):
+            control_input[2] = 0.5 + 0.1 * math.sin(i / 100.0)
+            connector.exchange_data(control_input)
+        writer.close()
+        print("captured {} exchanges to {}".format(writer.count, args.path))
+        if emulator is not None:
+            emulator.stop()
+
+    elif args.command == "replay":
+        replies = [e.reply for e in read_capture(args.path)
+                   if e.action == "ExchangeData"]
+        parser = StateParser()
+        state = AircraftState()
+        t0 = time.perf_counter()
+        for reply in replies:
+            parser.parse(reply, state)
+        dt = time.perf_counter() - t0
+        print("parse: {} replies, {:.2f} us/reply".format(
+            len(replies), dt / len(replies) * 1e6))
+
+        server = ReplayServer(args.path, speed=args.speed).start()
+        connector = FlightAxisConnector(*server.address)
+        report("replay x{}".format(args.speed or "inf"),
+               run(connector, args.steps))
+        server.stop()
+
+    else:
+        ap.print_help()
@@ -17,13 +17,16 @@ You should have received a copy of the GNU General Public License
 along with this program.  If not, see <http://www.gnu.org/licenses/>.
 """
 
-import re
-import requests
-import socket
+import enum
+import time
 
 import numpy as np
 
-from xml.etree import ElementTree as ET
+from encoder import ExchangeDataEncoder
+from state import INDEX, AircraftState, Flag
+from state_parser import StateParser
+from transport import (ConnectorConfig, FlightAxisTransport, LatencyCounter,
+                       encode_frame)
 
 SIM_DEFAULT = { # (name, value, save)        
         "AHRS_EKF_TYPE": (10, False),
@@ -116,209 +119,260 @@ ACTION_FMT = {
 }
 
 
-def is_number(s: str) -> bool:
-    return s.replace('.', '').replace('-', '').isdigit()
+def utf8len(s: str) -> int:
+    """Return byte length of string.
+    """
 
+    return len(s.encode('utf-8'))
 
-def parse_tail(s: str):
-    if is_number(s):
-        return float(s)
-    elif s == 'true':
-        return True
-    elif s == 'false':
-        return False
-    else:
-        return s
 
+PHYSICS_TIME = INDEX["m-currentPhysicsTime-SEC"]
 
-def utf8len(s: str) -> int:
-    """Return byte length of string.
+RESTORE = "RestoreOriginalControllerDevice"
+INJECT = "InjectUAVControllerInterface"
+
+
+class ControllerState(enum.IntEnum):
+    """Whether our UAV controller drives the simulated aircraft.
     """
 
-    return len(s.encode('utf-8'))
+    UNKNOWN = 0  # not injected by this connector yet
+    PENDING = 1  # injected, no reply has confirmed it yet
+    ACTIVE = 2  # replies report the controller active
+    LOST = 3  # simulator dropped the controller or reset was pressed
 
 
 class FlightAxisConnector(object):
     """Simulator connector for FlightAxis Link
 
+    `controller` tracks injection of the UAV controller from the flags
+    of every ExchangeData reply. The controller is injected on the first
+    step and again only after the simulator dropped it or the reset
+    button was pressed; a reset button flag held over several replies
+    triggers one injection, and replies that have not caught up with an
+    injection yet get `inject_grace` frames before it counts as lost.
     """
 
     _URL = "biobrain.tplinkdns.com"
     _PORT = 18083
-    _msg = ("POST / HTTP/1.1\n"
-            "soapaction: '{}'\n"
-            "content-length: {}\n"
-            "content-type: text/xml;charset='UTF-8'\n"
-            "Connection: Keep-Alive\n"
-            "\n"
-            "{}")
-
-    def __init__(self):
-        # self._host_ip = socket.gethostbyname(
-        #     FlightAxisConnector._URL)  # type: str
-        # self._socket = socket.socket(socket.AF_INET,
-        #                              socket.SOCK_STREAM)  # type: socket.socket
-        # # self._socket.setsockopt(socket.SOL_TCP, socket.TCP_NODELAY, 1)
-        # # self._host_ip = "127.0.0.1"
-        # self._socket.connect((self._host_ip, FlightAxisConnector._PORT))
-        # self._socket.setblocking(0)
 
+    def __init__(self, host: str = _URL, port: int = _PORT,
+                 state: AircraftState = None, config: ConnectorConfig = None,
+                 inject_grace: int = 2):
+        """
+        Args:
+            host: FlightAxis Link host, unless `config` is given.
+            port: FlightAxis Link port, unless `config` is given.
+            state: State to parse replies into; a new one by default.
+            config: Endpoint, timeouts and connection pool settings.
+            inject_grace: Replies after an injection that may still
+                report the controller inactive.
+        """
+
+        self.config = config if config is not None else ConnectorConfig(
+            host, port)
+        self.transport = FlightAxisTransport(self.config)
+        self.encoder = ExchangeDataEncoder()
+        self._frames = {
+            action: encode_frame(action, ACTION_FMT[action].encode("utf_8"))
+            for action in (RESTORE, INJECT)
+        }
         self.servos = np.zeros(12, dtype=float)
-        self.controller_started = False
+        self.controller = ControllerState.UNKNOWN
+        self.inject_grace = inject_grace
+        self._reset_pressed = False
+        self.injections = 0
+        self.resets = 0
+        self.extra_round_trips = 0  # round-trips other than ExchangeData
+        self.reset_latency = LatencyCounter()
         self.frame_counter = 0
         self.activation_frame_counter = 0
         self.average_frame_time_s = 0
         self.socket_frame_counter = 0
-        self.state = {
-            "m-currentPhysicsTime-SEC": 0,
-            "m-currentPhysicsSpeedMultiplier": 1,
-            "m-airspeed-MPS": 0,
-            "m-altitudeASL-MTR": 0,
-            "m-altitudeAGL-MTR": 0,
-            "m-groundspeed-MPS": 0,
-            "m-pitchRate-DEGpSEC": 0,
-            "m-rollRate-DEGpSEC": 0,
-            "m-yawRate-DEGpSEC": 0,
-            "m-azimuth-DEG": 0,
-            "m-inclination-DEG": 0,
-            "m-roll-DEG": 0,
-            "m-orientationQuaternion-X": 0,
-            "m-orientationQuaternion-Y": 0,
-            "m-orientationQuaternion-Z": 0,
-            "m-orientationQuaternion-W": 0,
-            "m-aircraftPositionX-MTR": 0,
-            "m-aircraftPositionY-MTR": 0,
-            "m-velocityWorldU-MPS": 0,
-            "m-velocityWorldV-MPS": 0,
-            "m-velocityWorldW-MPS": 0,
-            "m-velocityBodyU-MPS": 0,
-            "m-velocityBodyV-MPS": 0,
-            "m-velocityBodyW-MPS": 0,
-            "m-accelerationWorldAX-MPS2": 0,
-            "m-accelerationWorldAY-MPS2": 0,
-            "m-accelerationWorldAZ-MPS2": 0,
-            "m-accelerationBodyAX-MPS2": 0,
-            "m-accelerationBodyAY-MPS2": 0,
-            "m-accelerationBodyAZ-MPS2": 0,
-            "m-windX-MPS": 0,
-            "m-windY-MPS": 0,
-            "m-windZ-MPS": 0,
-            "m-propRPM": 0,
-            "m-heliMainRotorRPM": -1,
-            "m-batteryVoltage-VOLTS": -1,
-            "m-batteryCurrentDraw-AMPS": -1,
-            "m-batteryRemainingCapacity-MAH": -1,
-            "m-fuelRemaining-OZ": 0,
-            "m-isLocked": False,
-            "m-hasLostComponents": False,
-            "m-anEngineIsRunning": True,
-            "m-isTouchingGround": True,
-            "m-flightAxisControllerIsActive": False,
-            "m-currentAircraftStatus": "CAS-FLYING",
-            "m-resetButtonHasBeenPressed": False,
-        }
+        self.state = state if state is not None else AircraftState()
+        self.recorder = None  # e.g. recorder.TrajectoryRecorder
+        self.metrics = None  # e.g. metrics.StageMetrics
+        # e.g. action.ActionFilter() with the encoder's selected channels
+        self.action_filter = None
+        self._parser = StateParser()
+
+    def warm(self) -> None:
+        """Resolve and connect now rather than on the first tick.
+
+        Opens the active connection and fills the connection pool.
+        Raises OSError if the simulator is not reachable; without a
+        call, the first request connects.
+        """
+
+        self.transport.warm()
 
     def exchange_data(self, control_input) -> None:
-        if (not self.controller_started
-                or self.state["m-flightAxisControllerIsActive"] == False
-                or self.state["m-resetButtonHasBeenPressed"]):
-            self.soap_request("RestoreOriginalControllerDevice")
-            self.soap_request("InjectUAVControllerInterface")
-            self.activation_frame_counter = self.frame_counter
-            self.controller_started = True
-
-        action = "ExchangeData"
-        servo = control_input.tolist()
-        ex_data_msg = ACTION_FMT[action].format(*servo)
-        reply = self.soap_request(action, ex_data_msg)
+        if self.needs_controller():
+            self.inject_controller(restore=True)
+
+        if self.metrics is not None:
+            self.metrics.exchange_data(self, control_input)
+            return
+        reply = self.transport.request("ExchangeData",
+                                       frame=self.encode_controls(control_input))
         if reply:
-            lastt_s = self.state["m-currentPhysicsTime-SEC"]
-            self.parse_reply(reply)
-            dt = state.m_currentPhysicsTime_SEC - lastt_s
-            if 0 < dt < 0.1:
-                if self.average_frame_time_s < 1e-6:
-                    self.average_frame_time_s = dt
-                self.average_frame_time_s = (self.average_frame_time_s * 0.98 +
-                                             dt * 0.02)
-            self.socket_frame_counter += 1
-
-    def parse_reply(self, reply: str) -> None:
-        xml_txt = "".join(reply.split("\n")[-2:])
-        root = ET.fromstring(xml_txt)
-
-        aircraft_state = root[0][0][1]
-        for item in aircraft_state:
-            if item.tag in self.state.keys():
-                self.state[item.tag] = parse_tail(item.tail)
-
-        notification = root[0][0][2]
-        for item in notification:
-            if item.tag in self.state.keys():
-                self.state[item.tag] = parse_tail(item.tail)
-
-    def soap_request(self, action: str, body: str = "") -> str:
-        url = "http://biobrain.tplinkdns.com:18083"
-        _msg = ("POST / HTTP/1.1\n"
-                "soapaction: '{}'\n"
-                "content-length: {}\n"
-                "content-type: text/xml;charset='UTF-8'\n"
-                "Connection: Keep-Alive\n"
-                "\n"
-                "{}")
-        body_encoded = body.encode("utf_8", errors="strict")
-        headers = {"soapaction": action,
-                "content-type": "text/xml;charset='UTF-8'",
-                "Connection": "Keep-Alive",
-                }
-
-        response = requests.post(url, data=body, headers=headers)
-        return response.content
-
-    def soap_request2(self, action: str, fmt: str = "") -> str:
+            self.update_state(reply)
+
+    @property
+    def controller_started(self) -> bool:
+        return self.controller in (ControllerState.PENDING,
+                                   ControllerState.ACTIVE)
+
+    def needs_controller(self) -> bool:
+        """Return whether the UAV controller has to be (re)injected.
+        """
+
+        return self.controller in (ControllerState.UNKNOWN,
+                                   ControllerState.LOST)
+
+    def injection_requests(self, restore: bool) -> list:
+        """Return (action, frame) pairs that inject the controller.
+        """
+
+        actions = (RESTORE, INJECT) if restore else (INJECT,)
+        return [(action, self._frames[action]) for action in actions]
+
+    def inject_controller(self, restore: bool = True) -> None:
+        """Inject the UAV controller, restarting the flight.
+
+        Args:
+            restore: Restore the original controller first, as needed
+                when the injection state of the simulator is unknown.
+        """
+
+        requests = self.injection_requests(restore)
+        if self.config.pipeline_requests:
+            self.transport.request_many(requests)
+            self.controller_injected(1)
+        else:
+            for action, frame in requests:
+                self.transport.request(action, frame=frame)
+            self.controller_injected(len(requests))
+
+    def controller_injected(self, round_trips: int = 2) -> None:
+        self.activation_frame_counter = self.socket_frame_counter
+        self.controller = ControllerState.PENDING
+        self.injections += 1
+        self.extra_round_trips += round_trips
+
+    def update_controller(self) -> None:
+        """Advance `controller` from the flags of the latest reply.
+        """
+
+        flags = self.state.flags
+        active = flags & Flag.FLIGHT_AXIS_CONTROLLER_IS_ACTIVE
+        reset = bool(flags & Flag.RESET_BUTTON_HAS_BEEN_PRESSED)
+        pressed = reset and not self._reset_pressed
+        self._reset_pressed = reset
+        controller = self.controller
+        if controller == ControllerState.ACTIVE:
+            if pressed or not active:
+                self.controller = ControllerState.LOST
+        elif controller == ControllerState.PENDING:
+            if pressed:
+                self.controller = ControllerState.LOST
+            elif active:
+                self.controller = ControllerState.ACTIVE
+            elif (self.socket_frame_counter - self.activation_frame_counter
+                  > self.inject_grace):
+                self.controller = ControllerState.LOST
+
+    def reset_episode(self, control_input=None) -> AircraftState:
+        """Restart the flight and return the first state of the episode.
+
+        An active controller is re-injected without restoring the
+        original controller first, which saves one round-trip; with
+        `config.pipeline_requests` a full injection also costs a single
+        round-trip. The first ExchangeData sends `control_input`, or the
+        last servo values.
+        """
+
+        t0 = time.perf_counter()
+        self.state.reset()
+        self._reset_pressed = False
+        self.inject_controller(restore=self.needs_controller())
+        self.exchange_data(self.servos if control_input is None
+                           else control_input)
+        self.reset_latency.record(time.perf_counter() - t0)
+        self.resets += 1
+        return self.state
+
+    def controller_stats(self) -> dict:
+        return {
+            "controller": self.controller.name,
+            "injections": self.injections,
+            "resets": self.resets,
+            "extra_round_trips": self.extra_round_trips,
+            "extra_round_trips_per_reset":
+                self.extra_round_trips / self.resets if self.resets else 0.0,
+            "reset_mean_ms": self.reset_latency.mean_s * 1e3,
+            "reset_max_ms": self.reset_latency.max_s * 1e3,
+        }
+
+    def encode_controls(self, control_input) -> memoryview:
+        action_filter = self.action_filter
+        if action_filter is not None:
+            control_input = action_filter(control_input)
+            if not action_filter.changed:
+                # same %.4f channels as the frame already holds
+                return self.encoder.view
+        self.servos[:] = control_input
+        return self.encoder.encode(self.servos)
+
+    def update_state(self, reply: bytes) -> None:
+        """Parse ExchangeData `reply` and update frame timing.
         """
 
+        last_physics_s = self.state.values[PHYSICS_TIME]
+        self.parse_reply(reply)
+        self.state_updated(last_physics_s)
+
+    def state_updated(self, last_physics_s: float) -> None:
+        """Bookkeeping after a reply was parsed into `state`.
+        """
+
+        dt = self.state.values[PHYSICS_TIME] - last_physics_s
+        if 0 < dt < 0.1:
+            if self.average_frame_time_s < 1e-6:
+                self.average_frame_time_s = dt
+            self.average_frame_time_s = (self.average_frame_time_s * 0.98 +
+                                         dt * 0.02)
+        self.socket_frame_counter += 1
+        self.update_controller()
+        if self.recorder is not None:
+            self.recorder.record(
+                self.servos, self.state,
+                self.transport.latency["ExchangeData"].last_s)
+
+    def parse_reply(self, reply: bytes) -> None:
+        self._parser.parse(reply, self.state)
+
+    def soap_request(self, action: str, body: str = "") -> bytes:
+        """Send one SOAP request over the keep-alive transport.
+
         Args:
             action:
                 "RestoreOriginalControllerDevice"
                 "InjectUAVControllerInterface"
                 "ExchangeData"
+            body: SOAP envelope; defaults to `ACTION_FMT[action]`.
         Returns:
-            Return string from RealFlight.
+            Reply body from RealFlight.
         """
-        # _socket = socket.socket(socket.AF_INET,
-        #                              socket.SOCK_STREAM)  # type: socket.socket
-        # _socket.connect((self._host_ip, FlightAxisConnector._PORT))
-        # _socket.setblocking(0)
-        # _socket.settimeout(1)
-
-        if fmt == "":
-            fmt = ACTION_FMT[action]
-        msg = FlightAxisConnector._msg.format(action, len(fmt), fmt)
-        # ret = self._socket.send(bytes(msg, encoding="utf_8"))
-        ret = self._socket.send(msg.encode("utf_8", errors="strict"))
-        #print(bytes(msg, encoding="utf8"))
-
-        self._socket.settimeout(1)
-        chunk = self._socket.recv(4096)
-        byte_received = len(chunk)
-        data = chunk.decode()
-        if data == 0:
-            print("No data")
-            return None
-
-        # get content length
-        m = re.search(r"(?<=Content-Length:).+", data)
-        if m is None:
-            print("No Content-Length")
-            return None
-
-        content_length = int(m.group(0))
-
-        q = data.find("<?xml")
-        print("DEBUG DEBUG DEBUG")
-        print(data[q:])
-        # _socket.close()
-        return data
+
+        if not body:
+            frame = self._frames.get(action)
+            if frame is not None:
+                return self.transport.request(action, frame=frame)
+            body = ACTION_FMT[action]
+        if isinstance(body, str):
+            body = body.encode("utf_8", errors="strict")
+        return self.transport.request(action, body)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,351 @@
+#!/usr/bin/env python3
+""" Local FlightAxis Link stand-in with a rigid-body hover model
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+import random
+import re
+import socket
+import socketserver
+import threading
+import time
+
+from state import FIELDS, FLAGS, STATUS_KEY
+from state_parser import render_reply
+from transport import parse_content_length
+
+GRAVITY = 9.81
+
+_KEYS = [name for name, _ in FIELDS] + list(FLAGS) + [STATUS_KEY]
+# same element layout as render_reply, with format fields for the values
+_REPLY_FMT = render_reply({key: "{}" for key in _KEYS}).decode("utf_8")
+_REPLY_ORDER = [key for key in _KEYS if key != "m-resetButtonHasBeenPressed"]
+_REPLY_ORDER.append("m-resetButtonHasBeenPressed")
+
+_SOAP_ACTION = re.compile(rb"soapaction:\s*'?([A-Za-z]+)", re.IGNORECASE)
+_ITEM = re.compile(rb"<item>([^<]*)</item>")
+
+
+def _bool(value: bool) -> str:
+    return "true" if value else "false"
+
+
+class HoverModel(object):
+    """Rigid-body multirotor in mode 2 stick layout.
+
+    Channel 1 commands roll rate, channel 2 pitch rate, channel 3 total
+    thrust along the body z axis and channel 4 yaw rate. The world frame
+    is right-handed with z up.
+    """
+
+    def __init__(self, mass: float = 1.5, thrust_to_weight: float = 2.0,
+                 max_rate: float = math.radians(200), rate_tau: float = 0.05,
+                 drag: float = 0.3, crash_speed: float = 4.0):
+        self.mass = mass
+        self.max_thrust = thrust_to_weight * mass * GRAVITY
+        self.max_rate = max_rate
+        self.rate_tau = rate_tau
+        self.drag = drag
+        self.crash_speed = crash_speed
+        self.reset()
+
+    def reset(self) -> None:
+        self.time = 0.0
+        self.pos = [0.0, 0.0, 0.0]
+        self.vel = [0.0, 0.0, 0.0]
+        self.acc = [0.0, 0.0, 0.0]
+        self.q = [0.0, 0.0, 0.0, 1.0]  # x, y, z, w
+        self.rates = [0.0, 0.0, 0.0]  # roll, pitch, yaw in rad/s
+        self.on_ground = True
+        self.crashed = False
+
+    def rotate(self, v: list) -> list:
+        """Rotate body vector `v` into the world frame.
+        """
+
+        x, y, z, w = self.q
+        vx, vy, vz = v
+        # v + 2w (q x v) + 2 q x (q x v)
+        tx = 2 * (y * vz - z * vy)
+        ty = 2 * (z * vx - x * vz)
+        tz = 2 * (x * vy - y * vx)
+        return [vx + w * tx + y * tz - z * ty,
+                vy + w * ty + z * tx - x * tz,
+                vz + w * tz + x * ty - y * tx]
+
+    def unrotate(self, v: list) -> list:
+        x, y, z, w = self.q
+        self.q = [-x, -y, -z, w]
+        try:
+            return self.rotate(v)
+        finally:
+            self.q = [x, y, z, w]
+
+    def step(self, controls: list, dt: float) -> None:
+        if self.crashed:
+            self.time += dt
+            return
+
+        # first order response of body rates to stick commands
+        alpha = min(1.0, dt / self.rate_tau)
+        for i, channel in enumerate((0, 1, 3)):
+            target = (controls[channel] - 0.5) * 2 * self.max_rate
+            self.rates[i] += alpha * (target - self.rates[i])
+
+        # attitude: q' = q + dt/2 q (x) (0, w)
+        p, r_pitch, r_yaw = self.rates
+        x, y, z, w = self.q
+        h = 0.5 * dt
+        q = [x + h * (w * p + y * r_yaw - z * r_pitch),
+             y + h * (w * r_pitch + z * p - x * r_yaw),
+             z + h * (w * r_yaw + x * r_pitch - y * p),
+             w - h * (x * p + y * r_pitch + z * r_yaw)]
+        norm = math.sqrt(sum(c * c for c in q))
+        self.q = [c / norm for c in q]
+
+        # translation
+        thrust = controls[2] * self.max_thrust / self.mass
+        force = self.rotate([0.0, 0.0, thrust])
+        self.acc = [force[0] - self.drag * self.vel[0],
+                    force[1] - self.drag * self.vel[1],
+                    force[2] - self.drag * self.vel[2] - GRAVITY]
+        for i in range(3):
+            self.vel[i] += self.acc[i] * dt
+            self.pos[i] += self.vel[i] * dt
+
+        self.on_ground = self.pos[2] <= 0.0
+        if self.on_ground:
+            if self.vel[2] < -self.crash_speed:
+                self.crashed = True
+            self.pos[2] = 0.0
+            self.vel = [0.0, 0.0, max(0.0, self.vel[2])]
+            self.rates = [0.0, 0.0, 0.0]
+        self.time += dt
+
+    def euler(self) -> tuple:
+        """Return (roll, pitch, yaw) in radians.
+        """
+
+        x, y, z, w = self.q
+        roll = math.atan2(2 * (w * x + y * z), 1 - 2 * (x * x + y * y))
+        pitch = math.asin(max(-1.0, min(1.0, 2 * (w * y - z * x))))
+        yaw = math.atan2(2 * (w * z + x * y), 1 - 2 * (y * y + z * z))
+        return roll, pitch, yaw
+
+    def report(self, speed: float, controller_active: bool,
+               reset_pressed: bool) -> dict:
+        roll, pitch, yaw = self.euler()
+        vel_body = self.unrotate(self.vel)
+        acc_body = self.unrotate(self.acc)
+        speed_horizontal = math.hypot(self.vel[0], self.vel[1])
+        return {
+            "m-currentPhysicsTime-SEC": self.time,
+            "m-currentPhysicsSpeedMultiplier": speed,
+            "m-airspeed-MPS": math.sqrt(sum(v * v for v in self.vel)),
+            "m-altitudeASL-MTR": self.pos[2],
+            "m-altitudeAGL-MTR": self.pos[2],
+            "m-groundspeed-MPS": speed_horizontal,
+            "m-pitchRate-DEGpSEC": math.degrees(self.rates[1]),
+            "m-rollRate-DEGpSEC": math.degrees(self.rates[0]),
+            "m-yawRate-DEGpSEC": math.degrees(self.rates[2]),
+            "m-azimuth-DEG": math.degrees(yaw),
+            "m-inclination-DEG": math.degrees(pitch),
+            "m-roll-DEG": math.degrees(roll),
+            "m-orientationQuaternion-X": self.q[0],
+            "m-orientationQuaternion-Y": self.q[1],
+            "m-orientationQuaternion-Z": self.q[2],
+            "m-orientationQuaternion-W": self.q[3],
+            "m-aircraftPositionX-MTR": self.pos[0],
+            "m-aircraftPositionY-MTR": self.pos[1],
+            "m-velocityWorldU-MPS": self.vel[0],
+            "m-velocityWorldV-MPS": self.vel[1],
+            "m-velocityWorldW-MPS": self.vel[2],
+            "m-velocityBodyU-MPS": vel_body[0],
+            "m-velocityBodyV-MPS": vel_body[1],
+            "m-velocityBodyW-MPS": vel_body[2],
+            "m-accelerationWorldAX-MPS2": self.acc[0],
+            "m-accelerationWorldAY-MPS2": self.acc[1],
+            "m-accelerationWorldAZ-MPS2": self.acc[2],
+            "m-accelerationBodyAX-MPS2": acc_body[0],
+            "m-accelerationBodyAY-MPS2": acc_body[1],
+            "m-accelerationBodyAZ-MPS2": acc_body[2],
+            "m-windX-MPS": 0.0,
+            "m-windY-MPS": 0.0,
+            "m-windZ-MPS": 0.0,
+            "m-propRPM": 0.0,
+            "m-heliMainRotorRPM": -1.0,
+            "m-batteryVoltage-VOLTS": -1.0,
+            "m-batteryCurrentDraw-AMPS": -1.0,
+            "m-batteryRemainingCapacity-MAH": -1.0,
+            "m-fuelRemaining-OZ": 0.0,
+            "m-isLocked": _bool(False),
+            "m-hasLostComponents": _bool(self.crashed),
+            "m-anEngineIsRunning": _bool(not self.crashed),
+            "m-isTouchingGround": _bool(self.on_ground),
+            "m-flightAxisControllerIsActive": _bool(controller_active),
+            "m-currentAircraftStatus":
+                "CAS-CRASHED" if self.crashed else "CAS-FLYING",
+            "m-resetButtonHasBeenPressed": _bool(reset_pressed),
+        }
+
+
+class SoapRequestHandler(socketserver.StreamRequestHandler):
+    """Read FlightAxis Link requests and answer with `server.backend`.
+
+    The backend is any object with `handle(action, body) -> bytes`.
+    """
+
+    def setup(self):
+        super().setup()
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def handle(self):
+        backend = self.server.backend
+        while True:
+            header = []
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                if line in (b"\r\n", b"\n"):
+                    break
+                header.append(line)
+            header = b"".join(header)
+            body = self.rfile.read(parse_content_length(header))
+            m = _SOAP_ACTION.search(header)
+            reply = backend.handle(m.group(1).decode() if m else "", body)
+            self.wfile.write(b"HTTP/1.1 200 OK\r\n"
+                             b"Content-Type: text/xml; charset='UTF-8'\r\n"
+                             b"Content-Length: "
+                             + str(len(reply)).encode() + b"\r\n"
+                             b"Connection: Keep-Alive\r\n"
+                             b"\r\n" + reply)
+
+
+class SoapServer(socketserver.ThreadingMixIn, socketserver.TCPServer):
+    allow_reuse_address = True
+    daemon_threads = True
+
+
+class FlightAxisEmulator(object):
+    """Stand-in for FlightAxis Link on a local TCP port.
+
+    Speaks RestoreOriginalControllerDevice, InjectUAVControllerInterface
+    and ExchangeData. Injecting the controller resets the aircraft, like
+    starting a new flight in RealFlight. Every reply is delayed by
+    `latency_s` plus uniform jitter of up to `jitter_s`.
+
+    The model runs on wall time scaled by `speed`; with `physics_dt` set,
+    every ExchangeData advances the model by exactly that step instead,
+    which makes runs reproducible.
+    """
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0,
+                 latency_s: float = 0.0, jitter_s: float = 0.0,
+                 speed: float = 1.0, physics_dt: float = None,
+                 seed: int = None):
+        self.latency_s = latency_s
+        self.jitter_s = jitter_s
+        self.speed = speed
+        self.physics_dt = physics_dt
+        self.model = HoverModel()
+        self.controller_active = False
+        self.requests = {}  # type: dict
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._last_s = None
+        self._server = SoapServer((host, port), SoapRequestHandler)
+        self._server.backend = self
+        self._thread = None  # type: threading.Thread
+
+    @property
+    def address(self) -> tuple:
+        return self._server.server_address[:2]
+
+    def start(self) -> "FlightAxisEmulator":
+        self._thread = threading.Thread(target=self._server.serve_forever,
+                                        daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def serve_forever(self) -> None:
+        self._server.serve_forever()
+
+    def handle(self, action: str, body: bytes) -> bytes:
+        delay = self.latency_s
+        if self.jitter_s:
+            delay += self._random.uniform(0.0, self.jitter_s)
+        if delay > 0:
+            time.sleep(delay)
+
+        with self._lock:
+            self.requests[action] = self.requests.get(action, 0) + 1
+            if action == "RestoreOriginalControllerDevice":
+                self.controller_active = False
+                return b"<RestoreOriginalControllerDeviceResponse/>"
+            elif action == "InjectUAVControllerInterface":
+                self.controller_active = True
+                self.model.reset()
+                self._last_s = None
+                return b"<InjectUAVControllerInterfaceResponse/>"
+            elif action == "ExchangeData":
+                return self._exchange_data(body)
+            return b""
+
+    def _exchange_data(self, body: bytes) -> bytes:
+        now = time.monotonic()
+        if self.controller_active:
+            controls = [float(v) for v in _ITEM.findall(body)]
+            controls += [0.5] * (12 - len(controls))
+            if self.physics_dt is not None:
+                dt = self.physics_dt
+            elif self._last_s is None:
+                dt = 0.0
+            else:
+                dt = min(now - self._last_s, 0.1) * self.speed
+            while dt > 0:
+                h = min(dt, 0.002)
+                self.model.step(controls, h)
+                dt -= h
+        self._last_s = now
+        report = self.model.report(self.speed, self.controller_active, False)
+        return _REPLY_FMT.format(
+            *[report[key] for key in _REPLY_ORDER]).encode("utf_8")
+
+
+if __name__ == "__main__":
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", type=str, default="127.0.0.1")
+    ap.add_argument("--port", type=int, default=18083)
+    ap.add_argument("--latency", type=float, default=0.0, help="ms")
+    ap.add_argument("--jitter", type=float, default=0.0, help="ms")
+    ap.add_argument("--speed", type=float, default=1.0)
+    ap.add_argument("--physics-dt", type=float, default=None, help="s")
+    args = ap.parse_args()
+
+    emulator = FlightAxisEmulator(args.host, args.port, args.latency / 1e3,
+                                  args.jitter / 1e3, args.speed,
+                                  args.physics_dt)
+    print("FlightAxis Link emulator on {}:{}".format(*emulator.address))
+    emulator.serve_forever()
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+""" Hover environments on top of FlightAxisConnector
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from connector import FlightAxisConnector
+from state import (INDEX, N_FIELDS, AircraftState, AircraftStatus, Flag,
+                   field_slice)
+
+OBS_FIELDS = (
+    "m-altitudeAGL-MTR",
+    "m-orientationQuaternion-X",
+    "m-orientationQuaternion-Y",
+    "m-orientationQuaternion-Z",
+    "m-orientationQuaternion-W",
+    "m-velocityWorldU-MPS",
+    "m-velocityWorldV-MPS",
+    "m-velocityWorldW-MPS",
+    "m-pitchRate-DEGpSEC",
+    "m-rollRate-DEGpSEC",
+    "m-yawRate-DEGpSEC",
+)
+OBS_INDEX = np.array([INDEX[name] for name in OBS_FIELDS], dtype=np.intp)
+OBS_DIM = len(OBS_FIELDS)
+
+ALTITUDE = INDEX["m-altitudeAGL-MTR"]
+QUATERNION = field_slice("m-orientationQuaternion-X",
+                         "m-orientationQuaternion-W")
+VELOCITY = field_slice("m-velocityWorldU-MPS", "m-velocityWorldW-MPS")
+
+NEUTRAL_CONTROLS = np.full(12, 0.5)
+
+
+def hover_reward(states: np.ndarray, target_altitude: float = 2.0,
+                 altitude_weight: float = 1.0, tilt_weight: float = 1.0,
+                 velocity_weight: float = 0.1) -> np.ndarray:
+    """Return hover reward of every row of an (N, N_FIELDS) state batch.
+
+    Penalizes altitude error, tilt of the body z axis away from vertical
+    and squared world velocity.
+    """
+
+    altitude_error = np.abs(states[:, ALTITUDE] - target_altitude)
+    q = states[:, QUATERNION]
+    # z component of the body up axis in world frame is cos(tilt)
+    cos_tilt = 1.0 - 2.0 * (q[:, 0] ** 2 + q[:, 1] ** 2)
+    v = states[:, VELOCITY]
+    speed2 = np.einsum("ij,ij->i", v, v)
+    return -(altitude_weight * altitude_error
+             + tilt_weight * (1.0 - cos_tilt)
+             + velocity_weight * speed2)
+
+
+def is_terminal(state: AircraftState) -> bool:
+    return bool(state.status == AircraftStatus.CRASHED
+                or state.flags & Flag.HAS_LOST_COMPONENTS)
+
+
+class VectorHoverEnv(object):
+    """N hover environments stepped together.
+
+    Every connector parses into a row of one (N, N_FIELDS) array, so
+    observations and rewards come out as stacked (N, ...) arrays without
+    per-environment gathering. Round-trips run on a thread pool; the
+    socket I/O releases the GIL, so the simulators are stepped in
+    parallel.
+
+    Environments that finish are reset in `step`; their last
+    observation before the reset is returned in `info`.
+    """
+
+    def __init__(self, endpoints, target_altitude: float = 2.0,
+                 max_steps: int = 1000, max_workers: int = None,
+                 action_filter=None, observation=None):
+        """
+        Args:
+            endpoints: (host, port) of every FlightAxis Link instance.
+            target_altitude: Hover altitude above ground in meters.
+            max_steps: Episode length limit.
+            max_workers: Thread pool size; defaults to one per endpoint.
+            action_filter: Batched `action.ActionFilter` applied to the
+                (N, 12) actions of every step.
+            observation: Callable mapping the (N, N_FIELDS) states to
+                observations, e.g. `observation.ObservationBuilder`;
+                by default the raw `OBS_FIELDS` columns.
+        """
+
+        self.num_envs = len(endpoints)
+        self.target_altitude = target_altitude
+        self.max_steps = max_steps
+        self.states = np.zeros((self.num_envs, N_FIELDS))
+        self.connectors = [
+            FlightAxisConnector(host, port, AircraftState(self.states[i]))
+            for i, (host, port) in enumerate(endpoints)]
+        self.steps = np.zeros(self.num_envs, dtype=np.int64)
+        self.action_filter = action_filter
+        self.observation = observation
+        self._obs = np.zeros((self.num_envs, OBS_DIM))
+        self._pool = ThreadPoolExecutor(max_workers or self.num_envs)
+
+    def close(self) -> None:
+        self._pool.shutdown()
+        for connector in self.connectors:
+            connector.transport.close()
+
+    def observe(self, update: bool = True) -> np.ndarray:
+        if self.observation is not None:
+            return self.observation(self.states, update=update)
+        np.take(self.states, OBS_INDEX, axis=1, out=self._obs)
+        return self._obs
+
+    def reset(self) -> np.ndarray:
+        """Reset every environment and return the (N, OBS_DIM) observation.
+        """
+
+        self._run(self._reset_one, range(self.num_envs))
+        self.steps[:] = 0
+        if self.action_filter is not None:
+            self.action_filter.reset()
+        return self.observe().copy()
+
+    def step(self, actions: np.ndarray):
+        """Step every environment with its row of the (N, 12) `actions`.
+
+        Returns:
+            (observations, rewards, dones, info) with leading dimension N.
+        """
+
+        if self.action_filter is not None:
+            actions = self.action_filter(actions)
+        self._run(self._step_one, range(self.num_envs), actions)
+        self.steps += 1
+        rewards = hover_reward(self.states, self.target_altitude)
+        dones = np.array([is_terminal(c.state) for c in self.connectors])
+        dones |= self.steps >= self.max_steps
+        obs = self.observe().copy()
+        info = {}
+        if dones.any():
+            index = np.flatnonzero(dones)
+            info["terminal_observation"] = obs[index]
+            info["terminal_index"] = index
+            self._run(self._reset_one, index)
+            self.steps[index] = 0
+            if self.action_filter is not None:
+                self.action_filter.reset(index)
+            obs[index] = self.observe(update=False)[index]
+        return obs, rewards, dones, info
+
+    def _run(self, fn, index, *args) -> None:
+        for future in [self._pool.submit(fn, i, *args) for i in index]:
+            future.result()
+
+    def _reset_one(self, i: int) -> None:
+        self.connectors[i].reset_episode(NEUTRAL_CONTROLS)
+
+    def _step_one(self, i: int, actions: np.ndarray) -> None:
+        self.connectors[i].exchange_data(actions[i])
+
+
+class HoverEnv(object):
+    """Single hover environment with the `VectorHoverEnv` semantics.
+    """
+
+    def __init__(self, host: str = FlightAxisConnector._URL,
+                 port: int = FlightAxisConnector._PORT,
+                 target_altitude: float = 2.0, max_steps: int = 1000):
+        self.target_altitude = target_altitude
+        self.max_steps = max_steps
+        self.states = np.zeros((1, N_FIELDS))
+        self.connector = FlightAxisConnector(host, port,
+                                             AircraftState(self.states[0]))
+        self.steps = 0
+
+    def close(self) -> None:
+        self.connector.transport.close()
+
+    def observe(self) -> np.ndarray:
+        return self.states[0, OBS_INDEX]
+
+    def reset(self) -> np.ndarray:
+        self.connector.reset_episode(NEUTRAL_CONTROLS)
+        self.steps = 0
+        return self.observe()
+
+    def step(self, action: np.ndarray):
+        self.connector.exchange_data(action)
+        self.steps += 1
+        reward = float(hover_reward(self.states, self.target_altitude)[0])
+        done = is_terminal(self.connector.state) or self.steps >= self.max_steps
+        return self.observe(), reward, done, {}
@@ -0,0 +1,258 @@
+#!/usr/bin/env python3
+""" Per-stage latency instrumentation of the ExchangeData path
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+
+import numpy as np
+
+from connector import PHYSICS_TIME
+
+STAGES = (
+    "encode",  # control input to request frame
+    "send",  # frame handed to the kernel
+    "first_byte",  # send done to first reply byte: server time + RTT
+    "response",  # first to last reply byte
+    "parse",  # reply into AircraftState
+    "update",  # frame timing, controller tracking, recorder
+    "total",
+)
+QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+
+class HdrHistogram(object):
+    """Fixed-size log-linear histogram in the style of HdrHistogram.
+
+    Values are counted in integer `unit_s` steps. Every power-of-two
+    range has the same number of linear sub-buckets, so the relative
+    error stays below 10^-`digits` from `unit_s` up to `max_s` with a
+    few thousand counters. Larger values are counted as `max_s`.
+    """
+
+    def __init__(self, unit_s: float = 1e-6, max_s: float = 10.0,
+                 digits: int = 2):
+        self.unit_s = unit_s
+        self.scale = 1.0 / unit_s
+        self.sub_bits = int(np.ceil(np.log2(2 * 10 ** digits)))
+        self.half = 1 << (self.sub_bits - 1)
+        self.max_units = int(max_s * self.scale)
+        self.counts = [0] * (self._index(self.max_units) + 1)
+        self.reset()
+
+    def reset(self) -> None:
+        self.counts[:] = [0] * len(self.counts)
+        self.count = 0
+        self.total_s = 0.0
+        self.max_s = 0.0
+
+    def _index(self, units: int) -> int:
+        shift = units.bit_length() - self.sub_bits
+        if shift <= 0:
+            return units
+        return shift * self.half + (units >> shift)
+
+    def _upper_s(self, index: int) -> float:
+        """Return upper edge of bucket `index` in seconds.
+        """
+
+        if index < 2 * self.half:
+            return (index + 1) * self.unit_s
+        shift = index // self.half - 1
+        sub = index - shift * self.half
+        return ((sub + 1) << shift) * self.unit_s
+
+    def record(self, dt: float) -> None:
+        units = int(dt * self.scale)
+        if units > self.max_units:
+            units = self.max_units
+        elif units < 0:
+            units = 0
+        self.counts[self._index(units)] += 1
+        self.count += 1
+        self.total_s += dt
+        if dt > self.max_s:
+            self.max_s = dt
+
+    @property
+    def mean_s(self) -> float:
+        return self.total_s / self.count if self.count else 0.0
+
+    def percentile(self, q: float) -> float:
+        """Return upper edge of the bucket holding the `q`-th percentile.
+        """
+
+        if not self.count:
+            return 0.0
+        cumulative = np.cumsum(self.counts)
+        index = int(np.searchsorted(cumulative, self.count * q / 100.0))
+        return min(self._upper_s(index), self.max_s)
+
+
+class StageMetrics(object):
+    """Timestamp every stage of `FlightAxisConnector.exchange_data`.
+
+    Opt-in: set as `connector.metrics`. Each step then records encode,
+    send, first byte, full response, parse and state update durations
+    into `HdrHistogram`s and costs a few microseconds more, mostly for
+    one extra peek at the socket. Retry and reconnect counters are read
+    from the transport when a snapshot is taken.
+    """
+
+    def __init__(self, unit_s: float = 1e-6, max_s: float = 10.0):
+        self.histograms = {stage: HdrHistogram(unit_s, max_s)
+                           for stage in STAGES}
+        self._stages = [self.histograms[stage] for stage in STAGES]
+        self._trace = [0.0, 0.0]
+        self.steps = 0
+        self.transport = None
+
+    def exchange_data(self, connector, control_input) -> None:
+        """Timed equivalent of the ExchangeData part of `exchange_data`.
+        """
+
+        transport = connector.transport
+        self.transport = transport
+        trace = self._trace
+        transport.trace = trace
+        t0 = time.perf_counter()
+        frame = connector.encode_controls(control_input)
+        t1 = time.perf_counter()
+        try:
+            reply = transport.request("ExchangeData", frame=frame)
+        finally:
+            transport.trace = None
+        t4 = time.perf_counter()
+        if not reply:
+            return
+        last_physics_s = connector.state.values[PHYSICS_TIME]
+        connector.parse_reply(reply)
+        t5 = time.perf_counter()
+        connector.state_updated(last_physics_s)
+        t6 = time.perf_counter()
+
+        t2, t3 = trace
+        encode, send, first_byte, response, parse, update, total = \
+            self._stages
+        encode.record(t1 - t0)
+        send.record(t2 - t1)
+        first_byte.record(t3 - t2)
+        response.record(t4 - t3)
+        parse.record(t5 - t4)
+        update.record(t6 - t5)
+        total.record(t6 - t0)
+        self.steps += 1
+
+    def reset(self) -> None:
+        for histogram in self._stages:
+            histogram.reset()
+        self.steps = 0
+
+    def counters(self) -> dict:
+        transport = self.transport
+        if transport is None:
+            return {}
+        return {name: getattr(transport, name)
+                for name in ("connects", "reconnects", "retries", "timeouts",
+                             "bytes_sent", "bytes_received")
+                if hasattr(transport, name)}
+
+    def snapshot(self) -> dict:
+        """Return counters and per-stage stats in milliseconds.
+        """
+
+        stages = {}
+        for stage, histogram in self.histograms.items():
+            stats = {"count": histogram.count,
+                     "mean_ms": histogram.mean_s * 1e3,
+                     "max_ms": histogram.max_s * 1e3}
+            for q in QUANTILES:
+                stats["p{:g}_ms".format(q * 100)] = \
+                    histogram.percentile(q * 100) * 1e3
+            stages[stage] = stats
+        return {"steps": self.steps, "counters": self.counters(),
+                "stages": stages}
+
+    def prometheus(self, prefix: str = "flightaxis") -> str:
+        """Return the snapshot in the Prometheus text exposition format.
+        """
+
+        name = prefix + "_exchange_stage_seconds"
+        lines = ["# HELP {} ExchangeData step time per stage.".format(name),
+                 "# TYPE {} summary".format(name)]
+        for stage, histogram in self.histograms.items():
+            for q in QUANTILES:
+                lines.append('{}{{stage="{}",quantile="{:g}"}} {:.9g}'.format(
+                    name, stage, q, histogram.percentile(q * 100)))
+            lines.append('{}_sum{{stage="{}"}} {:.9g}'.format(
+                name, stage, histogram.total_s))
+            lines.append('{}_count{{stage="{}"}} {}'.format(
+                name, stage, histogram.count))
+        for counter, value in self.counters().items():
+            metric = "{}_transport_{}_total".format(prefix, counter)
+            lines.append("# TYPE {} counter".format(metric))
+            lines.append("{} {}".format(metric, value))
+        return "\n".join(lines) + "\n"
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from benchmark import report, run
+    from connector import FlightAxisConnector
+    from emulator import FlightAxisEmulator
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--host", type=str, default=None,
+                    help="FlightAxis Link host; default runs local emulator")
+    ap.add_argument("--port", type=int, default=18083)
+    ap.add_argument("--steps", type=int, default=5000)
+    ap.add_argument("--prometheus", action="store_true")
+    args = ap.parse_args()
+
+    histogram = HdrHistogram()
+    for dt in np.linspace(0.0, 0.1, 100001):
+        histogram.record(dt)
+    for q in (50, 99):
+        assert abs(histogram.percentile(q) - q / 1e3) < q / 1e3 * 0.01
+
+    emulator = None
+    if args.host is None:
+        emulator = FlightAxisEmulator(physics_dt=1 / 300).start()
+        host, port = emulator.address
+    else:
+        host, port = args.host, args.port
+
+    connector = FlightAxisConnector(host, port)
+    report("plain", run(connector, args.steps))
+    metrics = StageMetrics()
+    connector.metrics = metrics
+    report("instrumented", run(connector, args.steps, warmup=0))
+
+    if args.prometheus:
+        print(metrics.prometheus(), end="")
+    else:
+        snapshot = metrics.snapshot()
+        print("counters:", snapshot["counters"])
+        for stage, stats in snapshot["stages"].items():
+            print("{:>10}: mean {:8.4f} ms  p50 {:8.4f} ms  p99 {:8.4f} ms"
+                  "  max {:8.4f} ms".format(stage, stats["mean_ms"],
+                                            stats["p50_ms"], stats["p99_ms"],
+                                            stats["max_ms"]))
+    connector.transport.close()
+    if emulator is not None:
+        emulator.stop()
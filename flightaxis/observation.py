@@ -0,0 +1,218 @@
+#!/usr/bin/env python3
+""" Batched observation features from FlightAxis state arrays
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import numpy as np
+
+from state import INDEX, field_slice
+
+ALTITUDE = INDEX["m-altitudeAGL-MTR"]
+QUATERNION = field_slice("m-orientationQuaternion-X",
+                         "m-orientationQuaternion-W")
+POSITION = field_slice("m-aircraftPositionX-MTR", "m-aircraftPositionY-MTR")
+VELOCITY = field_slice("m-velocityWorldU-MPS", "m-velocityWorldW-MPS")
+RATES = np.array([INDEX["m-rollRate-DEGpSEC"], INDEX["m-pitchRate-DEGpSEC"],
+                  INDEX["m-yawRate-DEGpSEC"]], dtype=np.intp)
+
+FEATURES = (  # (name, width), in column order
+    ("altitude_error", 1),
+    ("position_error", 2),  # world x, y
+    ("velocity_body", 3),
+    ("gravity_body", 3),  # unit vector pointing down, in body axes
+    ("euler", 3),  # roll, pitch, yaw in radians
+    ("rates", 3),  # roll, pitch, yaw rate in rad/s
+)
+OBS_DIM = sum(width for _, width in FEATURES)
+
+
+def feature_slice(name: str) -> slice:
+    """Return columns of feature `name` in an observation.
+    """
+
+    start = 0
+    for feature, width in FEATURES:
+        if feature == name:
+            return slice(start, start + width)
+        start += width
+    raise KeyError(name)
+
+
+def rotation_matrices(q: np.ndarray, out: np.ndarray) -> np.ndarray:
+    """Write body-to-world rotation matrices of quaternions `q` into `out`.
+
+    `q` is (N, 4) in x, y, z, w order, as FlightAxis Link reports it;
+    `out` is (N, 3, 3).
+    """
+
+    qq = 2.0 * q[:, :, None] * q[:, None, :]  # 2 q_i q_j
+    xx, yy, zz = qq[:, 0, 0], qq[:, 1, 1], qq[:, 2, 2]
+    xy, xz, yz = qq[:, 0, 1], qq[:, 0, 2], qq[:, 1, 2]
+    wx, wy, wz = qq[:, 3, 0], qq[:, 3, 1], qq[:, 3, 2]
+    out[:, 0, 0] = 1.0 - yy - zz
+    out[:, 0, 1] = xy - wz
+    out[:, 0, 2] = xz + wy
+    out[:, 1, 0] = xy + wz
+    out[:, 1, 1] = 1.0 - xx - zz
+    out[:, 1, 2] = yz - wx
+    out[:, 2, 0] = xz - wy
+    out[:, 2, 1] = yz + wx
+    out[:, 2, 2] = 1.0 - xx - yy
+    return out
+
+
+def euler(r: np.ndarray, out: np.ndarray) -> None:
+    """Write (roll, pitch, yaw) of (N, 3, 3) rotation matrices into `out`.
+    """
+
+    np.arctan2(r[:, 2, 1], r[:, 2, 2], out=out[:, 0])
+    np.arcsin(np.clip(-r[:, 2, 0], -1.0, 1.0), out=out[:, 1])
+    np.arctan2(r[:, 1, 0], r[:, 0, 0], out=out[:, 2])
+
+
+class RunningNormalizer(object):
+    """Running per-column mean and variance for standardizing features.
+
+    Batches are merged with the parallel variance update of Chan et
+    al., so statistics over N environments cost one pass per step.
+    """
+
+    def __init__(self, dim: int, eps: float = 1e-8, clip: float = 10.0):
+        self.mean = np.zeros(dim)
+        self.var = np.ones(dim)
+        self.count = 0
+        self.eps = eps
+        self.clip = clip
+
+    def update(self, batch: np.ndarray) -> None:
+        n = len(batch)
+        if not n:
+            return
+        batch_mean = batch.mean(axis=0)
+        batch_var = batch.var(axis=0)
+        total = self.count + n
+        delta = batch_mean - self.mean
+        self.mean += delta * (n / total)
+        self.var = (self.var * self.count + batch_var * n
+                    + delta ** 2 * (self.count * n / total)) / total
+        self.count = total
+
+    def normalize(self, batch: np.ndarray, out: np.ndarray = None) \
+            -> np.ndarray:
+        out = np.subtract(batch, self.mean, out=out)
+        out /= np.sqrt(self.var + self.eps)
+        if self.clip:
+            np.clip(out, -self.clip, self.clip, out=out)
+        return out
+
+
+class ObservationBuilder(object):
+    """Turn an (N, N_FIELDS) state batch into (N, OBS_DIM) features.
+
+    Features are listed in `FEATURES`: altitude and horizontal position
+    error to the hover target, velocity and gravity in body axes, Euler
+    angles and body rates. With `normalize` they are standardized by a
+    `RunningNormalizer` that is updated on every call with `update`.
+    """
+
+    def __init__(self, target_altitude: float = 2.0, target_xy=(0.0, 0.0),
+                 normalize: bool = True, clip: float = 10.0):
+        self.target_altitude = target_altitude
+        self.target_xy = np.asarray(target_xy, dtype=float)
+        self.normalizer = RunningNormalizer(OBS_DIM, clip=clip) \
+            if normalize else None
+        self._r = None
+        self._raw = None
+        self._out = None
+
+    def _buffers(self, n: int) -> None:
+        if self._raw is None or len(self._raw) != n:
+            self._raw = np.zeros((n, OBS_DIM))
+            self._out = np.zeros((n, OBS_DIM))
+            self._r = np.zeros((n, 3, 3))
+
+    def features(self, states: np.ndarray) -> np.ndarray:
+        """Return raw features; the array is reused by the next call.
+        """
+
+        self._buffers(len(states))
+        raw = self._raw
+        r = rotation_matrices(states[:, QUATERNION], self._r)
+        np.subtract(states[:, ALTITUDE], self.target_altitude,
+                    out=raw[:, 0])
+        np.subtract(states[:, POSITION], self.target_xy, out=raw[:, 1:3])
+        # world to body is the transpose; gravity is -z of the world
+        np.einsum("nji,nj->ni", r, states[:, VELOCITY], out=raw[:, 3:6])
+        np.negative(r[:, 2, :], out=raw[:, 6:9])
+        euler(r, raw[:, 9:12])
+        np.radians(states[:, RATES], out=raw[:, 12:15])
+        return raw
+
+    def __call__(self, states: np.ndarray, update: bool = True) \
+            -> np.ndarray:
+        """Return (N, OBS_DIM) observations; reused by the next call.
+        """
+
+        raw = self.features(states)
+        if self.normalizer is None:
+            return raw
+        if update:
+            self.normalizer.update(raw)
+        return self.normalizer.normalize(raw, out=self._out)
+
+
+if __name__ == "__main__":
+    import time
+
+    from emulator import HoverModel
+    from state import AircraftState, N_FIELDS
+
+    # features agree with what the emulator reports
+    model = HoverModel()
+    controls = [0.6, 0.45, 0.7, 0.55]
+    states = np.zeros((50, N_FIELDS))
+    for i in range(len(states)):
+        for _ in range(10):
+            model.step(controls, 0.002)
+        report = model.report(1.0, True, False)
+        state = AircraftState(states[i])
+        for key in state.keys():
+            if key in INDEX:
+                state[key] = float(report[key])
+    raw = ObservationBuilder(normalize=False).features(states)
+    body = field_slice("m-velocityBodyU-MPS", "m-velocityBodyW-MPS")
+    assert np.allclose(raw[:, feature_slice("velocity_body")],
+                       states[:, body])
+    angles = [INDEX["m-roll-DEG"], INDEX["m-inclination-DEG"],
+              INDEX["m-azimuth-DEG"]]
+    assert np.allclose(np.degrees(raw[:, feature_slice("euler")]),
+                       states[:, angles])
+
+    rng = np.random.default_rng(0)
+    print("{:>5} {:>12} {:>14}".format("N", "us/batch", "us/env"))
+    for n in (1, 4, 16, 64, 256, 1024):
+        batch = np.repeat(states[-1:], n, axis=0)
+        batch[:, QUATERNION] = rng.normal(size=(n, 4))
+        batch[:, QUATERNION] /= np.linalg.norm(batch[:, QUATERNION],
+                                               axis=1, keepdims=True)
+        builder = ObservationBuilder()
+        reps = max(20, 20000 // n)
+        t0 = time.perf_counter()
+        for _ in range(reps):
+            builder(batch)
+        dt = (time.perf_counter() - t0) / reps
+        print("{:>5} {:>12.1f} {:>14.3f}".format(n, dt * 1e6, dt / n * 1e6))
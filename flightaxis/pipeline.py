@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+""" Pipelined ExchangeData that overlaps policy compute with the round-trip
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from state import AircraftState
+
+
+class PipelinedConnector(object):
+    """Step a `FlightAxisConnector` with the round-trip off the caller's path.
+
+    In pipelined mode `step(a_k)` waits for the request carrying a_(k-1),
+    takes a snapshot of the state it produced, launches a_k on a
+    background I/O thread and returns the snapshot. The caller computes
+    a_(k+1) from that snapshot while a_k is in flight, so a step costs
+    max(RTT, policy) instead of RTT + policy.
+
+    The price is latency: every action is applied one step later than in
+    serial mode, and the state a policy sees is one round-trip older.
+    The overlap only materializes when the policy releases the GIL, as
+    NumPy and PyTorch kernels do; a pure-Python policy starves the I/O
+    thread.
+
+    With `pipelined=False`, `step` is a plain blocking `exchange_data`,
+    which makes A/B runs of both modes easy.
+    """
+
+    def __init__(self, connector, pipelined: bool = True):
+        self.connector = connector
+        self.pipelined = pipelined
+        self.state = AircraftState()
+        self._actions = np.zeros((2, len(connector.servos)))
+        self._slot = 0
+        self._future = None
+        self._executor = ThreadPoolExecutor(1) if pipelined else None
+        self.steps = 0
+        self.wait_s = 0.0  # caller time spent blocked on I/O
+        self.io_s = 0.0  # background time spent in exchange_data
+        self._t_start = None
+
+    @property
+    def rate_hz(self) -> float:
+        """Effective control rate since the first step.
+        """
+
+        if self._t_start is None or self.steps < 2:
+            return 0.0
+        return (self.steps - 1) / (time.perf_counter() - self._t_start)
+
+    def step(self, control_input) -> AircraftState:
+        """Send `control_input` and return the latest complete state.
+        """
+
+        if self._t_start is None:
+            self._t_start = time.perf_counter()
+        self.steps += 1
+        if not self.pipelined:
+            t0 = time.perf_counter()
+            self.connector.exchange_data(control_input)
+            self.wait_s += time.perf_counter() - t0
+            self._snapshot()
+            return self.state
+
+        self.flush()
+        self._snapshot()
+        action = self._actions[self._slot]
+        self._slot ^= 1
+        np.copyto(action, control_input)
+        self._future = self._executor.submit(self._exchange, action)
+        return self.state
+
+    def flush(self) -> None:
+        """Wait for the request in flight, if any.
+        """
+
+        if self._future is not None:
+            t0 = time.perf_counter()
+            future, self._future = self._future, None
+            future.result()
+            self.wait_s += time.perf_counter() - t0
+
+    def close(self) -> None:
+        self.flush()
+        if self._executor is not None:
+            self._executor.shutdown()
+
+    def _exchange(self, action: np.ndarray) -> None:
+        t0 = time.perf_counter()
+        self.connector.exchange_data(action)
+        self.io_s += time.perf_counter() - t0
+
+    def _snapshot(self) -> None:
+        # only called while no request is in flight
+        state = self.connector.state
+        np.copyto(self.state.values, state.values)
+        self.state.flags = state.flags
+        self.state.status = state.status
+
+
+if __name__ == "__main__":
+    import argparse
+    import multiprocessing
+
+    from connector import FlightAxisConnector
+    from emulator import FlightAxisEmulator
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--latency", type=float, default=2.0, help="ms")
+    ap.add_argument("--policy", type=float, default=1.5,
+                    help="policy compute time in ms")
+    ap.add_argument("--steps", type=int, default=500)
+    args = ap.parse_args()
+
+    # emulator in its own process, like RealFlight on another PC
+    emulator = FlightAxisEmulator(latency_s=args.latency / 1e3)
+    server = multiprocessing.Process(target=emulator.serve_forever,
+                                     daemon=True)
+    server.start()
+    hover = np.full(12, 0.5)
+
+    def policy(state):
+        # stand-in for a network forward pass, which releases the GIL
+        time.sleep(args.policy / 1e3)
+        return hover
+
+    for pipelined in (False, True):
+        connector = FlightAxisConnector(*emulator.address)
+        pipe = PipelinedConnector(connector, pipelined)
+        state = pipe.step(hover)
+        for _ in range(args.steps):
+            state = pipe.step(policy(state))
+        pipe.close()
+        print("{:>9}: {:6.1f} Hz, caller blocked {:5.1f}%".format(
+            "pipelined" if pipelined else "serial", pipe.rate_hz,
+            100 * pipe.wait_s / (pipe.steps / pipe.rate_hz)))
+        connector.transport.close()
+    server.terminate()
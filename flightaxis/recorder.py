@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+""" Columnar memory-mapped trajectory recorder for FlightAxis sessions
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import json
+import os
+import threading
+import time
+
+import numpy as np
+
+from state import FIELDS, N_FIELDS
+
+COLUMNS = (  # (name, dtype, row shape)
+    ("t", np.float64, ()),  # time.time() when the reply was parsed
+    ("step_s", np.float32, ()),  # ExchangeData round-trip
+    ("servos", np.float64, (12,)),
+    ("state", np.float64, (N_FIELDS,)),
+    ("flags", np.uint8, ()),
+    ("status", np.uint8, ()),
+)
+META = "meta.json"
+
+
+class RingBuffer(object):
+    """Single-producer single-consumer ring of preallocated columns.
+
+    The producer only advances `head` and the consumer only advances
+    `tail`, so neither side takes a lock. A full ring drops the new row
+    rather than blocking the producer.
+    """
+
+    def __init__(self, capacity: int = 65536, columns=COLUMNS):
+        self.capacity = capacity
+        self.arrays = {name: np.zeros((capacity,) + shape, dtype=dtype)
+                       for name, dtype, shape in columns}
+        self.head = 0  # rows written
+        self.tail = 0  # rows consumed
+        self.dropped = 0
+
+    def __len__(self):
+        return self.head - self.tail
+
+    def reserve(self) -> int:
+        """Return slot index for the next row, or -1 when full.
+        """
+
+        if self.head - self.tail >= self.capacity:
+            self.dropped += 1
+            return -1
+        return self.head % self.capacity
+
+    def commit(self) -> None:
+        self.head += 1
+
+    def segment(self) -> tuple:
+        """Return (start, stop) of the oldest contiguous run of rows.
+        """
+
+        n = self.head - self.tail
+        start = self.tail % self.capacity
+        return start, min(self.capacity, start + n)
+
+
+class TrajectoryWriter(object):
+    """Append rows to per-column files grown in chunks of `chunk_rows`.
+
+    A trajectory is a directory with one raw binary file per column and
+    a meta.json with dtype, row shape and row count of every column.
+    """
+
+    def __init__(self, path: str, chunk_rows: int = 1 << 16,
+                 columns=COLUMNS):
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.chunk_rows = chunk_rows
+        self.columns = columns
+        self.rows = 0
+        self.capacity = 0
+        self._files = {name: open(os.path.join(path, name + ".bin"), "w+b")
+                       for name, _, _ in columns}
+        self._maps = {}
+        self._grow(chunk_rows)
+
+    def _grow(self, capacity: int) -> None:
+        self._maps.clear()
+        for name, dtype, shape in self.columns:
+            f = self._files[name]
+            row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+            f.truncate(capacity * row_bytes)
+            self._maps[name] = np.memmap(f, dtype=dtype, mode="r+",
+                                         shape=(capacity,) + shape)
+        self.capacity = capacity
+
+    def append(self, arrays: dict, start: int, stop: int) -> None:
+        """Append rows `start:stop` of every column in `arrays`.
+        """
+
+        n = stop - start
+        if self.rows + n > self.capacity:
+            self.flush()
+            chunks = -(-(self.rows + n) // self.chunk_rows)
+            self._grow(chunks * self.chunk_rows)
+        for name, _, _ in self.columns:
+            self._maps[name][self.rows:self.rows + n] = \
+                arrays[name][start:stop]
+        self.rows += n
+
+    def flush(self) -> None:
+        for m in self._maps.values():
+            m.flush()
+        meta = {name: {"dtype": np.dtype(dtype).str, "shape": list(shape)}
+                for name, dtype, shape in self.columns}
+        with open(os.path.join(self.path, META), "w") as f:
+            json.dump({"rows": self.rows, "columns": meta,
+                       "fields": [name for name, _ in FIELDS]}, f)
+
+    def close(self) -> None:
+        self.flush()
+        self._maps.clear()
+        for name, dtype, shape in self.columns:
+            row_bytes = np.dtype(dtype).itemsize * int(np.prod(shape))
+            self._files[name].truncate(self.rows * row_bytes)
+            self._files[name].close()
+
+
+class TrajectoryRecorder(object):
+    """Record every ExchangeData of a connector without blocking it.
+
+    `record` copies one row into a lock-free ring; a background thread
+    drains the ring into a `TrajectoryWriter`. Set as
+    `connector.recorder` to hook it into `exchange_data`.
+    """
+
+    def __init__(self, path: str, capacity: int = 65536,
+                 chunk_rows: int = 1 << 16, poll_s: float = 0.005):
+        self.ring = RingBuffer(capacity)
+        self.writer = TrajectoryWriter(path, chunk_rows)
+        self.poll_s = poll_s
+        self._running = True
+        self._thread = threading.Thread(target=self._drain, daemon=True)
+        self._thread.start()
+
+    @property
+    def dropped(self) -> int:
+        return self.ring.dropped
+
+    def record(self, servos: np.ndarray, state, step_s: float = 0.0) -> None:
+        ring = self.ring
+        i = ring.reserve()
+        if i < 0:
+            return
+        arrays = ring.arrays
+        arrays["t"][i] = time.time()
+        arrays["step_s"][i] = step_s
+        arrays["servos"][i] = servos
+        arrays["state"][i] = state.values
+        arrays["flags"][i] = state.flags
+        arrays["status"][i] = state.status
+        ring.commit()
+
+    def _drain(self) -> None:
+        ring = self.ring
+        while True:
+            running = self._running
+            while len(ring):
+                start, stop = ring.segment()
+                self.writer.append(ring.arrays, start, stop)
+                ring.tail += stop - start
+            if not running:
+                break
+            time.sleep(self.poll_s)
+
+    def close(self) -> None:
+        self._running = False
+        self._thread.join()
+        self.writer.close()
+
+
+class TrajectoryReader(object):
+    """Read-only zero-copy column views of a recorded trajectory.
+    """
+
+    def __init__(self, path: str):
+        with open(os.path.join(path, META)) as f:
+            meta = json.load(f)
+        self.rows = meta["rows"]
+        self.fields = meta["fields"]
+        self.columns = {}
+        for name, column in meta["columns"].items():
+            shape = (self.rows,) + tuple(column["shape"])
+            filename = os.path.join(path, name + ".bin")
+            if self.rows:
+                self.columns[name] = np.memmap(filename, dtype=column["dtype"],
+                                               mode="r", shape=shape)
+            else:
+                self.columns[name] = np.zeros(shape, dtype=column["dtype"])
+
+    def __len__(self):
+        return self.rows
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        return self.columns[name]
+
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+
+    from state import AircraftState
+
+    rows = 1000000
+    state = AircraftState()
+    servos = np.full(12, 0.5)
+    path = tempfile.mkdtemp()
+    recorder = TrajectoryRecorder(path)
+    t0 = time.perf_counter()
+    for i in range(rows):
+        state.values[0] = i
+        recorder.record(servos, state)
+    dt = time.perf_counter() - t0
+    recorder.close()
+    print("{} rows in {:.2f}s, {:.2f} us/row, dropped {}".format(
+        rows, dt, dt / rows * 1e6, recorder.dropped))
+
+    reader = TrajectoryReader(path)
+    physics_time = reader["state"][:, 0]
+    assert len(reader) + recorder.dropped == rows
+    assert np.all(np.diff(physics_time) > 0)
+    print("read back {} rows".format(len(reader)))
+    shutil.rmtree(path)
@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+""" Prioritized experience replay for hover-trainer transitions
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import os
+
+import numpy as np
+
+from state import N_FIELDS
+
+
+class SumTree(object):
+    """Binary sum tree over `capacity` priorities in one flat array.
+
+    Node i has children 2i and 2i+1; the root is node 1 and the leaves
+    start at `size`, the next power of two. Updates and sampling work on
+    whole batches and walk the tree level by level with NumPy, so a
+    batch costs O(log n) vector operations.
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.size = 1 << max(0, (capacity - 1).bit_length())
+        self.depth = self.size.bit_length() - 1
+        self.tree = np.zeros(2 * self.size, dtype=np.float64)
+
+    @property
+    def total(self) -> float:
+        return float(self.tree[1])
+
+    def __getitem__(self, index):
+        return self.tree[np.asarray(index) + self.size]
+
+    def update(self, index: np.ndarray, priority: np.ndarray) -> None:
+        """Set leaves `index` to `priority` and refresh their ancestors.
+
+        With duplicate indices the last priority wins.
+        """
+
+        node = np.asarray(index, dtype=np.int64) + self.size
+        self.tree[node] = priority
+        for _ in range(self.depth):
+            node = np.unique(node >> 1)
+            self.tree[node] = self.tree[2 * node] + self.tree[2 * node + 1]
+
+    def find(self, value: np.ndarray) -> np.ndarray:
+        """Return leaf index of every prefix-sum `value` in [0, total).
+        """
+
+        value = np.array(value, dtype=np.float64)
+        node = np.ones(len(value), dtype=np.int64)
+        tree = self.tree
+        for _ in range(self.depth):
+            left = 2 * node
+            left_sum = tree[left]
+            right = value >= left_sum
+            value -= left_sum * right
+            node = left + right
+        return np.minimum(node - self.size, self.capacity - 1)
+
+
+def _allocate(path: str, name: str, shape: tuple, dtype) -> np.ndarray:
+    if path is None:
+        return np.zeros(shape, dtype=dtype)
+    return np.lib.format.open_memmap(os.path.join(path, name + ".npy"),
+                                     mode="w+", dtype=dtype, shape=shape)
+
+
+class PrioritizedReplayBuffer(object):
+    """Ring buffer of transitions sampled in proportion to priority^alpha.
+
+    Transitions are stored as structure-of-arrays in preallocated
+    float32 buffers: obs, action, reward, next_obs and done. With `path`
+    the buffers are .npy memory maps in that directory, so buffers
+    larger than RAM spill to disk and survive the process.
+
+    Importance weights are (N P(i))^-beta normalized by the largest
+    weight in the batch.
+    """
+
+    def __init__(self, capacity: int, obs_dim: int = N_FIELDS,
+                 act_dim: int = 12, alpha: float = 0.6, beta: float = 0.4,
+                 eps: float = 1e-6, path: str = None, seed: int = None):
+        if path is not None:
+            os.makedirs(path, exist_ok=True)
+        self.capacity = capacity
+        self.alpha = alpha
+        self.beta = beta
+        self.eps = eps
+        self.obs = _allocate(path, "obs", (capacity, obs_dim), np.float32)
+        self.action = _allocate(path, "action", (capacity, act_dim),
+                                np.float32)
+        self.reward = _allocate(path, "reward", (capacity,), np.float32)
+        self.next_obs = _allocate(path, "next_obs", (capacity, obs_dim),
+                                  np.float32)
+        self.done = _allocate(path, "done", (capacity,), np.bool_)
+        self.tree = SumTree(capacity)
+        self.max_priority = 1.0
+        self.cursor = 0
+        self.count = 0
+        self._rng = np.random.default_rng(seed)
+
+    def __len__(self):
+        return self.count
+
+    def add(self, obs, action, reward, next_obs, done) -> np.ndarray:
+        """Insert a batch of B transitions and return their indices.
+
+        New transitions get the largest priority seen so far, so each is
+        sampled at least once soon.
+        """
+
+        reward = np.atleast_1d(reward)
+        n = len(reward)
+        index = (self.cursor + np.arange(n)) % self.capacity
+        self.obs[index] = obs
+        self.action[index] = action
+        self.reward[index] = reward
+        self.next_obs[index] = next_obs
+        self.done[index] = done
+        self.tree.update(index, np.full(n, self.max_priority ** self.alpha))
+        self.cursor = (self.cursor + n) % self.capacity
+        self.count = min(self.count + n, self.capacity)
+        return index
+
+    def sample(self, batch_size: int, beta: float = None) -> dict:
+        """Draw a stratified batch in proportion to priority.
+
+        Returns:
+            Dict of obs, action, reward, next_obs, done, plus `index` for
+            `update_priorities` and importance `weight`.
+        """
+
+        if beta is None:
+            beta = self.beta
+        total = self.tree.total
+        segment = total / batch_size
+        value = (np.arange(batch_size) + self._rng.random(batch_size)) \
+            * segment
+        index = self.tree.find(value)
+        p = self.tree[index] / total
+        weight = (self.count * p) ** -beta
+        weight /= weight.max()
+        return {
+            "obs": self.obs[index],
+            "action": self.action[index],
+            "reward": self.reward[index],
+            "next_obs": self.next_obs[index],
+            "done": self.done[index],
+            "index": index,
+            "weight": weight.astype(np.float32),
+        }
+
+    def update_priorities(self, index: np.ndarray,
+                          priority: np.ndarray) -> None:
+        """Set new priorities, e.g. |TD error|, of sampled transitions.
+        """
+
+        priority = np.abs(priority) + self.eps
+        self.max_priority = max(self.max_priority, float(priority.max()))
+        self.tree.update(index, priority ** self.alpha)
+
+    def flush(self) -> None:
+        for array in (self.obs, self.action, self.reward, self.next_obs,
+                      self.done):
+            if isinstance(array, np.memmap):
+                array.flush()
+
+
+if __name__ == "__main__":
+    import argparse
+    import time
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--capacity", type=int, default=1000000)
+    ap.add_argument("--path", type=str, default=None,
+                    help="directory for mmap-backed buffers")
+    args = ap.parse_args()
+
+    # exact proportional sampling on a small tree
+    tree = SumTree(5)
+    tree.update(np.arange(5), np.array([1.0, 0.0, 3.0, 0.0, 6.0]))
+    counts = np.bincount(tree.find(np.random.random(100000) * tree.total),
+                         minlength=5)
+    assert counts[1] == counts[3] == 0
+    assert np.allclose(counts / counts.sum(), [0.1, 0, 0.3, 0, 0.6],
+                       atol=0.01)
+
+    buffer = PrioritizedReplayBuffer(args.capacity, path=args.path, seed=0)
+    rng = np.random.default_rng(0)
+    insert = 1024
+    obs = rng.random((insert, N_FIELDS), dtype=np.float32)
+    action = rng.random((insert, 12), dtype=np.float32)
+    reward = rng.random(insert, dtype=np.float32)
+    done = np.zeros(insert, dtype=bool)
+
+    t0 = time.perf_counter()
+    while len(buffer) < args.capacity:
+        buffer.add(obs, action, reward, obs, done)
+    dt = time.perf_counter() - t0
+    print("insert: {:.0f} transitions/s in batches of {}".format(
+        args.capacity / dt, insert))
+
+    for batch_size in (64, 256, 1024, 4096):
+        n = 200
+        t0 = time.perf_counter()
+        for _ in range(n):
+            batch = buffer.sample(batch_size)
+            buffer.update_priorities(batch["index"],
+                                     rng.random(batch_size))
+        dt = (time.perf_counter() - t0) / n
+        print("sample+update {:>5}: {:.3f} ms/batch, {:.0f} transitions/s"
+              .format(batch_size, dt * 1e3, batch_size / dt))
+    buffer.flush()
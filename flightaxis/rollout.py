@@ -0,0 +1,276 @@
+#!/usr/bin/env python3
+""" Multi-process hover rollouts exchanging data through shared memory
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import multiprocessing
+import queue
+import time
+import traceback
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from env import OBS_DIM, HoverEnv
+
+RUN, STOP = 0, 1
+
+
+class WorkerError(RuntimeError):
+    """A rollout worker failed or died."""
+
+
+def _layout(num_envs: int, horizon: int) -> tuple:
+    # (name, dtype, shape); obs has one extra row for bootstrapping
+    return (
+        ("obs", np.float64, (horizon + 1, num_envs, OBS_DIM)),
+        ("action", np.float64, (horizon, num_envs, 12)),
+        ("reward", np.float64, (horizon, num_envs)),
+        ("done", np.bool_, (horizon, num_envs)),
+        ("command", np.int64, (1,)),
+        ("failed", np.bool_, (num_envs,)),
+    )
+
+
+class RolloutBuffer(object):
+    """(horizon, N, ...) rollout columns laid out in one shared memory block.
+
+    Worker i only writes column i of obs, reward, done and failed; the
+    coordinator only writes action and command. Who may touch which row
+    is decided by the semaphores of `RolloutWorkers`, so the arrays
+    themselves need no locks.
+    """
+
+    def __init__(self, num_envs: int, horizon: int, name: str = None):
+        self.num_envs = num_envs
+        self.horizon = horizon
+        layout = _layout(num_envs, horizon)
+        size = sum(np.dtype(dtype).itemsize * int(np.prod(shape))
+                   for _, dtype, shape in layout)
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=size)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.arrays = {}
+        offset = 0
+        for column, dtype, shape in layout:
+            array = np.ndarray(shape, dtype=dtype, buffer=self.shm.buf,
+                               offset=offset)
+            offset += array.nbytes
+            self.arrays[column] = array
+
+    @property
+    def name(self) -> str:
+        return self.shm.name
+
+    def __getitem__(self, column: str) -> np.ndarray:
+        return self.arrays[column]
+
+    def close(self) -> None:
+        self.arrays.clear()
+        self.shm.close()
+
+    def unlink(self) -> None:
+        self.shm.unlink()
+
+
+def _worker(i: int, endpoint: tuple, name: str, num_envs: int, horizon: int,
+            target_altitude: float, max_steps: int, action_ready,
+            obs_ready, errors) -> None:
+    buffer = RolloutBuffer(num_envs, horizon, name)
+    obs, action = buffer["obs"], buffer["action"]
+    reward, done = buffer["reward"], buffer["done"]
+    command = buffer["command"]
+    env = None
+    slot = 0
+    try:
+        env = HoverEnv(*endpoint, target_altitude=target_altitude,
+                       max_steps=max_steps)
+        obs[0, i] = env.reset()
+        obs_ready.release()
+        while True:
+            action_ready.acquire()
+            if command[0] == STOP:
+                break
+            next_obs, r, d, _ = env.step(action[slot, i])
+            if d:
+                next_obs = env.reset()
+            reward[slot, i] = r
+            done[slot, i] = d
+            slot += 1
+            obs[slot, i] = next_obs
+            if slot == horizon:
+                slot = 0
+            obs_ready.release()
+    except Exception:
+        # report instead of leaving the coordinator waiting for this step
+        errors.put((i, traceback.format_exc()))
+        buffer["failed"][i] = True
+        obs_ready.release()
+    finally:
+        if env is not None:
+            env.close()
+        buffer.close()
+
+
+class RolloutWorkers(object):
+    """Step one `HoverEnv` per worker process in lockstep.
+
+    Each worker owns a `FlightAxisConnector`, so round-trips, XML
+    parsing and rewards run on separate cores instead of serializing on
+    the coordinator's GIL. Observations, actions, rewards and dones live
+    in a shared `RolloutBuffer` ring of `horizon` steps; nothing is
+    pickled per step. The coordinator evaluates the policy once per step
+    on the stacked (N, OBS_DIM) observations.
+
+    Per step, every worker waits on its own `action_ready` semaphore,
+    steps, writes its column of the next row and releases the shared
+    `obs_ready` semaphore, which the coordinator acquires N times.
+    Finished episodes are reset inside the worker; `done` marks them and
+    the next observation is already the one after the reset.
+
+    A worker that raises sets its `failed` flag, sends its traceback and
+    still releases `obs_ready`; one that dies without doing so is found
+    by polling every `timeout` seconds. Either way the coordinator raises
+    `WorkerError` instead of waiting forever.
+    """
+
+    def __init__(self, endpoints, horizon: int = 128,
+                 target_altitude: float = 2.0, max_steps: int = 1000,
+                 timeout: float = 1.0):
+        self.num_envs = len(endpoints)
+        self.horizon = horizon
+        self.buffer = RolloutBuffer(self.num_envs, horizon)
+        self.buffer["command"][0] = RUN
+        self.steps = 0
+        self.timeout = timeout
+        self._errors = multiprocessing.Queue()
+        self._obs_ready = multiprocessing.Semaphore(0)
+        self._action_ready = [multiprocessing.Semaphore(0)
+                              for _ in endpoints]
+        self._workers = [
+            multiprocessing.Process(
+                target=_worker, daemon=True,
+                args=(i, endpoint, self.buffer.name, self.num_envs, horizon,
+                      target_altitude, max_steps, self._action_ready[i],
+                      self._obs_ready, self._errors))
+            for i, endpoint in enumerate(endpoints)]
+        for worker in self._workers:
+            worker.start()
+        try:
+            self._wait()
+        except WorkerError:
+            self.close()
+            raise
+
+    def _wait(self) -> None:
+        for _ in range(self.num_envs):
+            while not self._obs_ready.acquire(timeout=self.timeout):
+                dead = [i for i, worker in enumerate(self._workers)
+                        if not worker.is_alive()]
+                if dead:
+                    self._raise("workers {} exited".format(dead))
+        if self.buffer["failed"].any():
+            self._raise("workers {} failed".format(
+                np.flatnonzero(self.buffer["failed"]).tolist()))
+
+    def _raise(self, message: str) -> None:
+        reports = []
+        while True:
+            try:
+                i, report = self._errors.get(timeout=0.1)
+            except queue.Empty:
+                break
+            reports.append("worker {}:\n{}".format(i, report))
+        raise WorkerError("\n".join([message] + reports))
+
+    def rollout(self, policy) -> dict:
+        """Collect `horizon` steps of every environment.
+
+        `policy` maps an (N, OBS_DIM) observation batch to (N, 12)
+        actions. The returned arrays are views of shared memory that the
+        next `rollout` overwrites: obs is (horizon + 1, N, OBS_DIM),
+        action (horizon, N, 12), reward and done (horizon, N).
+        """
+
+        buffer = self.buffer
+        obs, action = buffer["obs"], buffer["action"]
+        if self.steps:
+            obs[0] = obs[-1]
+        for t in range(self.horizon):
+            action[t] = policy(obs[t])
+            for ready in self._action_ready:
+                ready.release()
+            self._wait()
+        self.steps += self.horizon
+        return {column: buffer[column]
+                for column in ("obs", "action", "reward", "done")}
+
+    def close(self) -> None:
+        self.buffer["command"][0] = STOP
+        for ready in self._action_ready:
+            ready.release()
+        for worker in self._workers:
+            worker.join()
+        self._errors.close()
+        self.buffer.close()
+        self.buffer.unlink()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from emulator import FlightAxisEmulator
+    from env import VectorHoverEnv
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--envs", type=int, nargs="+", default=[1, 2, 4, 8])
+    ap.add_argument("--horizon", type=int, default=256)
+    args = ap.parse_args()
+    print("{} cores".format(multiprocessing.cpu_count()))
+
+    def policy(obs):
+        return np.full((len(obs), 12), 0.5)
+
+    for n in args.envs:
+        emulators = [FlightAxisEmulator(physics_dt=0.01) for _ in range(n)]
+        servers = [multiprocessing.Process(target=e.serve_forever,
+                                           daemon=True) for e in emulators]
+        for server in servers:
+            server.start()
+        endpoints = [e.address for e in emulators]
+
+        env = VectorHoverEnv(endpoints)
+        obs = env.reset()
+        t0 = time.perf_counter()
+        for _ in range(args.horizon):
+            obs, _, _, _ = env.step(policy(obs))
+        threaded = n * args.horizon / (time.perf_counter() - t0)
+        env.close()
+
+        workers = RolloutWorkers(endpoints, args.horizon)
+        workers.rollout(policy)
+        t0 = time.perf_counter()
+        batch = workers.rollout(policy)
+        processes = n * args.horizon / (time.perf_counter() - t0)
+        assert np.isfinite(batch["reward"]).all()
+        workers.close()
+        print("{:>3} envs: threads {:7.0f} steps/s, processes {:7.0f} "
+              "steps/s".format(n, threaded, processes))
+
+        for server in servers:
+            server.terminate()
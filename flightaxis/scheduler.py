@@ -0,0 +1,213 @@
+#!/usr/bin/env python3
+""" Fixed-rate real-time control loop around FlightAxisConnector
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import math
+import time
+
+import numpy as np
+
+from state import INDEX
+
+PHYSICS_TIME = INDEX["m-currentPhysicsTime-SEC"]
+SPEED_MULTIPLIER = INDEX["m-currentPhysicsSpeedMultiplier"]
+
+
+class Histogram(object):
+    """Fixed-size histogram of durations with linear bins.
+
+    Values beyond the last bin are counted in it.
+    """
+
+    def __init__(self, max_s: float = 0.02, bins: int = 400):
+        self.bin_s = max_s / bins
+        self.counts = np.zeros(bins, dtype=np.int64)
+
+    def record(self, dt: float) -> None:
+        i = int(dt / self.bin_s)
+        if i < 0:
+            i = 0
+        elif i >= len(self.counts):
+            i = len(self.counts) - 1
+        self.counts[i] += 1
+
+    def percentile(self, q: float) -> float:
+        """Return upper edge of the bin holding the `q`-th percentile.
+        """
+
+        total = self.counts.sum()
+        if not total:
+            return 0.0
+        i = int(np.searchsorted(np.cumsum(self.counts), total * q / 100.0))
+        return (i + 1) * self.bin_s
+
+    def reset(self) -> None:
+        self.counts[:] = 0
+
+
+class LoopStats(object):
+    """Timing record of a `ControlLoop` run.
+
+    Jitter is how late each tick started after its deadline; skew is
+    physics time elapsed, divided by the speed multiplier, minus wall
+    time elapsed, so a negative skew means the simulator fell behind.
+    """
+
+    def __init__(self):
+        self.ticks = 0
+        self.misses = 0
+        self.skipped = 0
+        self.skew_violations = 0
+        self.jitter = Histogram(0.005, 500)
+        self.step_time = Histogram(0.05, 500)
+        self.skew_s = 0.0
+        self.min_skew_s = 0.0
+        self.max_skew_s = 0.0
+        self.wall_s = 0.0
+
+    def summary(self) -> dict:
+        return {
+            "ticks": self.ticks,
+            "rate_hz": self.ticks / self.wall_s if self.wall_s else 0.0,
+            "misses": self.misses,
+            "skipped": self.skipped,
+            "jitter_p50_ms": self.jitter.percentile(50) * 1e3,
+            "jitter_p99_ms": self.jitter.percentile(99) * 1e3,
+            "step_p50_ms": self.step_time.percentile(50) * 1e3,
+            "step_p99_ms": self.step_time.percentile(99) * 1e3,
+            "skew_ms": self.skew_s * 1e3,
+            "min_skew_ms": self.min_skew_s * 1e3,
+            "max_skew_ms": self.max_skew_s * 1e3,
+            "skew_violations": self.skew_violations,
+        }
+
+
+class ControlLoop(object):
+    """Run policy -> ExchangeData -> parse at a fixed rate.
+
+    Deadlines are laid out on an absolute monotonic grid, so sleep error
+    never accumulates. The loop sleeps until `busy_wait` before the
+    deadline and spins for the rest. A tick that overruns its period
+    counts as a miss; the loop then resumes at the next free slot instead
+    of bursting to catch up.
+
+    Args:
+        connector: `FlightAxisConnector` to step.
+        policy: Callable mapping the connector's `AircraftState` to the
+            12 channel control input.
+        rate_hz: Target control rate.
+        busy_wait: Seconds before each deadline spent spinning instead
+            of sleeping; 0 disables spinning.
+        max_skew: Bound on |skew| in seconds. Ticks beyond it are counted
+            and passed to `on_skew`.
+        on_skew: Called with the skew in seconds when it exceeds
+            `max_skew`.
+    """
+
+    def __init__(self, connector, policy, rate_hz: float = 100.0,
+                 busy_wait: float = 0.0005, max_skew: float = None,
+                 on_skew=None):
+        self.connector = connector
+        self.policy = policy
+        self.period = 1.0 / rate_hz
+        self.busy_wait = busy_wait
+        self.max_skew = max_skew
+        self.on_skew = on_skew
+        self.stats = LoopStats()
+
+    def wait_until(self, deadline: float) -> None:
+        remaining = deadline - time.perf_counter()
+        if remaining > self.busy_wait:
+            time.sleep(remaining - self.busy_wait)
+        while time.perf_counter() < deadline:
+            pass
+
+    def run(self, steps: int = None, duration: float = None) -> LoopStats:
+        """Run for `steps` ticks or `duration` seconds, whichever first.
+        """
+
+        connector = self.connector
+        values = connector.state.values
+        stats = self.stats
+        period = self.period
+
+        t_start = time.perf_counter()
+        physics_start = None
+        deadline = t_start
+        tick = 0
+        while ((steps is None or tick < steps)
+               and (duration is None
+                    or time.perf_counter() - t_start < duration)):
+            self.wait_until(deadline)
+            t0 = time.perf_counter()
+            stats.jitter.record(t0 - deadline)
+
+            connector.exchange_data(self.policy(connector.state))
+
+            t1 = time.perf_counter()
+            stats.step_time.record(t1 - t0)
+            stats.ticks += 1
+            tick += 1
+
+            physics = values[PHYSICS_TIME]
+            if physics_start is None:
+                physics_start, wall_start = physics, t1
+            else:
+                speed = values[SPEED_MULTIPLIER] or 1.0
+                skew = (physics - physics_start) / speed - (t1 - wall_start)
+                stats.skew_s = skew
+                stats.min_skew_s = min(stats.min_skew_s, skew)
+                stats.max_skew_s = max(stats.max_skew_s, skew)
+                if self.max_skew is not None and abs(skew) > self.max_skew:
+                    stats.skew_violations += 1
+                    if self.on_skew is not None:
+                        self.on_skew(skew)
+
+            deadline += period
+            if t1 > deadline:
+                stats.misses += 1
+                skip = math.ceil((t1 - deadline) / period)
+                stats.skipped += skip
+                deadline += skip * period
+        stats.wall_s += time.perf_counter() - t_start
+        return stats
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from connector import FlightAxisConnector
+    from emulator import FlightAxisEmulator
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--rate", type=float, default=200.0)
+    ap.add_argument("--duration", type=float, default=3.0)
+    ap.add_argument("--latency", type=float, default=1.0, help="ms")
+    ap.add_argument("--jitter", type=float, default=1.0, help="ms")
+    ap.add_argument("--busy-wait", type=float, default=0.5, help="ms")
+    args = ap.parse_args()
+
+    emulator = FlightAxisEmulator(latency_s=args.latency / 1e3,
+                                  jitter_s=args.jitter / 1e3).start()
+    connector = FlightAxisConnector(*emulator.address)
+    hover = np.full(12, 0.5)
+    loop = ControlLoop(connector, lambda state: hover, args.rate,
+                       args.busy_wait / 1e3, max_skew=0.05)
+    for key, value in loop.run(duration=args.duration).summary().items():
+        print("{:>16}: {}".format(key, round(value, 3)))
+    emulator.stop()
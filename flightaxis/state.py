@@ -0,0 +1,181 @@
+#!/usr/bin/env python3
+""" Array-backed aircraft state for FlightAxis Link
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import enum
+
+import numpy as np
+
+FIELDS = (  # (name, default), in the order FlightAxis Link reports them
+    ("m-currentPhysicsTime-SEC", 0.0),
+    ("m-currentPhysicsSpeedMultiplier", 1.0),
+    ("m-airspeed-MPS", 0.0),
+    ("m-altitudeASL-MTR", 0.0),
+    ("m-altitudeAGL-MTR", 0.0),
+    ("m-groundspeed-MPS", 0.0),
+    ("m-pitchRate-DEGpSEC", 0.0),
+    ("m-rollRate-DEGpSEC", 0.0),
+    ("m-yawRate-DEGpSEC", 0.0),
+    ("m-azimuth-DEG", 0.0),
+    ("m-inclination-DEG", 0.0),
+    ("m-roll-DEG", 0.0),
+    ("m-orientationQuaternion-X", 0.0),
+    ("m-orientationQuaternion-Y", 0.0),
+    ("m-orientationQuaternion-Z", 0.0),
+    ("m-orientationQuaternion-W", 0.0),
+    ("m-aircraftPositionX-MTR", 0.0),
+    ("m-aircraftPositionY-MTR", 0.0),
+    ("m-velocityWorldU-MPS", 0.0),
+    ("m-velocityWorldV-MPS", 0.0),
+    ("m-velocityWorldW-MPS", 0.0),
+    ("m-velocityBodyU-MPS", 0.0),
+    ("m-velocityBodyV-MPS", 0.0),
+    ("m-velocityBodyW-MPS", 0.0),
+    ("m-accelerationWorldAX-MPS2", 0.0),
+    ("m-accelerationWorldAY-MPS2", 0.0),
+    ("m-accelerationWorldAZ-MPS2", 0.0),
+    ("m-accelerationBodyAX-MPS2", 0.0),
+    ("m-accelerationBodyAY-MPS2", 0.0),
+    ("m-accelerationBodyAZ-MPS2", 0.0),
+    ("m-windX-MPS", 0.0),
+    ("m-windY-MPS", 0.0),
+    ("m-windZ-MPS", 0.0),
+    ("m-propRPM", 0.0),
+    ("m-heliMainRotorRPM", -1.0),
+    ("m-batteryVoltage-VOLTS", -1.0),
+    ("m-batteryCurrentDraw-AMPS", -1.0),
+    ("m-batteryRemainingCapacity-MAH", -1.0),
+    ("m-fuelRemaining-OZ", 0.0),
+)
+
+INDEX = {name: i for i, (name, _) in enumerate(FIELDS)}
+DEFAULTS = np.array([default for _, default in FIELDS], dtype=np.float64)
+N_FIELDS = len(FIELDS)
+
+
+class Flag(enum.IntFlag):
+    IS_LOCKED = 1
+    HAS_LOST_COMPONENTS = 2
+    AN_ENGINE_IS_RUNNING = 4
+    IS_TOUCHING_GROUND = 8
+    FLIGHT_AXIS_CONTROLLER_IS_ACTIVE = 16
+    RESET_BUTTON_HAS_BEEN_PRESSED = 32
+
+
+FLAGS = {
+    "m-isLocked": Flag.IS_LOCKED,
+    "m-hasLostComponents": Flag.HAS_LOST_COMPONENTS,
+    "m-anEngineIsRunning": Flag.AN_ENGINE_IS_RUNNING,
+    "m-isTouchingGround": Flag.IS_TOUCHING_GROUND,
+    "m-flightAxisControllerIsActive": Flag.FLIGHT_AXIS_CONTROLLER_IS_ACTIVE,
+    "m-resetButtonHasBeenPressed": Flag.RESET_BUTTON_HAS_BEEN_PRESSED,
+}
+DEFAULT_FLAGS = int(Flag.AN_ENGINE_IS_RUNNING | Flag.IS_TOUCHING_GROUND)
+
+
+class AircraftStatus(enum.IntEnum):
+    UNKNOWN = 0
+    FLYING = 1
+    CRASHED = 2
+
+
+STATUS_KEY = "m-currentAircraftStatus"
+STATUS = {
+    "CAS-FLYING": AircraftStatus.FLYING,
+    "CAS-CRASHED": AircraftStatus.CRASHED,
+}
+STATUS_NAME = {status: name for name, status in STATUS.items()}
+
+
+def field_slice(first: str, last: str) -> slice:
+    """Return slice covering fields `first` through `last`.
+    """
+
+    return slice(INDEX[first], INDEX[last] + 1)
+
+
+class AircraftState(object):
+    """Aircraft state reported by FlightAxis Link.
+
+    Numeric fields live in one float64 array laid out as `FIELDS`, the
+    boolean fields are packed into the `flags` bitfield and
+    `m-currentAircraftStatus` is kept as an `AircraftStatus`. Observation
+    slices are views into `values`, so nothing is copied per step.
+
+    `values` may be supplied by the caller, e.g. a row of an (N, N_FIELDS)
+    batch, to have the parser write straight into it.
+    """
+
+    __slots__ = ("values", "flags", "status")
+
+    def __init__(self, values: np.ndarray = None):
+        if values is None:
+            values = DEFAULTS.copy()
+        else:
+            if values.shape != (N_FIELDS,) or values.dtype != np.float64:
+                raise ValueError("values must be a float64 array of shape "
+                                 "({},)".format(N_FIELDS))
+            values[:] = DEFAULTS
+        self.values = values
+        self.flags = DEFAULT_FLAGS
+        self.status = AircraftStatus.FLYING
+
+    def view(self, first: str, last: str) -> np.ndarray:
+        """Return view of fields `first` through `last`.
+        """
+
+        return self.values[field_slice(first, last)]
+
+    def __getitem__(self, key: str):
+        i = INDEX.get(key)
+        if i is not None:
+            return float(self.values[i])
+        elif key in FLAGS:
+            return bool(self.flags & FLAGS[key])
+        elif key == STATUS_KEY:
+            return STATUS_NAME.get(self.status, "")
+        raise KeyError(key)
+
+    def __setitem__(self, key: str, value) -> None:
+        i = INDEX.get(key)
+        if i is not None:
+            self.values[i] = value
+        elif key in FLAGS:
+            # a plain int, IntFlag arithmetic is slow
+            if value:
+                self.flags |= int(FLAGS[key])
+            else:
+                self.flags &= ~int(FLAGS[key])
+        elif key == STATUS_KEY:
+            self.status = STATUS.get(value, AircraftStatus.UNKNOWN)
+        else:
+            raise KeyError(key)
+
+    def __contains__(self, key: str) -> bool:
+        return key in INDEX or key in FLAGS or key == STATUS_KEY
+
+    def keys(self):
+        return [name for name, _ in FIELDS] + list(FLAGS) + [STATUS_KEY]
+
+    def as_dict(self) -> dict:
+        return {key: self[key] for key in self.keys()}
+
+    def reset(self) -> None:
+        self.values[:] = DEFAULTS
+        self.flags = DEFAULT_FLAGS
+        self.status = AircraftStatus.FLYING
@@ -0,0 +1,306 @@
+#!/usr/bin/env python3
+""" Schema-compiled parser for FlightAxis Link ExchangeData replies
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import operator
+import re
+
+from state import FLAGS, INDEX, STATUS, STATUS_KEY, AircraftStatus
+
+# <m-key>value</m-key>; elements with attributes or children never match
+_ELEMENT = re.compile(rb"<(m-[A-Za-z0-9-]+)>([^<]*)</")
+# any text and tags, as few as needed to reach what follows
+_SKIP = rb"[^<]*(?:<[^>]*>[^<]*)*?"
+_TRUE = b"true"
+
+_FLOAT, _FLAG, _STATUS = range(3)  # kinds of state slots
+
+
+def decode_bool(value: bytes) -> bool:
+    return value == _TRUE
+
+
+def decode_str(value: bytes) -> str:
+    return value.decode("utf_8")
+
+
+def _getter(groups: list):
+    """Return function mapping a match to the tuple of `groups`.
+    """
+
+    if len(groups) == 1:
+        group = groups[0]
+        return lambda m: (m.group(group),)
+    return operator.methodcaller("group", *groups)
+
+
+def decoder_for(default):
+    """Return value decoder matching the type of `default`.
+    """
+
+    if isinstance(default, bool):
+        return decode_bool
+    elif isinstance(default, (int, float)):
+        return float
+    else:
+        return decode_str
+
+
+class StateParser(object):
+    """Single-pass parser for the `m-*` elements of a reply.
+
+    Every known key is bound to its slot in `AircraftState` when the
+    parser is built: a float index, a flag bit or the aircraft status.
+    Values are decoded by that kind and never type-sniffed at parse
+    time. Unknown elements such as `m-selectedChannels` are skipped.
+
+    FlightAxis Link always emits the same elements in the same order, so
+    the first reply is scanned element by element and its layout is
+    compiled into one pattern that captures every known value in a
+    single match. The pattern spells out only the tags of known keys
+    and skips whatever else lies between them, so unknown elements may
+    change, appear or disappear without breaking the layout. Replies
+    that do not fit the layout fall back to the scan, which recompiles
+    the layout.
+
+    Float values are assigned as captured; NumPy converts the bytes to
+    float64 in one call. Flags and status take few distinct values, so
+    their decoded form is cached by the captured text.
+    """
+
+    def __init__(self):
+        self.kinds = {}
+        for key, i in INDEX.items():
+            self.kinds[key.encode("ascii")] = (_FLOAT, key, i)
+        for key, bit in FLAGS.items():
+            self.kinds[key.encode("ascii")] = (_FLAG, key, int(bit))
+        self.kinds[STATUS_KEY.encode("ascii")] = (_STATUS, STATUS_KEY, None)
+        self._status = {name.encode("ascii"): status
+                        for name, status in STATUS.items()}
+        self._layout = None  # type: re.Pattern
+        self._anchor = None  # opening tag of the first known value
+        self._floats = None  # (slots, getter)
+        self._flags = None  # (flag mask, getter of flags and status)
+        self._flag_bits = ()  # bit of each flag the getter returns
+        self._has_status = False  # the getter returns the status last
+        self._decoded = {}  # captured flags and status -> (bits, status)
+        self._count = 0
+        self.compiles = 0
+
+    def parse(self, reply: bytes, state) -> int:
+        """Decode `reply` into `state` in place.
+
+        Args:
+            reply: Reply body from RealFlight.
+            state: `AircraftState` to update.
+        Returns:
+            Number of values set.
+        """
+
+        if self._layout is not None:
+            pos = reply.find(self._anchor)
+            m = self._layout.match(reply, pos) if pos >= 0 else None
+            if m is not None:
+                if self._floats is not None:
+                    index, getter = self._floats
+                    state.values[index] = getter(m)
+                if self._flags is not None:
+                    mask, getter = self._flags
+                    values = getter(m)
+                    decoded = self._decoded.get(values)
+                    if decoded is None:
+                        decoded = self._decode(values)
+                    bits, status = decoded
+                    state.flags = (state.flags & ~mask) | bits
+                    if status is not None:
+                        state.status = status
+                return self._count
+        return self._scan(reply, state)
+
+    def _decode(self, values: tuple) -> tuple:
+        """Decode and cache captured flags and status.
+        """
+
+        bits = sum(bit for bit, value in zip(self._flag_bits, values)
+                   if value == _TRUE)
+        status = None
+        if self._has_status:
+            status = self._status.get(values[-1], AircraftStatus.UNKNOWN)
+        decoded = self._decoded[values] = (bits, status)
+        return decoded
+
+    def _scan(self, reply: bytes, state) -> int:
+        kinds = self.kinds
+        spans = []
+        for m in _ELEMENT.finditer(reply):
+            entry = kinds.get(m.group(1))
+            if entry is not None:
+                kind, key, _ = entry
+                value = m.group(2)
+                if kind == _FLOAT:
+                    state[key] = float(value)
+                elif kind == _FLAG:
+                    state[key] = value == _TRUE
+                else:
+                    state[key] = decode_str(value)
+                spans.append(m)
+        if spans:
+            self._compile(reply, spans)
+        return len(spans)
+
+    def _compile(self, reply: bytes, spans: list) -> None:
+        """Compile the element layout seen in `reply`.
+
+        The tags of known values are matched literally. Anything else
+        between two known values, such as unknown elements or enclosing
+        tags, is skipped whatever its contents.
+        """
+
+        parts = []
+        for prev, m in zip([None] + spans, spans):
+            if prev is not None:
+                closing = b"</" + prev.group(1) + b">"
+                gap = reply[prev.end(2):m.start()]
+                if gap.startswith(closing):
+                    parts.append(re.escape(closing))
+                    if gap != closing:
+                        parts.append(_SKIP)
+                else:
+                    parts.append(_SKIP)
+            parts.append(re.escape(reply[m.start():m.start(2)]))
+            parts.append(rb"([^<]*)")
+        parts.append(b"<")
+
+        groups = {_FLOAT: [], _FLAG: [], _STATUS: []}
+        for i, m in enumerate(spans, 1):
+            kind, _, slot = self.kinds[m.group(1)]
+            groups[kind].append((i, slot))
+
+        self._floats = self._flags = None
+        self._decoded = {}
+        if groups[_FLOAT]:
+            slots = [slot for _, slot in groups[_FLOAT]]
+            index = slots
+            if slots == list(range(slots[0], slots[0] + len(slots))):
+                index = slice(slots[0], slots[0] + len(slots))
+            self._floats = (index, _getter([i for i, _ in groups[_FLOAT]]))
+        self._flag_bits = tuple(slot for _, slot in groups[_FLAG])
+        self._has_status = bool(groups[_STATUS])
+        others = groups[_FLAG] + groups[_STATUS][-1:]
+        if others:
+            self._flags = (sum(self._flag_bits),
+                           _getter([i for i, _ in others]))
+        self._count = len(spans)
+        self._anchor = reply[spans[0].start():spans[0].start(2)]
+        self._layout = re.compile(b"".join(parts))
+        self.compiles += 1
+
+
+def parse_reference(reply: bytes, template: dict) -> dict:
+    """Slow ElementTree parse of `reply`, for checking `StateParser`.
+    """
+
+    from xml.etree import ElementTree as ET
+
+    state = {}
+    root = ET.fromstring(reply)
+    for item in root.iter():
+        if item.tag in template:
+            text = (item.text or "").encode("utf_8")
+            state[item.tag] = decoder_for(template[item.tag])(text)
+    return state
+
+
+def render_reply(state: dict) -> bytes:
+    """Render an ExchangeData reply body the way FlightAxis Link does.
+    """
+
+    def fmt(value):
+        if isinstance(value, bool):
+            return "true" if value else "false"
+        return str(value)
+
+    notifications = ("m-resetButtonHasBeenPressed",)
+    aircraft = "".join("<{0}>{1}</{0}>".format(key, fmt(value))
+                       for key, value in state.items()
+                       if key not in notifications)
+    notification = "".join("<{0}>{1}</{0}>".format(key, fmt(state[key]))
+                           for key in notifications if key in state)
+    return ("<?xml version='1.0' encoding='UTF-8'?>\n"
+            "<SOAP-ENV:Envelope "
+            "xmlns:SOAP-ENV='http://schemas.xmlsoap.org/soap/envelope/' "
+            "xmlns:SOAP-ENC='http://schemas.xmlsoap.org/soap/encoding/' "
+            "xmlns:xsd='http://www.w3.org/2001/XMLSchema' "
+            "xmlns:xsi='http://www.w3.org/2001/XMLSchema-instance'>"
+            "<SOAP-ENV:Body><ReturnData>"
+            "<m-previousInputsState>"
+            "<m-selectedChannels>-1</m-selectedChannels>"
+            "<m-channelValues-0to1 xsi:type='SOAP-ENC:Array' "
+            "SOAP-ENC:arrayType='xsd:double[12]'>"
+            + "<item>0.5</item>" * 12 +
+            "</m-channelValues-0to1></m-previousInputsState>"
+            "<m-aircraftState>" + aircraft + "</m-aircraftState>"
+            "<m-notifications>" + notification + "</m-notifications>"
+            "</ReturnData></SOAP-ENV:Body></SOAP-ENV:Envelope>"
+            ).encode("utf_8")
+
+
+if __name__ == "__main__":
+    import random
+    import sys
+    import time
+
+    from state import AircraftState
+
+    template = AircraftState().as_dict()
+    if len(sys.argv) > 1:
+        # recorded reply bodies, one per file
+        replies = [open(path, "rb").read() for path in sys.argv[1:]]
+    else:
+        random.seed(0)
+        replies = []
+        for _ in range(100):
+            state = {}
+            for key, default in template.items():
+                if isinstance(default, bool):
+                    state[key] = random.random() < 0.5
+                elif isinstance(default, str):
+                    state[key] = default
+                else:
+                    state[key] = round(random.uniform(-100, 100), 6)
+            replies.append(render_reply(state))
+
+    parser = StateParser()
+    state = AircraftState()
+    for reply in replies:
+        parser.parse(reply, state)
+        expected = parse_reference(reply, template)
+        assert {key: state[key] for key in expected} == expected
+
+    n = 20000 // len(replies) + 1
+
+    def bench(name, fn):
+        t0 = time.perf_counter()
+        for _ in range(n):
+            for reply in replies:
+                fn(reply)
+        dt = (time.perf_counter() - t0) / (n * len(replies))
+        print("{:>10}: {:.2f} us/reply".format(name, dt * 1e6))
+
+    bench("etree", lambda reply: parse_reference(reply, template))
+    bench("compiled", lambda reply: parser.parse(reply, state))
@@ -0,0 +1,577 @@
+#!/usr/bin/env python3
+""" Persistent keep-alive transport for FlightAxis Link
+
+Copyright (C) 2019  BioBrain, Inc
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+import collections
+import select
+import socket
+import threading
+import time
+
+HEADER_FMT = ("POST / HTTP/1.1\n"
+              "soapaction: '{}'\n"
+              "content-length: {}\n"
+              "content-type: text/xml;charset='UTF-8'\n"
+              "Connection: Keep-Alive\n"
+              "\n")
+
+_CONTENT_LENGTH = b"content-length:"
+
+
+class TransportError(ConnectionError):
+    """Raised when FlightAxis Link does not answer with a valid reply.
+    """
+
+
+class LatencyCounter(object):
+    """Running latency statistics of one kind of request.
+    """
+
+    __slots__ = ("count", "total_s", "min_s", "max_s", "last_s")
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self) -> None:
+        self.count = 0
+        self.total_s = 0.0
+        self.min_s = float("inf")
+        self.max_s = 0.0
+        self.last_s = 0.0
+
+    def record(self, dt: float) -> None:
+        self.count += 1
+        self.total_s += dt
+        self.last_s = dt
+        if dt < self.min_s:
+            self.min_s = dt
+        if dt > self.max_s:
+            self.max_s = dt
+
+    @property
+    def mean_s(self) -> float:
+        return self.total_s / self.count if self.count else 0.0
+
+    def __repr__(self):
+        return ("LatencyCounter(count={}, mean={:.3f}ms, min={:.3f}ms, "
+                "max={:.3f}ms)".format(self.count, self.mean_s * 1e3,
+                                       self.min_s * 1e3 if self.count else 0,
+                                       self.max_s * 1e3))
+
+
+def encode_frame(action: str, body: bytes) -> bytes:
+    """Return complete HTTP/SOAP request frame for `action`.
+    """
+
+    header = HEADER_FMT.format(action, len(body))
+    return header.encode("utf_8", errors="strict") + body
+
+
+def parse_content_length(header: bytes) -> int:
+    """Return Content-Length of an HTTP response header block.
+    """
+
+    header = header.lower()
+    p = header.find(_CONTENT_LENGTH)
+    if p < 0:
+        raise TransportError("no Content-Length in reply")
+    q = header.find(b"\n", p)
+    return int(header[p + len(_CONTENT_LENGTH):q if q >= 0 else None])
+
+
+class ConnectorConfig(object):
+    """Where and how to reach one FlightAxis Link instance.
+
+    Args:
+        host: Host name or address of the simulator PC.
+        port: FlightAxis Link port.
+        connect_timeout: Bound on establishing a connection, in seconds.
+        timeout: Bound on every send and receive, in seconds.
+        max_retries: Resends of a request after a connection failure.
+        pool_size: Connections kept open, including the active one.
+        dns_ttl: Seconds a resolved address is reused.
+        idle_check: Connections idle longer than this many seconds are
+            health checked before use.
+        pipeline_requests: Send the controller injection requests back
+            to back in one round-trip. Needs a server that answers
+            pipelined HTTP requests in order.
+    """
+
+    def __init__(self, host: str, port: int, connect_timeout: float = 0.5,
+                 timeout: float = 1.0, max_retries: int = 1,
+                 pool_size: int = 2, dns_ttl: float = 300.0,
+                 idle_check: float = 0.25, pipeline_requests: bool = False):
+        self.host = host
+        self.port = port
+        self.connect_timeout = connect_timeout
+        self.timeout = timeout
+        self.max_retries = max_retries
+        self.pool_size = pool_size
+        self.dns_ttl = dns_ttl
+        self.idle_check = idle_check
+        self.pipeline_requests = pipeline_requests
+
+    def __repr__(self):
+        return "ConnectorConfig({!r}, {})".format(self.host, self.port)
+
+
+_dns_cache = {}  # type: dict
+_dns_lock = threading.Lock()
+
+
+def resolve(host: str, port: int, ttl: float = 300.0,
+            refresh: bool = False) -> tuple:
+    """Return cached (family, sockaddr) of a TCP endpoint.
+    """
+
+    address = None if refresh else cached_address(host, port)
+    if address is None:
+        address = cache_address(host, port, ttl, socket.getaddrinfo(
+            host, port, type=socket.SOCK_STREAM))
+    return address
+
+
+def cached_address(host: str, port: int) -> tuple:
+    """Return (family, sockaddr) from the DNS cache, or None if the entry
+    is missing or expired.
+    """
+
+    with _dns_lock:
+        entry = _dns_cache.get((host, port))
+    if entry is not None and entry[0] > time.monotonic():
+        return entry[1]
+    return None
+
+
+def cache_address(host: str, port: int, ttl: float, addrinfo: list) -> tuple:
+    """Store the first result of getaddrinfo for `ttl` seconds and return
+    it as (family, sockaddr).
+    """
+
+    family, _, _, _, sockaddr = addrinfo[0]
+    with _dns_lock:
+        _dns_cache[(host, port)] = (time.monotonic() + ttl,
+                                    (family, sockaddr))
+    return family, sockaddr
+
+
+def is_alive(sock: socket.socket) -> bool:
+    """Return whether an idle keep-alive connection is still usable.
+
+    An idle connection must have nothing to read: a readable socket has
+    either been closed by the peer or holds stray bytes of an old reply.
+    """
+
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+    except (OSError, ValueError):
+        return False
+    return not readable
+
+
+class ConnectionPool(object):
+    """Bounded pool of pre-warmed connections to one endpoint.
+
+    Connections are health checked when taken from the pool, so a socket
+    the simulator dropped between episodes is replaced by a spare
+    instead of stalling the next control tick on a reconnect. `refill`
+    replaces used and dead spares on a background thread, keeping
+    connects off the tick path.
+    """
+
+    def __init__(self, config: ConnectorConfig):
+        self.config = config
+        self._idle = collections.deque()
+        self._lock = threading.Lock()
+        self._refilling = False
+        self._closed = False
+        self.opened = 0
+        self.evicted = 0
+
+    def __len__(self):
+        return len(self._idle)
+
+    @property
+    def spares(self) -> int:
+        """Idle connections kept besides the active one.
+        """
+
+        return max(0, self.config.pool_size - 1)
+
+    def open(self) -> socket.socket:
+        config = self.config
+        family, sockaddr = resolve(config.host, config.port, config.dns_ttl)
+        sock = socket.socket(family, socket.SOCK_STREAM)
+        sock.settimeout(config.connect_timeout)
+        try:
+            sock.connect(sockaddr)
+        except OSError:
+            sock.close()
+            # the address may have moved; look it up again next time
+            resolve(config.host, config.port, config.dns_ttl, refresh=True)
+            raise
+        sock.settimeout(config.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.opened += 1
+        return sock
+
+    def warm(self) -> None:
+        """Open connections until the pool is full.
+        """
+
+        while len(self._idle) < self.spares and not self._closed:
+            sock = self.open()
+            self.release(sock)
+
+    def check(self) -> None:
+        """Evict dead idle connections and top the pool up again.
+
+        Idle connections stay available to `acquire` meanwhile.
+        """
+
+        with self._lock:
+            idle = list(self._idle)
+        for sock in idle:
+            if is_alive(sock):
+                continue
+            with self._lock:
+                try:
+                    self._idle.remove(sock)
+                except ValueError:
+                    continue  # acquired meanwhile
+            self.discard(sock)
+        self.warm()
+
+    def refill(self) -> None:
+        """Run `check` on a background thread unless one is running.
+        """
+
+        with self._lock:
+            if self._refilling or self._closed:
+                return
+            self._refilling = True
+        thread = threading.Thread(target=self._refill, daemon=True)
+        thread.start()
+
+    def _refill(self) -> None:
+        try:
+            self.check()
+        except OSError:
+            pass  # simulator unreachable; the next refill tries again
+        finally:
+            self._refilling = False
+
+    def acquire(self) -> socket.socket:
+        while True:
+            with self._lock:
+                sock = self._idle.popleft() if self._idle else None
+            if sock is None:
+                return self.open()
+            if is_alive(sock):
+                return sock
+            self.discard(sock)
+
+    def release(self, sock: socket.socket) -> None:
+        with self._lock:
+            if len(self._idle) < self.spares and not self._closed:
+                self._idle.append(sock)
+                return
+        sock.close()
+
+    def discard(self, sock: socket.socket) -> None:
+        self.evicted += 1
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+    def close(self) -> None:
+        with self._lock:
+            self._closed = True
+            idle = list(self._idle)
+            self._idle.clear()
+        for sock in idle:
+            sock.close()
+
+
+class FlightAxisTransport(object):
+    """Single keep-alive TCP connection to FlightAxis Link.
+
+    Requests are written as pre-encoded frames and replies are read with
+    Content-Length framing, so no HTTP library is involved per tick. A
+    broken connection is replaced from the connection pool and the
+    request resent up to `config.max_retries` times. A connection that
+    sat idle longer than `config.idle_check` is health checked first.
+    Every `config.idle_check` seconds of use, and whenever a spare was
+    taken, the pool is refilled in the background.
+    """
+
+    def __init__(self, config: ConnectorConfig, bufsize: int = 16384):
+        self.config = config
+        self.pool = ConnectionPool(config)
+        self._sock = None  # type: socket.socket
+        self._last_used = 0.0
+        self._last_refill = 0.0
+        self._buf = bytearray(bufsize)
+        self._view = memoryview(self._buf)
+        self._pending = 0  # bytes already in _buf belonging to next reply
+        self.latency = {}  # type: dict
+        self.connects = 0
+        self.reconnects = 0
+        self.retries = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.capture = None  # e.g. capture.CaptureWriter
+        # when set, request() stores perf_counter() after the send and at
+        # the first reply byte into trace[0] and trace[1]
+        self.trace = None  # type: list
+
+    @property
+    def connected(self) -> bool:
+        return self._sock is not None
+
+    def connect(self) -> None:
+        if self._sock is not None:
+            if (time.monotonic() - self._last_used < self.config.idle_check
+                    or is_alive(self._sock)):
+                return
+            self.pool.discard(self._sock)
+            self._sock = None
+        self._sock = self.pool.acquire()
+        self._pending = 0
+        if self.connects:
+            self.reconnects += 1
+        self.connects += 1
+        self._refill()
+
+    def _refill(self) -> None:
+        self._last_refill = time.monotonic()
+        self.pool.refill()
+
+    def warm(self) -> None:
+        """Open the active connection and fill the pool with spares.
+        """
+
+        self.connect()
+        self.pool.warm()
+
+    def disconnect(self) -> None:
+        """Drop the active connection, e.g. after a failed request.
+        """
+
+        if self._sock is not None:
+            self.pool.discard(self._sock)
+            self._sock = None
+        self._pending = 0
+
+    def close(self) -> None:
+        self.disconnect()
+        self.pool.close()
+
+    def request(self, action: str, body: bytes = b"",
+                frame: bytes = None) -> bytes:
+        """Send one SOAP request and return the reply body.
+
+        Args:
+            action:
+                "RestoreOriginalControllerDevice"
+                "InjectUAVControllerInterface"
+                "ExchangeData"
+            body: Encoded SOAP envelope.
+            frame: Complete pre-encoded frame; overrides `body`.
+        Returns:
+            Reply body from RealFlight.
+        """
+
+        if frame is None:
+            frame = encode_frame(action, body)
+        counter = self.counter(action)
+
+        attempt = 0
+        while True:
+            t0 = time.perf_counter()
+            try:
+                self.connect()
+                self._sock.sendall(frame)
+                self.bytes_sent += len(frame)
+                if self.trace is not None:
+                    self._trace_first_byte()
+                reply = self._read_reply()
+            except (OSError, TransportError):
+                self.disconnect()
+                if attempt >= self.config.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                continue
+            dt = time.perf_counter() - t0
+            counter.record(dt)
+            self._last_used = time.monotonic()
+            if self._last_used - self._last_refill > self.config.idle_check:
+                self._refill()
+            if self.capture is not None:
+                self.capture.write(action, frame, reply, dt)
+            return reply
+
+    def request_many(self, requests) -> list:
+        """Send (action, frame) pairs back to back and return the replies.
+
+        All frames go out in one write and the replies are read in
+        order, so the batch costs one round-trip. A failure resends the
+        whole batch. Every action is charged the latency of the batch.
+        """
+
+        data = b"".join(frame for _, frame in requests)
+        attempt = 0
+        while True:
+            t0 = time.perf_counter()
+            try:
+                self.connect()
+                self._sock.sendall(data)
+                self.bytes_sent += len(data)
+                replies = [self._read_reply() for _ in requests]
+            except (OSError, TransportError):
+                self.disconnect()
+                if attempt >= self.config.max_retries:
+                    raise
+                attempt += 1
+                self.retries += 1
+                continue
+            dt = time.perf_counter() - t0
+            self._last_used = time.monotonic()
+            if self._last_used - self._last_refill > self.config.idle_check:
+                self._refill()
+            for (action, frame), reply in zip(requests, replies):
+                self.counter(action).record(dt)
+                if self.capture is not None:
+                    self.capture.write(action, frame, reply, dt)
+            return replies
+
+    def _trace_first_byte(self) -> None:
+        trace = self.trace
+        trace[0] = time.perf_counter()
+        if not self._pending:
+            # blocks until the reply starts arriving, without consuming it
+            self._sock.recv(1, socket.MSG_PEEK)
+        trace[1] = time.perf_counter()
+
+    def counter(self, action: str) -> LatencyCounter:
+        counter = self.latency.get(action)
+        if counter is None:
+            counter = self.latency[action] = LatencyCounter()
+        return counter
+
+    def _fill(self, end: int) -> int:
+        """Receive more bytes into the buffer starting at `end`.
+        """
+
+        if end == len(self._buf):
+            self._view.release()
+            self._buf.extend(bytes(len(self._buf)))
+            self._view = memoryview(self._buf)
+        n = self._sock.recv_into(self._view[end:])
+        if n == 0:
+            raise TransportError("connection closed by FlightAxis Link")
+        self.bytes_received += n
+        return end + n
+
+    def _read_reply(self) -> bytes:
+        buf = self._buf
+        end = self._pending
+        # headers
+        while True:
+            head_end = buf.find(b"\r\n\r\n", 0, end)
+            sep = 4
+            if head_end < 0:
+                head_end = buf.find(b"\n\n", 0, end)
+                sep = 2
+            if head_end >= 0:
+                break
+            end = self._fill(end)
+            buf = self._buf
+
+        content_length = parse_content_length(bytes(buf[:head_end]))
+
+        # body
+        start = head_end + sep
+        stop = start + content_length
+        while end < stop:
+            end = self._fill(end)
+        reply = bytes(self._view[start:stop])
+
+        # keep whatever already arrived for the next reply
+        self._pending = end - stop
+        if self._pending:
+            self._buf[:self._pending] = self._buf[stop:end]
+        return reply
+
+
+def _serve_canned(sock: socket.socket, reply: bytes) -> None:
+    """Answer every request on accepted connections with `reply`.
+    """
+
+    response = (b"HTTP/1.1 200 OK\r\n"
+                b"Content-Type: text/xml; charset='UTF-8'\r\n"
+                b"Content-Length: " + str(len(reply)).encode() + b"\r\n"
+                b"Connection: Keep-Alive\r\n"
+                b"\r\n" + reply)
+    while True:
+        conn, _ = sock.accept()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        data = b""
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+            while True:
+                head_end = data.find(b"\n\n")
+                if head_end < 0:
+                    break
+                header = data[:head_end].lower()
+                p = header.find(_CONTENT_LENGTH)
+                length = int(header[p + len(_CONTENT_LENGTH):].split(b"\n")[0])
+                if len(data) < head_end + 2 + length:
+                    break
+                data = data[head_end + 2 + length:]
+                conn.sendall(response)
+        conn.close()
+
+
+if __name__ == "__main__":
+    import threading
+
+    from connector import ACTION_FMT
+
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.bind(("127.0.0.1", 0))
+    server.listen(1)
+    reply = b"<?xml version='1.0' encoding='UTF-8'?>\n" + b"x" * 4000
+    threading.Thread(target=_serve_canned, args=(server, reply),
+                     daemon=True).start()
+
+    transport = FlightAxisTransport(ConnectorConfig(*server.getsockname()))
+    action = "ExchangeData"
+    body = ACTION_FMT[action].format(*([0.5] * 12)).encode("utf_8")
+    n = 10000
+    t0 = time.perf_counter()
+    for _ in range(n):
+        transport.request(action, body)
+    dt = time.perf_counter() - t0
+    print("{} requests in {:.2f}s, {:.0f} req/s".format(n, dt, n / dt))
+    print(transport.latency[action])
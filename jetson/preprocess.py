@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+
+# preprocess.py: stereo frame to model input without per-frame allocation.
+
+import cv2
+import numpy as np
+
+SCALE = np.float16(255.0)
+
+
+class StereoPreprocessor(object):
+    '''split a side by side stereo frame and turn both eyes into one
+    (2, 3, H, W) float16 RGB tensor
+
+    Both eyes are resized into one preallocated uint8 buffer. Channel
+    swap, HWC to CHW, float16 conversion and scaling are then a single
+    np.divide from a strided view of it into the preallocated output,
+    so no frame sized array is allocated per frame. The result is
+    bit-identical to resizing, transposing, astype(np.float16) and
+    dividing by 255.0 separately.
+
+    The output buffer is reused by the next call; copy it to keep it.
+    '''
+
+    def __init__(self, model_input, interpolation=cv2.INTER_LANCZOS4,
+                 swap_rb=True):
+        width, height = model_input
+        self.model_input = (width, height)
+        self.interpolation = interpolation
+        # resized eyes, as cv2 produces them
+        self.resized = np.empty((2, height, width, 3), np.uint8)
+        self.output = np.empty((2, 3, height, width), np.float16)
+        view = self.resized[:, :, :, ::-1] if swap_rb else self.resized
+        self.source = view.transpose(0, 3, 1, 2)
+
+    @property
+    def left(self):
+        return self.resized[0]
+
+    @property
+    def right(self):
+        return self.resized[1]
+
+    def __call__(self, frame, split=None):
+        '''preprocess frame, the left eye in columns up to split, by
+        default the left half'''
+        if split is None:
+            split = frame.shape[1] // 2
+        for eye, image in enumerate((frame[:, :split], frame[:, split:])):
+            cv2.resize(image, self.model_input, dst=self.resized[eye],
+                       interpolation=self.interpolation)
+        np.divide(self.source, SCALE, out=self.output, dtype=np.float16,
+                  casting='unsafe')
+        return self.output
+
+
+def reference(frame, model_input, interpolation=cv2.INTER_LANCZOS4):
+    # the original per-eye steps, for comparison
+    half = frame.shape[1] // 2
+    eyes = []
+    for image in (frame[:, :half], frame[:, half:]):
+        image = cv2.resize(image, model_input, interpolation=interpolation)
+        image = np.transpose(image[:, :, ::-1], [2, 0, 1]).astype(np.float16)
+        image /= 255.0
+        eyes.append(image)
+    return eyes
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--stereo-size', type=str, default='640x360')
+    ap.add_argument('--model-input', type=str, default='513x257')
+    ap.add_argument('--count', type=int, default=200)
+    args = ap.parse_args()
+
+    stereo_size = tuple(int(v) for v in args.stereo_size.split('x'))
+    model_input = tuple(int(v) for v in args.model_input.split('x'))
+    frame = np.random.randint(0, 256, stereo_size[::-1] + (3,), np.uint8)
+    preprocess = StereoPreprocessor(model_input)
+
+    output = preprocess(frame)
+    expected = reference(frame, model_input)
+    assert all(np.array_equal(output[i], expected[i]) for i in range(2))
+
+    for name, fn in (('reference', lambda: reference(frame, model_input)),
+                     ('fused', lambda: preprocess(frame))):
+        t0 = time.time()
+        for i in range(args.count):
+            fn()
+        dt = time.time() - t0
+        print('%9s: %.2f ms/frame' % (name, dt / args.count * 1e3))
+
+    # the conversion alone, without the resize both share
+    t0 = time.time()
+    for i in range(args.count):
+        np.divide(preprocess.source, SCALE, out=preprocess.output,
+                  dtype=np.float16, casting='unsafe')
+    print('%9s: %.2f ms/frame' % ('convert', (time.time() - t0) /
+                                  args.count * 1e3))
@@ -3,50 +3,80 @@
 # steore.py: depth analysis on Jetson TX2.
 # Kyungwon Chun <kwchun@biobrain.kr>
 
+import os
+import sys
+
 import cv2
-import numpy as np
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'video'))
+from shmring import RingReceiver, ring_name
+from preprocess import StereoPreprocessor
 
 STATION = 'udp://192.168.0.178:9999?overrun_nonfatal=1&fifo_size=1316'
+# frames from grab.py --port 9999 on this host, used in place of STATION
+RING = ring_name(9999)
 STEREO_SIZE = (640, 360)
-MONOCULAR = (STEREO_SIZE[0] / 2, STEREO_SIZE[1])
+MONOCULAR = (STEREO_SIZE[0] // 2, STEREO_SIZE[1])
 MODEL_INPUT = (513, 257)
 
-cap = cv2.VideoCapture(STATION, cv2.CAP_FFMPEG)
-if not cap.isOpened():
-    print('VideoCapture not opened')
-    exit(-1)
+ring = RingReceiver(RING)
+cap = None
+if ring.get_frame(timeout=1.0) is not None:
+    # ring frames are RGB already and are read in place
+    preprocess = StereoPreprocessor(MODEL_INPUT, swap_rb=False)
+    display = cv2.COLOR_RGB2BGR
+else:
+    ring.close()
+    ring = None
+    preprocess = StereoPreprocessor(MODEL_INPUT)
+    display = None
+    cap = cv2.VideoCapture(STATION, cv2.CAP_FFMPEG)
+    if not cap.isOpened():
+        print('VideoCapture not opened')
+        exit(-1)
 
 while True:
-    ret, frame = cap.read()
+    if ring is not None:
+        # newest frame, mapped from shared memory at the size of the
+        # region grab.py captures, so split it in the middle
+        frame = ring.get_frame(timeout=1.0)
+        ret = frame is not None
+        if ret:
+            frame = frame[0]
+        split = None
+    else:
+        ret, frame = cap.read()
+        split = MONOCULAR[0]
 
     if not ret:
         print('frame empty')
         break
 
-    left = frame[:, :MONOCULAR[0]]
-    right = frame[:, MONOCULAR[0]:]
-
-    left = cv2.resize(left, MODEL_INPUT, interpolation = cv2.INTER_LANCZOS4)
-    right = cv2.resize(right, MODEL_INPUT, interpolation = cv2.INTER_LANCZOS4)
+    # (2, 3, H, W) RGB float16 in [0, 1], left eye first
+    batch = preprocess(frame, split)
+    if ring is not None and not ring.frame_valid():
+        # grab.py overwrote the slot while it was being resized
+        continue
 
-    cv2.imshow('left', left)
-    cv2.imshow('right', right)
+    if display is None:
+        cv2.imshow('left', preprocess.left)
+        cv2.imshow('right', preprocess.right)
+    else:
+        cv2.imshow('left', cv2.cvtColor(preprocess.left, display))
+        cv2.imshow('right', cv2.cvtColor(preprocess.right, display))
 
-    # Convert to RGB and then CHW.
-    left = np.transpose(left[:, :, ::-1], [2, 0, 1]).astype(np.float16)
-    left /= 255.0
-
-    right = np.transpose(right[:, :, ::-1], [2, 0, 1]).astype(np.float16)
-    right /= 255.0
-    
     with open('left.bin', 'wb') as w:
-        left.reshape(-1).tofile(w)
+        batch[0].tofile(w)
 
     with open('right.bin', 'wb') as w:
-        right.reshape(-1).tofile(w)
+        batch[1].tofile(w)
     
     if cv2.waitKey(1)&0XFF == ord('q'):
         break
 
-cap.release()
+if ring is not None:
+    ring.close()
+else:
+    cap.release()
 cv2.destroyAllWindows()
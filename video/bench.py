@@ -0,0 +1,231 @@
+#!/usr/bin/env python
+'''
+headless benchmark of the video forwarding pipeline over loopback UDP
+
+Every run captures synthetic or recorded frames through the grab.py
+path (CaptureStream, JpegEncoder or TileEncoder, FrameSender) and
+receives them through the display_udp_image.py path (FrameReceiver),
+with a consumer that takes the place of the display. A run is made for
+every combination of region size, quality, rate, tile mode and
+transport, and the results are written as JSON, for example
+
+  python bench.py --sizes 300x412,640x360 --qualities 50,80 \
+      --rates 30,50 --output results.json
+'''
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import sys
+import time
+
+import cv2
+import numpy
+
+from capture import ReplayBackend, SyntheticBackend
+from encode import JpegEncoder
+from framing import DEFAULT_PAYLOAD, FrameSender, connect
+from receiver import FrameReceiver
+from shmring import FrameRing, RingReceiver
+from stream import CaptureStream
+from tiles import TileEncoder
+
+# counters of FrameReceiver.stats() that are totals since start
+RECEIVER_COUNTS = ("received", "decoded", "dropped", "lost_deltas", "errors",
+                   "completed", "incomplete", "late", "duplicates", "invalid",
+                   "skipped", "overwritten")
+
+
+def parse_list(text, convert):
+    return [convert(v) for v in text.split(',') if v]
+
+
+def parse_size(text):
+    '''parse "widthxheight"'''
+    width, height = text.lower().split('x')
+    return int(width), int(height)
+
+
+def consume(receiver, until, latencies=None):
+    '''display frames until time until, recording capture to display
+    latency'''
+    displayed = 0
+    while time.time() < until:
+        frame = receiver.get_frame(timeout=0.05)
+        if frame is None:
+            continue
+        img, timestamp = frame
+        receiver.displayed_frame(timestamp)
+        displayed += 1
+        if latencies is not None:
+            latencies.append(time.time() - timestamp)
+    return displayed
+
+
+def run(size, quality, rate, tiles=0, duration=3.0, warmup=0.5,
+        frames=None, workers=1, payload=DEFAULT_PAYLOAD, queue_size=2,
+        keyframe=50, slots=4, deadline=0.2, transport="udp"):
+    '''stream for warmup + duration seconds and return the run's results'''
+    region = (0, 0) + size
+    if frames is None:
+        backend = SyntheticBackend(region)
+    else:
+        backend = ReplayBackend(region, frames)
+    if transport == "shm":
+        name = "taka_bench_%u" % os.getpid()
+        ring = FrameRing(name, slots, size[0] * size[1] * 3)
+        receiver = RingReceiver(name)
+        encode, send = numpy.asarray, ring.put
+        workers = tiles = quality = 0
+    else:
+        receiver = FrameReceiver(0, host='127.0.0.1', slots=slots,
+                                 deadline=deadline).start()
+        sender = FrameSender(connect('127.0.0.1', receiver.address[1]),
+                             payload)
+        encode, send = JpegEncoder(quality), sender.send
+        if tiles:
+            encode = TileEncoder(encode, tiles, keyframe)
+            workers = 1
+    stream = CaptureStream(backend, encode, send, rate, queue_size,
+                           workers).start()
+    try:
+        consume(receiver, time.time() + warmup)
+        stream.report()
+        before = receiver.stats()
+        if transport != "shm":
+            receiver.network.reset()
+        latencies = []
+        t0 = time.time()
+        cpu0 = time.process_time()
+        displayed = consume(receiver, t0 + duration, latencies)
+        sent = stream.sent
+        r = stream.report()
+        elapsed = time.time() - t0
+        cpu = time.process_time() - cpu0
+    finally:
+        stream.stop()
+    # frames still in flight are not lost
+    consume(receiver, time.time() + deadline)
+    after = receiver.stats()
+    if transport == "shm":
+        receiver.close()
+        ring.close()
+    else:
+        receiver.stop()
+
+    counts = {k: after[k] - before[k] for k in RECEIVER_COUNTS
+              if k in after}
+    if transport == "shm":
+        # every frame lands in the ring, frames replaced before the
+        # consumer got to them are skipped rather than lost
+        lost = 0
+    else:
+        lost = max(0, sent - counts["completed"])
+    latencies = numpy.array(latencies) * 1e3
+    result = {
+        "width": size[0],
+        "height": size[1],
+        "quality": quality,
+        "rate": rate,
+        "tiles": tiles,
+        "transport": transport,
+        "workers": workers,
+        "duration_s": elapsed,
+        "sent": sent,
+        "displayed": displayed,
+        "sent_fps": r["fps"],
+        "displayed_fps": displayed / elapsed,
+        "capture_fps": r["capture_fps"],
+        "kbyte_per_s": r["kbyte_per_s"],
+        "bytes_per_frame": r["kbyte_per_s"] * 1024.0 / r["fps"]
+        if r["fps"] else 0.0,
+        "capture_dropped": r["dropped"],
+        "capture_late": r["late"],
+        "stream_errors": r["errors"],
+        "encode_ms": r["encode_ms"],
+        "send_ms": r["send_ms"],
+        "loss_rate": float(lost) / sent if sent else 0.0,
+        "network_mean_ms": after.get("network_mean_ms"),
+        # sender and receiver together, as both run in this process
+        "cpu_percent": 100.0 * cpu / elapsed,
+    }
+    for p in (50, 90, 99):
+        result["latency_p%u_ms" % p] = \
+            float(numpy.percentile(latencies, p)) if len(latencies) else None
+    result["latency_max_ms"] = \
+        float(latencies.max()) if len(latencies) else None
+    result.update(counts)
+    return result
+
+
+if __name__ == '__main__':
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--sizes", type=str, default="300x412,640x360,1280x720",
+                    help="region sizes as widthxheight")
+    ap.add_argument("--qualities", type=str, default="50,80")
+    ap.add_argument("--rates", type=str, default="30,50")
+    ap.add_argument("--tiles", type=str, default="0",
+                    help="tile sizes to run, 0 for full frames")
+    ap.add_argument("--transports", type=str, default="udp",
+                    help="udp for jpeg over loopback, shm for raw frames "
+                    "in shared memory")
+    ap.add_argument("--frames", type=str, default=None,
+                    help="recorded .npy sequence from tiles.py record; "
+                    "default synthetic")
+    ap.add_argument("--duration", type=float, default=3.0,
+                    help="measured seconds per run")
+    ap.add_argument("--warmup", type=float, default=0.5)
+    ap.add_argument("--workers", type=int, default=1, help="encode threads")
+    ap.add_argument("--payload", type=int, default=DEFAULT_PAYLOAD)
+    ap.add_argument("--keyframe", type=int, default=50)
+    ap.add_argument("--output", type=str, default=None,
+                    help="JSON file, default stdout")
+    args = ap.parse_args()
+
+    runs = []
+    seen = set()
+    for size, quality, rate, tiles, transport in itertools.product(
+            parse_list(args.sizes, parse_size),
+            parse_list(args.qualities, int),
+            parse_list(args.rates, float),
+            parse_list(args.tiles, int),
+            parse_list(args.transports, str)):
+        if transport == "shm":
+            # raw frames, quality and tiles do not apply
+            if (size, rate) in seen:
+                continue
+            seen.add((size, rate))
+        r = run(size, quality, rate, tiles, args.duration, args.warmup,
+                args.frames, args.workers, args.payload,
+                keyframe=args.keyframe, transport=transport)
+        sys.stderr.write(
+            "%4ux%-4u %s q%-3u %4.0f FPS tiles %-3u: %5.1f FPS "
+            "%8.1f kByte/sec latency p50 %s ms p99 %s ms loss %.3f "
+            "cpu %.0f%%\n" % (
+                size[0], size[1], transport, r["quality"], rate, r["tiles"],
+                r["displayed_fps"], r["kbyte_per_s"],
+                "%.1f" % r["latency_p50_ms"]
+                if r["latency_p50_ms"] is not None else "-",
+                "%.1f" % r["latency_p99_ms"]
+                if r["latency_p99_ms"] is not None else "-",
+                r["loss_rate"], r["cpu_percent"]))
+        runs.append(r)
+
+    report = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "host": platform.node(),
+        "platform": platform.platform(),
+        "python": platform.python_version(),
+        "opencv": cv2.__version__,
+        "numpy": numpy.__version__,
+        "frames": args.frames or "synthetic",
+        "runs": runs,
+    }
+    text = json.dumps(report, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + "\n")
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+'''
+screen capture backends for grab.py
+
+Every backend captures a fixed (x, y, width, height) region and returns
+it as a new (height, width, 3) uint8 RGB image per grab(). RGB is what
+d3dshot produces and, after the jpeg round trip through cv2, what
+MPImage on the display side expects.
+'''
+
+import sys
+import time
+
+import numpy
+
+
+class CaptureBackend(object):
+    '''interface of a screen capture source'''
+
+    name = None
+
+    def __init__(self, region):
+        self.region = region
+
+    def grab(self):
+        '''return the current region as an RGB image'''
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class D3DShotBackend(CaptureBackend):
+    '''Windows Desktop Duplication through d3dshot'''
+
+    name = "d3dshot"
+
+    def __init__(self, region):
+        import d3dshot
+        super(D3DShotBackend, self).__init__(region)
+        x, y, width, height = region
+        self.box = (x, y, x + width, y + height)
+        self.d = d3dshot.create(capture_output="numpy")
+
+    def grab(self):
+        return self.d.screenshot(region=self.box)
+
+
+class MSSBackend(CaptureBackend):
+    '''X11, macOS and Windows capture through mss
+
+    mss handles are not shared between threads, so the handle is opened
+    by the first grab() on the capturing thread.
+    '''
+
+    name = "mss"
+
+    def __init__(self, region):
+        import mss
+        super(MSSBackend, self).__init__(region)
+        self.mss = mss
+        x, y, width, height = region
+        self.monitor = {"left": x, "top": y, "width": width, "height": height}
+        self.sct = None
+
+    def grab(self):
+        if self.sct is None:
+            self.sct = self.mss.mss()
+        shot = self.sct.grab(self.monitor)
+        bgra = numpy.frombuffer(shot.raw, dtype=numpy.uint8).reshape(
+            shot.height, shot.width, 4)
+        return bgra[:, :, 2::-1].copy()
+
+    def close(self):
+        if self.sct is not None:
+            self.sct.close()
+            self.sct = None
+
+
+class SyntheticBackend(CaptureBackend):
+    '''moving test pattern, for benchmarks and machines without a screen
+
+    A colour gradient with a bar sweeping across it and a changing block
+    in the top left corner, so consecutive frames differ the way a
+    screen with motion does.
+    '''
+
+    name = "synthetic"
+
+    def __init__(self, region, speed=4):
+        super(SyntheticBackend, self).__init__(region)
+        x, y, width, height = region
+        self.speed = speed
+        self.count = 0
+        gx = numpy.linspace(0, 255, width, dtype=numpy.float32)
+        gy = numpy.linspace(0, 255, height, dtype=numpy.float32)[:, None]
+        self.base = numpy.empty((height, width, 3), dtype=numpy.uint8)
+        self.base[:, :, 0] = gx
+        self.base[:, :, 1] = gy
+        self.base[:, :, 2] = (gx + gy) / 2
+
+    def grab(self):
+        img = self.base.copy()
+        height, width = img.shape[:2]
+        bar = (self.count * self.speed) % width
+        img[:, bar:bar + 8] = 255
+        img[:16, :16] = (self.count * 7) % 256
+        self.count += 1
+        return img
+
+
+class ReplayBackend(CaptureBackend):
+    '''replay a recorded (frames, height, width, 3) .npy sequence in a loop
+
+    The sequence is memory mapped and region is cropped out of each
+    frame, so one recording serves several region sizes.
+    '''
+
+    name = "replay"
+
+    def __init__(self, region, path):
+        super(ReplayBackend, self).__init__(region)
+        self.frames = numpy.load(path, mmap_mode='r')
+        x, y, width, height = region
+        if (self.frames.ndim != 4 or self.frames.shape[1] < y + height or
+                self.frames.shape[2] < x + width):
+            raise ValueError("%s holds %s frames, too small for region %s" %
+                             (path, self.frames.shape[1:], region))
+        self.count = 0
+
+    def grab(self):
+        x, y, width, height = self.region
+        frame = self.frames[self.count % len(self.frames)]
+        self.count += 1
+        return numpy.array(frame[y:y + height, x:x + width, :3])
+
+
+BACKENDS = {b.name: b for b in (D3DShotBackend, MSSBackend, SyntheticBackend)}
+
+
+def create_backend(name, region):
+    '''create backend name, or with "auto" the best one available'''
+    if name != "auto":
+        return BACKENDS[name](region)
+    names = ["d3dshot", "mss"] if sys.platform == "win32" else ["mss"]
+    for name in names:
+        try:
+            return BACKENDS[name](region)
+        except ImportError:
+            pass
+    return SyntheticBackend(region)
+
+
+def parse_region(text):
+    '''parse "x,y,width,height"'''
+    region = tuple(int(v) for v in text.split(','))
+    if len(region) != 4:
+        raise ValueError("Region must be 'x,y,width,height'")
+    return region
+
+
+if __name__ == '__main__':
+    import argparse
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--backend", type=str, default="auto",
+                    choices=["auto"] + sorted(BACKENDS))
+    ap.add_argument("--region", type=str, default="0,52,300,412")
+    ap.add_argument("--count", type=int, default=200)
+    args = ap.parse_args()
+
+    backend = create_backend(args.backend, parse_region(args.region))
+    backend.grab()
+    t0 = time.time()
+    for i in range(args.count):
+        img = backend.grab()
+    dt = time.time() - t0
+    print("%s: %s %.2f ms/grab %.1f FPS" % (backend.name, img.shape,
+                                            dt / args.count * 1e3,
+                                            args.count / dt))
+    backend.close()
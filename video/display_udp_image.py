@@ -1,30 +1,78 @@
-#!/usr/bin/env python
-'''
-script to display jpeg images coming in over UDP
-'''
-
-import cv2
-import socket
-import numpy
-import argparse
-from MAVProxy.modules.lib import multiproc
-from MAVProxy.modules.lib import mp_image
-
-if __name__ == '__main__':
-    multiproc.freeze_support()
-
-    ap = argparse.ArgumentParser()
-    ap.add_argument("--port", type=int, default=60050)
-    ap.add_argument("--title", type=str, default='UDP Images')
-    args = ap.parse_args()
-
-    viewer = mp_image.MPImage(title=args.title, width=200, height=200, auto_size=True)
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-    sock.bind(('', args.port))
-
-    while True:
-        p = sock.recv(80000)
-        img = cv2.imdecode(numpy.fromstring(p, dtype=numpy.uint8), -1)
-        viewer.set_image(img)
+#!/usr/bin/env python
+'''
+script to display jpeg images coming in over UDP
+
+Frames that grab.py puts into a shared memory ring on this host are
+shown in preference, falling back to UDP while there is no ring.
+'''
+
+import time
+import argparse
+from MAVProxy.modules.lib import multiproc
+from MAVProxy.modules.lib import mp_image
+
+from receiver import FrameReceiver
+from shmring import RingReceiver, ring_name
+
+if __name__ == '__main__':
+    multiproc.freeze_support()
+
+    ap = argparse.ArgumentParser()
+    ap.add_argument("--port", type=int, default=60050)
+    ap.add_argument("--title", type=str, default='UDP Images')
+    ap.add_argument("--slots", type=int, default=4, help="frame buffers")
+    ap.add_argument("--deadline", type=float, default=0.2,
+                    help="seconds before an incomplete frame is discarded")
+    ap.add_argument("--transport", type=str, default="auto",
+                    choices=["auto", "udp", "shm"])
+    args = ap.parse_args()
+
+    viewer = mp_image.MPImage(title=args.title, width=200, height=200, auto_size=True)
+
+    receiver = None
+    local = None
+    if args.transport != "shm":
+        receiver = FrameReceiver(args.port, slots=args.slots,
+                                 deadline=args.deadline).start()
+    if args.transport != "udp":
+        local = RingReceiver(ring_name(args.port))
+
+    last_print_s = time.time()
+    while True:
+        frame = None
+        source = local
+        if local is not None:
+            wait = receiver is None or local.active
+            frame = local.get_frame(timeout=0.1 if wait else 0)
+        if frame is None and receiver is not None:
+            source = receiver
+            wait = local is None or not local.active
+            frame = receiver.get_frame(timeout=0.1 if wait else 0)
+        if frame is not None:
+            img, timestamp = frame
+            viewer.set_image(img)
+            source.displayed_frame(timestamp)
+        now = time.time()
+        if now - last_print_s >= 1.0:
+            dt = now - last_print_s
+            if local is not None and local.active:
+                s = local.stats()
+                print("%.1f FPS latency %.1f/%.1f ms shared memory skipped %u "
+                      "overwritten %u" % (
+                          local.displayed / dt, s["latency_mean_ms"],
+                          s["latency_max_ms"], s["skipped"],
+                          s["overwritten"]))
+            elif receiver is not None:
+                s = receiver.stats()
+                print("%.1f FPS latency %.1f/%.1f ms network %.1f ms dropped %u "
+                      "incomplete %u lost %u errors %u" % (
+                          receiver.displayed / dt, s["latency_mean_ms"],
+                          s["latency_max_ms"], s["network_mean_ms"],
+                          s["dropped"], s["incomplete"], s["skipped"],
+                          s["errors"]))
+                receiver.network.reset()
+            for r in (receiver, local):
+                if r is not None:
+                    r.displayed = 0
+                    r.latency.reset()
+            last_print_s = now
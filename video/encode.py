@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+'''
+jpeg encoding with closed-loop quality and resolution control
+'''
+
+import cv2
+
+
+class JpegEncoder(object):
+    '''encode images as jpeg at an adjustable quality and scale
+
+    quality and scale may be changed from another thread at any time;
+    every encode() uses the values current when it starts. cv2 releases
+    the GIL while encoding, so one encoder can serve several threads.
+    '''
+
+    def __init__(self, quality=80, scale=1.0):
+        self.quality = quality
+        self.scale = scale
+
+    def __call__(self, img):
+        return self.encode(img)
+
+    def encode(self, img, scale=None):
+        '''encode img, resized by scale or by the current scale'''
+        if scale is None:
+            scale = self.scale
+        if scale < 1.0:
+            h, w = img.shape[:2]
+            size = (max(1, int(w * scale)), max(1, int(h * scale)))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+        result, encimg = cv2.imencode(
+            '.jpg', img, [int(cv2.IMWRITE_JPEG_QUALITY), int(self.quality)])
+        if not result:
+            raise ValueError("jpeg encode failed")
+        return encimg
+
+
+class RateController(object):
+    '''steer a JpegEncoder towards a byte rate and a frame-time budget
+
+    update() is fed the stats of CaptureStream.report() once per period.
+    Above the target byte rate quality is lowered in proportion to the
+    overshoot; once quality is at its floor, resolution is lowered
+    instead. Below the target, resolution is restored first and quality
+    raised after. When encoding and sending a frame takes longer than
+    budget_ms, or frames are dropped for lack of encode throughput,
+    resolution is lowered since encode time scales with pixel count, and
+    it is restored once the budget would still hold at the larger size.
+    '''
+
+    def __init__(self, encoder, target_kbps=None, budget_ms=None,
+                 min_quality=20, max_quality=95, min_scale=0.25,
+                 scale_step=0.1, tolerance=0.1):
+        self.encoder = encoder
+        self.target_kbps = target_kbps
+        self.budget_ms = budget_ms
+        self.min_quality = min_quality
+        self.max_quality = max_quality
+        self.min_scale = min_scale
+        self.scale_step = scale_step
+        self.tolerance = tolerance
+
+    def _scale_by(self, step):
+        e = self.encoder
+        e.scale = min(1.0, max(self.min_scale, round(e.scale + step, 3)))
+
+    def update(self, report):
+        e = self.encoder
+        frame_ms = report["encode_ms"] + report["send_ms"]
+        if self.budget_ms is not None and (frame_ms > self.budget_ms or
+                                           report["dropped"]):
+            self._scale_by(-self.scale_step)
+            return
+
+        if not report["fps"]:
+            return
+        # frame bytes and encode time grow about with the square of the
+        # scale
+        grown = (e.scale + self.scale_step) ** 2 / e.scale ** 2
+        headroom = self.budget_ms is None or \
+            frame_ms * grown < self.budget_ms
+        if not self.target_kbps:
+            if e.scale < 1.0 and headroom:
+                self._scale_by(self.scale_step)
+            return
+        ratio = report["kbyte_per_s"] / self.target_kbps
+        if ratio > 1.0 + self.tolerance:
+            if e.quality > self.min_quality:
+                step = min(15, max(2, int(20 * (ratio - 1.0))))
+                e.quality = max(self.min_quality, e.quality - step)
+            else:
+                self._scale_by(-self.scale_step)
+        elif ratio < 1.0 - self.tolerance:
+            if e.scale < 1.0 and ratio * grown < 1.0 and headroom:
+                self._scale_by(self.scale_step)
+            elif e.quality < self.max_quality:
+                step = min(10, max(1, int(10 * (1.0 - ratio))))
+                e.quality = min(self.max_quality, e.quality + step)
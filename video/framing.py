@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+'''
+fragmented, sequenced UDP framing for image streams
+
+Every datagram carries a fixed header followed by one fragment of a
+frame:
+
+  magic     2s  b'TK'
+  version   B
+  flags     B   FLAG_* bits, passed through to the receiver
+  frame_id  I   increases by one per frame
+  index     H   fragment index
+  count     H   fragments in this frame
+  timestamp d   sender time.time() when the frame was captured
+  size      I   frame length in bytes
+  offset    I   position of this fragment in the frame
+
+all in network byte order.
+'''
+
+import socket
+import struct
+import threading
+import time
+
+HEADER = struct.Struct("!2sBBIHHdII")
+MAGIC = b'TK'
+VERSION = 1
+FLAG_KEYFRAME = 1
+
+# keeps datagrams below a typical 1500 byte MTU so the IP layer never
+# fragments them; losing one IP fragment would lose the whole datagram
+DEFAULT_PAYLOAD = 1400 - HEADER.size
+MAX_DATAGRAM = 65507
+
+
+class FrameSender(object):
+    '''split frames into datagrams on a connected UDP socket'''
+
+    def __init__(self, sock, payload=DEFAULT_PAYLOAD):
+        if payload + HEADER.size > MAX_DATAGRAM:
+            raise ValueError("payload %u too large" % payload)
+        self.sock = sock
+        self.payload = payload
+        self.frame_id = 0
+        self.header = bytearray(HEADER.size)
+        self.packet = bytearray(HEADER.size + payload)
+        self.frames = 0
+        self.datagrams = 0
+        self.bytes = 0
+        self.use_sendmsg = hasattr(sock, "sendmsg")
+
+    def send(self, data, timestamp=None, flags=0):
+        '''send one frame; data is any bytes-like object'''
+        if timestamp is None:
+            timestamp = time.time()
+        view = memoryview(data).cast("B")
+        size = len(view)
+        payload = self.payload
+        count = max(1, -(-size // payload))
+        if count > 0xffff:
+            raise ValueError("frame of %u bytes needs too many fragments" % size)
+        frame_id = self.frame_id
+        self.frame_id = (frame_id + 1) & 0xffffffff
+        for index in range(count):
+            offset = index * payload
+            chunk = view[offset:offset + payload]
+            if self.use_sendmsg:
+                HEADER.pack_into(self.header, 0, MAGIC, VERSION, flags,
+                                 frame_id, index, count, timestamp, size,
+                                 offset)
+                self.sock.sendmsg([self.header, chunk])
+            else:
+                HEADER.pack_into(self.packet, 0, MAGIC, VERSION, flags,
+                                 frame_id, index, count, timestamp, size,
+                                 offset)
+                n = HEADER.size + len(chunk)
+                self.packet[HEADER.size:n] = chunk
+                self.sock.send(memoryview(self.packet)[:n])
+            self.bytes += HEADER.size + len(chunk)
+        self.datagrams += count
+        self.frames += 1
+        return frame_id
+
+
+class Frame(object):
+    '''a complete or partially received frame in a reassembly slot'''
+
+    __slots__ = ("slot", "frame_id", "flags", "size", "count", "received",
+                 "timestamp", "first_s")
+
+    def __init__(self, slot):
+        self.slot = slot
+
+
+class Reassembler(object):
+    '''rebuild frames from datagrams in preallocated slot buffers
+
+    Fragments are copied straight to their offset in the slot of their
+    frame, so a frame is never joined from pieces. Completed frames are
+    returned as (Frame, memoryview) and keep their slot until release()
+    is called. A partial frame is discarded when a newer frame
+    completes, when it is older than deadline seconds, or when its slot
+    is needed for a newer frame.
+    '''
+
+    def __init__(self, slots=4, max_frame=1 << 22, deadline=0.2,
+                 max_fragments=8192):
+        self.deadline = deadline
+        self.max_frame = max_frame
+        self.buffers = [bytearray(max_frame) for i in range(slots)]
+        self.views = [memoryview(b) for b in self.buffers]
+        self.seen = [bytearray(max_fragments) for i in range(slots)]
+        self.zeros = memoryview(bytes(max_fragments))
+        self.free = [Frame(i) for i in range(slots)]
+        self.partial = {}  # frame_id -> Frame
+        self.lock = threading.Lock()
+        self.last_id = None  # newest completed frame
+        self.last_timestamp = 0.0
+        self.completed = 0
+        self.incomplete = 0  # partial frames given up on
+        self.late = 0  # fragments of frames older than the newest one
+        self.duplicates = 0
+        self.invalid = 0
+        self.skipped = 0  # frame ids between completed frames, lost
+
+    def release(self, frame):
+        '''return the slot of a completed frame'''
+        with self.lock:
+            self.free.append(frame)
+
+    def _discard(self, frame):
+        del self.partial[frame.frame_id]
+        self.incomplete += 1
+        self.free.append(frame)
+
+    def _open(self, frame_id, flags, count, timestamp, size, now):
+        with self.lock:
+            for old in list(self.partial.values()):
+                if now - old.first_s > self.deadline:
+                    self._discard(old)
+            if not self.free:
+                # give the oldest partial frame's slot to this one
+                self._discard(min(self.partial.values(),
+                                  key=lambda f: f.frame_id))
+            if not self.free:
+                return None
+            frame = self.free.pop()
+        self.seen[frame.slot][:count] = self.zeros[:count]
+        frame.frame_id = frame_id
+        frame.flags = flags
+        frame.size = size
+        frame.count = count
+        frame.received = 0
+        frame.timestamp = timestamp
+        frame.first_s = now
+        self.partial[frame_id] = frame
+        return frame
+
+    def add(self, packet, now=None):
+        '''add one datagram; returns (Frame, memoryview) when it
+        completes a frame, else None'''
+        if len(packet) < HEADER.size:
+            self.invalid += 1
+            return None
+        (magic, version, flags, frame_id, index, count, timestamp, size,
+         offset) = HEADER.unpack_from(packet)
+        payload = len(packet) - HEADER.size
+        if (magic != MAGIC or version != VERSION or index >= count or
+                count > len(self.zeros) or size > self.max_frame or
+                offset + payload > size):
+            self.invalid += 1
+            return None
+        if now is None:
+            now = time.time()
+
+        last = self.last_id
+        if last is not None and frame_id <= last:
+            if timestamp <= self.last_timestamp:
+                self.late += 1
+                return None
+            # captured later under a lower id: sender restarted or the id
+            # wrapped around
+            self.last_id = None
+
+        frame = self.partial.get(frame_id)
+        if frame is None:
+            frame = self._open(frame_id, flags, count, timestamp, size, now)
+            if frame is None:
+                return None
+        seen = self.seen[frame.slot]
+        if seen[index]:
+            self.duplicates += 1
+            return None
+        seen[index] = 1
+        self.views[frame.slot][offset:offset + payload] = \
+            memoryview(packet)[HEADER.size:]
+        frame.received += 1
+        if frame.received < frame.count:
+            return None
+
+        # complete: anything older is now stale
+        del self.partial[frame_id]
+        with self.lock:
+            for old in [f for f in self.partial.values()
+                        if f.frame_id < frame_id]:
+                self._discard(old)
+        if self.last_id is not None:
+            self.skipped += max(0, frame_id - self.last_id - 1)
+        self.last_id = frame_id
+        self.last_timestamp = frame.timestamp
+        self.completed += 1
+        return frame, self.views[frame.slot][:frame.size]
+
+    def stats(self):
+        return {
+            "completed": self.completed,
+            "incomplete": self.incomplete,
+            "late": self.late,
+            "duplicates": self.duplicates,
+            "invalid": self.invalid,
+            "skipped": self.skipped,
+        }
+
+
+def connect(host, port, sndbuf=1 << 22):
+    '''return a UDP socket connected to host:port for FrameSender'''
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, sndbuf)
+    except OSError:
+        pass
+    sock.connect((host, port))
+    return sock
@@ -1,56 +1,112 @@
-#!/usr/bin/env python
-'''
-script to capture a region of a screen and send as jpg images over UDP
-to another host. This provides very low latency screen forwarding
-'''
-import d3dshot
-import time
-import cv2
-import socket
-import argparse
-import sys
-
-ap = argparse.ArgumentParser()
-ap.add_argument("--host", type=str, default=None, required=True)
-ap.add_argument("--port", type=int, default=60050)
-ap.add_argument("--region", type=str, default="0,52,300,412")
-ap.add_argument("--rate", type=int, default=50)
-ap.add_argument("--quality", type=int, default=80)
-
-args = ap.parse_args()
-
-usock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-usock.connect((args.host, args.port))
-
-region = args.region.split(',')
-if len(region) != 4:
-    print("Region must be 'x,y,width,height'")
-    sys.exit(1)
-region = (int(region[0]),int(region[1]),int(region[2]),int(region[3]))
-
-d = d3dshot.create(capture_output="numpy")
-
-last_print_s = time.time()
-count = 0
-target_dt = 1.0 / args.rate
-total_size = 0
-
-while True:
-    t1 = time.time()
-    img = d.screenshot(region=region)
-    encode_param = [int(cv2.IMWRITE_PNG_COMPRESSION), args.quality]
-    result, encimg = cv2.imencode('.jpg', img, encode_param)
-    total_size += len(encimg)
-    usock.send(encimg)
-    t2 = time.time()
-    dt = t2 - t1
-    if dt < target_dt:
-        time.sleep(target_dt - dt)
-    count += 1
-    now = time.time()
-    if now - last_print_s >= 1.0:
-        dt = now - last_print_s
-        print("%.1f FPS %.1f kByte/sec" % (count/dt, (total_size/1024.0)/dt))
-        last_print_s = now
-        count = 0
-        total_size = 0
\ No newline at end of file
+#!/usr/bin/env python
+'''
+script to capture a region of a screen and send as jpg images over UDP
+to another host. This provides very low latency screen forwarding
+
+When the host is this machine, raw frames are put into a shared memory
+ring instead, see shmring.py.
+'''
+import time
+import argparse
+import sys
+
+import numpy
+
+from capture import BACKENDS, create_backend, parse_region
+from encode import JpegEncoder, RateController
+from framing import DEFAULT_PAYLOAD, FrameSender, connect
+from shmring import FrameRing, is_local, ring_name
+from stream import CaptureStream
+from tiles import TileEncoder
+
+ap = argparse.ArgumentParser()
+ap.add_argument("--host", type=str, default=None, required=True)
+ap.add_argument("--port", type=int, default=60050)
+ap.add_argument("--region", type=str, default="0,52,300,412")
+ap.add_argument("--rate", type=int, default=50)
+ap.add_argument("--quality", type=int, default=80)
+ap.add_argument("--backend", type=str, default="auto",
+                choices=["auto"] + sorted(BACKENDS))
+ap.add_argument("--payload", type=int, default=DEFAULT_PAYLOAD,
+                help="bytes of frame data per datagram")
+ap.add_argument("--queue", type=int, default=2,
+                help="frames buffered between capture and encode")
+ap.add_argument("--workers", type=int, default=2, help="encode threads")
+ap.add_argument("--target-kbps", type=float, default=None,
+                help="adapt quality and resolution to this kByte/sec")
+ap.add_argument("--budget-ms", type=float, default=None,
+                help="encode and send time allowed per frame")
+ap.add_argument("--min-quality", type=int, default=20)
+ap.add_argument("--min-scale", type=float, default=0.25)
+ap.add_argument("--tiles", type=int, default=0,
+                help="send only changed tiles of this size in pixels")
+ap.add_argument("--keyframe", type=int, default=50,
+                help="frames between full frames in tile mode")
+ap.add_argument("--transport", type=str, default="auto",
+                choices=["auto", "udp", "shm"],
+                help="shm passes raw frames through shared memory to "
+                "consumers on this host; auto uses it when --host is local")
+ap.add_argument("--ring-slots", type=int, default=4,
+                help="frames in the shared memory ring")
+
+args = ap.parse_args()
+
+try:
+    region = parse_region(args.region)
+except ValueError as e:
+    print(e)
+    sys.exit(1)
+
+backend = create_backend(args.backend, region)
+transport = args.transport
+if transport == "auto":
+    transport = "shm" if is_local(args.host) else "udp"
+encoder = JpegEncoder(args.quality)
+controller = None
+ring = None
+if transport == "shm":
+    # raw frames, nothing to encode or rate control
+    ring = FrameRing(ring_name(args.port), args.ring_slots,
+                     region[2] * region[3] * 3)
+    encode = numpy.asarray
+    send = ring.put
+    workers = 1
+else:
+    sender = FrameSender(connect(args.host, args.port), args.payload)
+    encode = encoder
+    send = sender.send
+    workers = args.workers
+    if args.target_kbps or args.budget_ms:
+        controller = RateController(
+            encoder, args.target_kbps, args.budget_ms,
+            min_quality=args.min_quality,
+            max_quality=max(args.quality, args.min_quality),
+            min_scale=args.min_scale)
+    if args.tiles:
+        # deltas depend on the previous frame, so encode in order
+        encode = TileEncoder(encoder, args.tiles, args.keyframe)
+        workers = 1
+
+stream = CaptureStream(backend, encode, send, args.rate,
+                       args.queue, workers).start()
+print("capturing with %s to %s" % (backend.name, transport))
+
+try:
+    while True:
+        time.sleep(1.0)
+        r = stream.report()
+        print("%.1f FPS %.1f kByte/sec capture %.1f ms encode %.1f ms "
+              "send %.1f ms dropped %u errors %u quality %u scale %.2f" % (
+                  r["fps"], r["kbyte_per_s"], r["capture_ms"], r["encode_ms"],
+                  r["send_ms"], r["dropped"], r["errors"], encoder.quality,
+                  encoder.scale))
+        if isinstance(encode, TileEncoder):
+            print("keyframes %u deltas %u tiles %u" % (
+                encode.keyframes, encode.deltas, encode.tiles_sent))
+            encode.keyframes = encode.deltas = encode.tiles_sent = 0
+        if controller is not None:
+            controller.update(r)
+finally:
+    if ring is not None:
+        # consumers keep their mapping, the name goes
+        ring.close()
@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+'''
+receive jpeg images over UDP without per-frame allocation and decode
+only the newest one on a worker thread
+
+Tile deltas from tiles.TileEncoder are composited onto the last
+keyframe, so the sender may switch between full frames and deltas
+without the receiver being told. Every delta reaches the canvas, even
+one that is never displayed.
+'''
+
+import collections
+import socket
+import threading
+import time
+
+import cv2
+
+from framing import MAX_DATAGRAM, Reassembler
+from tiles import TileCompositor, is_delta
+
+
+class LatencyStats(object):
+    '''running latency in seconds'''
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, dt):
+        self.count += 1
+        self.total += dt
+        if dt > self.max:
+            self.max = dt
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+
+class FrameReceiver(object):
+    '''UDP jpeg receiver on top of the framing protocol
+
+    The receive thread reads every datagram with recv_into into one
+    packet buffer and feeds it to a Reassembler, whose preallocated
+    slots hold the frames. A completed jpeg frame drops every frame
+    queued before it, as does a decoded image replaced before
+    get_frame() collects it, so the consumer always gets the newest
+    image and never a backlog. Tile deltas queued behind a newer frame
+    are composited but not displayed, since the sender assumes the
+    canvas has their tiles. When more frames are queued than the slots
+    allow, the oldest are copied out of their slots; only beyond
+    backlog queued frames is a delta lost, counted in lost_deltas, and
+    the canvas stays stale until the next keyframe.
+
+    Latency is measured from the sender's capture timestamp, so across
+    hosts it is only as good as their clock synchronisation.
+    '''
+
+    def __init__(self, port, host='', slots=4, max_frame=1 << 22,
+                 deadline=0.2, timeout=0.5, rcvbuf=1 << 22,
+                 decode_flags=cv2.IMREAD_UNCHANGED, backlog=64):
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+        except OSError:
+            pass
+        self.sock.bind((host, port))
+        self.sock.settimeout(timeout)
+        self.decode_flags = decode_flags
+        # only used by the decode thread
+        self.compositor = TileCompositor(decode_flags)
+        # latest and decoding each hold one slot, one more is filling
+        self.reassembler = Reassembler(max(slots, 3), max_frame, deadline)
+        # frames waiting for the decode thread, oldest first, as (Frame,
+        # memoryview, capture time), or (None, bytes, capture time) once
+        # copied out of the slot
+        self.queue = collections.deque()
+        self.backlog = backlog
+        # queued frames in slots; one slot is left for decoding and one
+        # for filling
+        self.held = 0
+        self.max_held = max(slots, 3) - 2
+        self.packet = bytearray(MAX_DATAGRAM)
+        self.cond = threading.Condition()
+        self.image = None  # (image, capture time)
+        self.running = False
+        self.threads = []
+        self.received = 0
+        self.decoded = 0
+        self.displayed = 0
+        self.dropped = 0  # replaced before decode or before display
+        self.lost_deltas = 0  # deltas dropped from a full queue
+        self.errors = 0  # undecodable frames, or deltas without keyframe
+        self.network = LatencyStats()  # capture to last fragment
+        self.latency = LatencyStats()  # capture to display
+
+    @property
+    def address(self):
+        return self.sock.getsockname()
+
+    def start(self):
+        self.running = True
+        for target in (self._receive_loop, self._decode_loop):
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.running = False
+        with self.cond:
+            self.cond.notify_all()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        self.sock.close()
+
+    def _unqueue(self):
+        '''drop the oldest queued frame'''
+        frame, data, timestamp = self.queue.popleft()
+        if frame is not None:
+            self.reassembler.release(frame)
+            self.held -= 1
+        self.dropped += 1
+        return data
+
+    def _spill(self):
+        '''copy the oldest queued frames out of their slots until a slot
+        is free for the next frame'''
+        queue = self.queue
+        for i, (frame, data, timestamp) in enumerate(queue):
+            if self.held < self.max_held:
+                break
+            if frame is not None:
+                queue[i] = (None, bytes(data), timestamp)
+                self.reassembler.release(frame)
+                self.held -= 1
+
+    def _publish(self, frame, data, t):
+        '''queue a completed frame for the decode thread'''
+        with self.cond:
+            queue = self.queue
+            if not is_delta(data):
+                # a full frame replaces everything before it
+                while queue:
+                    self._unqueue()
+            else:
+                if len(queue) >= self.backlog:
+                    if is_delta(self._unqueue()):
+                        self.lost_deltas += 1
+                self._spill()
+            queue.append((frame, data, frame.timestamp))
+            self.held += 1
+            self.received += 1
+            self.network.record(t - frame.timestamp)
+            self.cond.notify()
+
+    def _receive_loop(self):
+        view = memoryview(self.packet)
+        reassembler = self.reassembler
+        while self.running:
+            try:
+                n = self.sock.recv_into(view)
+            except socket.timeout:
+                continue
+            except OSError:
+                if not self.running:
+                    break
+                raise
+            now = time.time()
+            done = reassembler.add(view[:n], now)
+            if done is not None:
+                self._publish(done[0], done[1], now)
+
+    def decode(self, data):
+        '''decode a jpeg or tile delta without copying the frame data'''
+        return self.compositor.decode(data)
+
+    def _decode_loop(self):
+        while True:
+            with self.cond:
+                while not self.queue and self.running:
+                    self.cond.wait()
+                if not self.running:
+                    break
+                frame, data, timestamp = self.queue.popleft()
+                if frame is not None:
+                    self.held -= 1
+                # only deltas queue behind a frame, so a superseded one
+                # still has to reach the canvas
+                superseded = bool(self.queue)
+            try:
+                if superseded:
+                    img = None
+                    ok = self.compositor.apply(data)
+                else:
+                    img = self.decode(data)
+                    ok = img is not None
+            finally:
+                if frame is not None:
+                    self.reassembler.release(frame)
+            if not ok:
+                self.errors += 1
+                continue
+            if superseded:
+                self.dropped += 1
+                continue
+            with self.cond:
+                if self.image is not None:
+                    self.dropped += 1
+                self.image = (img, timestamp)
+                self.decoded += 1
+                self.cond.notify_all()
+
+    def get_frame(self, timeout=None):
+        '''return (image, capture time) of the newest decoded frame, or
+        None if no new frame arrived within timeout'''
+        with self.cond:
+            if self.image is None and timeout:
+                self.cond.wait_for(lambda: self.image is not None or
+                                   not self.running, timeout)
+            frame, self.image = self.image, None
+        return frame
+
+    def displayed_frame(self, timestamp):
+        '''record that the frame captured at timestamp is on screen'''
+        self.displayed += 1
+        self.latency.record(time.time() - timestamp)
+
+    def stats(self):
+        s = {
+            "received": self.received,
+            "decoded": self.decoded,
+            "displayed": self.displayed,
+            "dropped": self.dropped,
+            "lost_deltas": self.lost_deltas,
+            "errors": self.errors,
+            "missing_keyframe": self.compositor.missing_keyframe,
+            "network_mean_ms": self.network.mean * 1e3,
+            "network_max_ms": self.network.max * 1e3,
+            "latency_mean_ms": self.latency.mean * 1e3,
+            "latency_max_ms": self.latency.max * 1e3,
+        }
+        s.update(self.reassembler.stats())
+        return s
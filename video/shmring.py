@@ -0,0 +1,290 @@
+#!/usr/bin/env python
+'''
+raw frames in a shared memory ring, for capture and consumers on one host
+
+The writer copies every frame into the next of a fixed number of slots
+and consumers map the newest slot without copying or decoding. Each
+slot carries a sequence number that is odd while the slot is being
+written, as in a seqlock: a reader checks it before and after using a
+frame to know that the writer did not overwrite the slot meanwhile.
+With N slots a consumer has N - 1 frame periods to finish with a
+frame. The writer never waits for readers, so a slow consumer only
+skips frames.
+
+The block is laid out as
+
+  header    4 uint64   magic, slots, slot bytes, frames written
+  sequence  slots uint64
+  shape     slots x 3 uint32
+  timestamp slots float64
+  data      slots x slot bytes
+'''
+
+import socket
+import time
+
+import numpy
+from multiprocessing import shared_memory
+
+from receiver import LatencyStats
+
+MAGIC = 0x54414b4152494e47  # TAKARING
+HEADER_WORDS = 4
+
+# rings created by this process, which its resource tracker owns
+_created = set()
+
+
+def ring_name(port):
+    '''ring name used in place of UDP port port on the local host'''
+    return "taka_video_%u" % port
+
+
+def is_local(host):
+    '''whether host is this machine'''
+    try:
+        address = socket.gethostbyname(host)
+    except socket.error:
+        return False
+    if address.startswith("127."):
+        return True
+    try:
+        return address in socket.gethostbyname_ex(socket.gethostname())[2]
+    except socket.error:
+        return False
+
+
+def _layout(slots, slot_bytes):
+    return (("header", numpy.uint64, (HEADER_WORDS,)),
+            ("sequence", numpy.uint64, (slots,)),
+            ("shape", numpy.uint32, (slots, 3)),
+            ("timestamp", numpy.float64, (slots,)),
+            ("data", numpy.uint8, (slots, slot_bytes)))
+
+
+def _attach(name):
+    '''open an existing block without handing it to this process's
+    resource tracker, which would unlink it when a reader exits'''
+    try:
+        return shared_memory.SharedMemory(name=name, track=False)
+    except TypeError:
+        # before python 3.13 attaching always registers the block
+        from multiprocessing import resource_tracker
+        shm = shared_memory.SharedMemory(name=name)
+        if name not in _created:
+            resource_tracker.unregister(shm._name, "shared_memory")
+        return shm
+
+
+class FrameRing(object):
+    '''ring of frame slots in one shared memory block
+
+    Create the ring in the writer with FrameRing(name, slots, slot_bytes)
+    and open it in consumers with FrameRing.attach(name).
+    '''
+
+    def __init__(self, name, slots=4, slot_bytes=None, shm=None):
+        if shm is None:
+            try:
+                # a writer that died left its ring behind
+                stale = shared_memory.SharedMemory(name=name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+            size = sum(numpy.dtype(dtype).itemsize * int(numpy.prod(shape))
+                       for _, dtype, shape in _layout(slots, slot_bytes))
+            shm = shared_memory.SharedMemory(name=name, create=True, size=size)
+            _created.add(name)
+            self.owner = True
+        else:
+            header = numpy.ndarray((HEADER_WORDS,), numpy.uint64, shm.buf)
+            if header[0] != MAGIC:
+                shm.close()
+                raise ValueError("%s is not a frame ring" % name)
+            slots, slot_bytes = int(header[1]), int(header[2])
+            del header
+            self.owner = False
+        self.shm = shm
+        self.name = name
+        self.slots = slots
+        self.slot_bytes = slot_bytes
+        offset = 0
+        for column, dtype, shape in _layout(slots, slot_bytes):
+            array = numpy.ndarray(shape, dtype=dtype, buffer=shm.buf,
+                                  offset=offset)
+            offset += array.nbytes
+            setattr(self, column, array)
+        if self.owner:
+            self.sequence[:] = 0
+            self.header[:] = (MAGIC, slots, slot_bytes, 0)
+
+    @classmethod
+    def attach(cls, name):
+        '''open the ring a writer created; raises FileNotFoundError if
+        there is none'''
+        return cls(name, shm=_attach(name))
+
+    @property
+    def count(self):
+        '''frames written so far'''
+        return int(self.header[3])
+
+    def put(self, img, timestamp=None):
+        '''copy img into the next slot and publish it'''
+        if img.nbytes > self.slot_bytes:
+            raise ValueError("frame of %u bytes does not fit %u byte slots" %
+                             (img.nbytes, self.slot_bytes))
+        if timestamp is None:
+            timestamp = time.time()
+        count = self.count
+        i = count % self.slots
+        self.sequence[i] = 2 * count + 1
+        shape = img.shape + (1,) * (3 - img.ndim)
+        self.data[i, :img.nbytes].reshape(shape)[...] = img.reshape(shape)
+        self.shape[i] = shape
+        self.timestamp[i] = timestamp
+        self.sequence[i] = 2 * count + 2
+        self.header[3] = count + 1
+
+    def latest(self, timeout=0.01):
+        '''return (image view, timestamp, frame number) of the newest
+        frame, or None before the first one or if no slot stays intact
+        for timeout seconds
+
+        The view points into the ring; check valid(frame number) after
+        using it.
+        '''
+        deadline = None
+        while True:
+            count = self.count
+            if count == 0:
+                return None
+            i = (count - 1) % self.slots
+            if self.sequence[i] == 2 * count:
+                height, width, channels = (int(v) for v in self.shape[i])
+                timestamp = float(self.timestamp[i])
+                img = self.data[i, :height * width * channels].reshape(
+                    height, width, channels)
+                if self.sequence[i] == 2 * count:
+                    return img, timestamp, count
+            # the writer moved on, or is rewriting the newest slot as
+            # with a single slot; a writer that died there never finishes
+            now = time.time()
+            if deadline is None:
+                deadline = now + timeout
+            elif now > deadline:
+                return None
+
+    def valid(self, count):
+        '''whether frame count is still unchanged in its slot'''
+        return self.sequence[(count - 1) % self.slots] == 2 * count
+
+    def close(self):
+        for column, dtype, shape in _layout(self.slots, self.slot_bytes):
+            delattr(self, column)
+        try:
+            self.shm.close()
+        except BufferError:
+            pass  # a consumer still holds a frame; unmapped with it
+        if self.owner:
+            self.shm.unlink()
+            _created.discard(self.name)
+
+
+class RingReceiver(object):
+    '''consumer side of a FrameRing with the interface of FrameReceiver
+
+    The ring is attached when it appears and dropped when no frame has
+    arrived for stale seconds, so a writer that restarts is picked up
+    again.
+    '''
+
+    def __init__(self, name, poll=0.001, stale=1.0):
+        self.name = name
+        self.poll = poll
+        self.stale = stale
+        self.ring = None
+        self.last_count = 0
+        self.last_frame_s = 0.0
+        self.last_attach_s = 0.0
+        self.received = 0
+        self.displayed = 0
+        self.skipped = 0  # frames written but never collected
+        self.overwritten = 0  # frames the writer replaced while in use
+        self.pending = None
+        self.latency = LatencyStats()
+
+    @property
+    def active(self):
+        '''whether a writer is currently delivering frames'''
+        return self.ring is not None and \
+            time.time() - self.last_frame_s < self.stale
+
+    def _attach(self):
+        now = time.time()
+        if now - self.last_attach_s < self.stale:
+            return False
+        self.last_attach_s = now
+        try:
+            self.ring = FrameRing.attach(self.name)
+        except (FileNotFoundError, ValueError):
+            return False
+        self.last_count = self.ring.count
+        self.last_frame_s = now
+        return True
+
+    def get_frame(self, timeout=None):
+        '''return (image view, capture time) of the newest frame, or None
+        if no new frame arrived within timeout'''
+        deadline = time.time() + (timeout or 0)
+        while True:
+            if self.ring is None:
+                self._attach()
+            if self.ring is not None:
+                frame = self.ring.latest()
+                if frame is not None and frame[2] != self.last_count:
+                    img, timestamp, count = frame
+                    self.skipped += count - self.last_count - 1
+                    self.last_count = count
+                    self.last_frame_s = time.time()
+                    self.received += 1
+                    self.pending = count
+                    return img, timestamp
+                if time.time() - self.last_frame_s > self.stale:
+                    self.close()
+            if time.time() >= deadline:
+                return None
+            time.sleep(self.poll)
+
+    def frame_valid(self):
+        '''whether the frame last returned by get_frame() was left intact
+        while it was used; call once done with it'''
+        valid = self.pending is None or (self.ring is not None and
+                                         self.ring.valid(self.pending))
+        if not valid:
+            self.overwritten += 1
+        self.pending = None
+        return valid
+
+    def displayed_frame(self, timestamp):
+        '''record that the frame captured at timestamp is on screen'''
+        self.displayed += 1
+        self.latency.record(time.time() - timestamp)
+        self.frame_valid()
+
+    def stats(self):
+        return {
+            "received": self.received,
+            "displayed": self.displayed,
+            "skipped": self.skipped,
+            "overwritten": self.overwritten,
+            "latency_mean_ms": self.latency.mean * 1e3,
+            "latency_max_ms": self.latency.max * 1e3,
+        }
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
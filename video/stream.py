@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+'''
+capture, encode and send as pipeline stages on separate threads
+'''
+
+import queue
+import sys
+import threading
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+
+from receiver import LatencyStats
+
+
+class CaptureStream(object):
+    '''grab frames at a fixed rate and hand them to encode and send
+
+    The capture thread grabs on an absolute time grid and puts
+    (image, timestamp) into a bounded queue. The output thread encodes
+    and sends. When encoding falls behind, the oldest queued frame is
+    dropped instead of delaying the next capture, so the capture rate
+    holds and the sender always works on recent frames.
+
+    With more than one worker, frames are encoded in parallel on a
+    thread pool and a send thread sends them in capture order. This
+    only pays off when encode releases the GIL, as cv2.imencode does.
+
+    A frame whose encode or send raises is counted in errors and
+    skipped; the first failure of each report period prints its
+    traceback.
+
+    Args:
+        backend: CaptureBackend to grab from.
+        encode: function image -> bytes-like object.
+        send: function (data, timestamp) called with every encoded frame.
+            data may also be a numpy array, such as a raw frame.
+        rate: capture rate in frames per second.
+        queue_size: frames buffered between capture and encode.
+        workers: encode threads.
+    '''
+
+    def __init__(self, backend, encode, send, rate, queue_size=2,
+                 workers=1):
+        self.backend = backend
+        self.encode = encode
+        self.send = send
+        self.period = 1.0 / rate
+        self.queue = queue.Queue(queue_size)
+        self.workers = workers
+        self.pool = ThreadPoolExecutor(workers) if workers > 1 else None
+        # encodes in flight, in capture order
+        self.encoded = queue.Queue(workers)
+        self.running = False
+        self.threads = []
+        self.capture_stats = LatencyStats()
+        self.encode_stats = LatencyStats()
+        self.send_stats = LatencyStats()
+        self.captured = 0
+        self.sent = 0
+        self.dropped = 0
+        self.late = 0  # captures that missed their slot
+        self.errors = 0  # frames that failed to encode or send
+        self.bytes = 0
+        self.last_report = time.time()
+
+    def start(self):
+        self.running = True
+        targets = [self._capture_loop, self._output_loop]
+        if self.pool is not None:
+            targets.append(self._send_loop)
+        for target in targets:
+            t = threading.Thread(target=target)
+            t.daemon = True
+            t.start()
+            self.threads.append(t)
+        return self
+
+    def stop(self):
+        self.running = False
+        for t in self.threads:
+            t.join()
+        self.threads = []
+        if self.pool is not None:
+            self.pool.shutdown()
+        self.backend.close()
+
+    def _put(self, item):
+        while True:
+            try:
+                self.queue.put_nowait(item)
+                return
+            except queue.Full:
+                try:
+                    self.queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def _capture_loop(self):
+        deadline = time.time()
+        while self.running:
+            t0 = time.time()
+            img = self.backend.grab()
+            t1 = time.time()
+            self.capture_stats.record(t1 - t0)
+            self.captured += 1
+            self._put((img, t0))
+            deadline += self.period
+            delay = deadline - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                # resume on the grid instead of bursting to catch up
+                self.late += 1
+                deadline = time.time()
+        self._put(None)
+
+    def _failed(self, stage):
+        self.errors += 1
+        if self.errors == 1:
+            sys.stderr.write("%s failed:\n" % stage)
+            traceback.print_exc()
+
+    def _encode(self, img):
+        t0 = time.time()
+        try:
+            data = self.encode(img)
+        except Exception:
+            self._failed("encode")
+            return None
+        self.encode_stats.record(time.time() - t0)
+        return data
+
+    def _send(self, data, timestamp):
+        if data is None:
+            return
+        t0 = time.time()
+        try:
+            self.send(data, timestamp)
+        except Exception:
+            self._failed("send")
+            return
+        self.send_stats.record(time.time() - t0)
+        self.bytes += data.nbytes if hasattr(data, "nbytes") else len(data)
+        self.sent += 1
+
+    def _output_loop(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            img, timestamp = item
+            if self.pool is None:
+                self._send(self._encode(img), timestamp)
+            else:
+                # blocks while all workers are busy, so frames back up
+                # into the capture queue and the oldest get dropped
+                self.encoded.put((self.pool.submit(self._encode, img),
+                                  timestamp))
+        if self.pool is not None:
+            self.encoded.put(None)
+
+    def _send_loop(self):
+        while True:
+            item = self.encoded.get()
+            if item is None:
+                break
+            future, timestamp = item
+            self._send(future.result(), timestamp)
+
+    def report(self):
+        '''return stats since the last report and start a new period'''
+        now = time.time()
+        dt = now - self.last_report
+        r = {
+            "capture_fps": self.captured / dt,
+            "fps": self.sent / dt,
+            "kbyte_per_s": self.bytes / 1024.0 / dt,
+            "dropped": self.dropped,
+            "late": self.late,
+            "errors": self.errors,
+        }
+        for name, stats in (("capture", self.capture_stats),
+                            ("encode", self.encode_stats),
+                            ("send", self.send_stats)):
+            r[name + "_ms"] = stats.mean * 1e3
+            r[name + "_max_ms"] = stats.max * 1e3
+            stats.reset()
+        self.captured = self.sent = self.dropped = self.late = 0
+        self.bytes = self.errors = 0
+        self.last_report = now
+        return r
@@ -0,0 +1,278 @@
+#!/usr/bin/env python
+'''
+send only the screen tiles that changed since the previous frame
+
+A delta frame is a tile message instead of a jpeg:
+
+  magic   2s  b'TL'
+  width   H   full frame size
+  height  H
+  tile    H   tile size in pixels
+  count   H   changed tiles
+  columns H   tiles per row of the atlas
+  then count (row, column) H pairs giving each tile's place in the frame,
+  then one jpeg of the atlas, the changed tiles packed row by row, or
+  nothing if count is 0
+
+all in network byte order. One jpeg for all tiles keeps the per-image
+header overhead of a frame constant. Tiles are multiples of 16 pixels so
+jpeg blocks, including subsampled chroma, never straddle two tiles.
+Keyframes are plain jpegs of the whole frame.
+'''
+
+import struct
+
+import cv2
+import numpy
+
+MAGIC = b'TL'
+HEADER = struct.Struct("!2sHHHHH")
+
+
+def padded_shape(shape, tile):
+    '''shape rounded up to whole tiles'''
+    return (-(-shape[0] // tile) * tile, -(-shape[1] // tile) * tile) + \
+        tuple(shape[2:])
+
+
+def tile_view(img, tile):
+    '''(rows, cols, tile, tile, ...) view of an image of whole tiles'''
+    h, w = img.shape[:2]
+    rows, cols = h // tile, w // tile
+    s = img.strides
+    return numpy.lib.stride_tricks.as_strided(
+        img, (rows, cols, tile, tile) + img.shape[2:],
+        (s[0] * tile, s[1] * tile) + s)
+
+
+def changed_tiles(img, ref, tile, threshold=0):
+    '''return (rows, cols) bool array of tiles where img differs from ref
+    by more than threshold in any pixel and channel'''
+    diff = cv2.absdiff(img, ref)
+    h, w = diff.shape[:2]
+    # channels are folded into the tile columns, so one reduction covers
+    # the tile's pixels and channels
+    return diff.reshape(h // tile, tile, w // tile, -1).max(
+        axis=(1, 3)) > threshold
+
+
+class TileEncoder(object):
+    '''encode frames as keyframes or as changed-tile deltas
+
+    The reference is the image the receiver has been sent, so changes
+    are measured against the receiver's canvas rather than against the
+    previous capture. A keyframe is sent every keyframe_interval frames,
+    when the frame size changes, while the encoder scales frames down
+    and on the first frame back at full resolution, and when more than
+    max_fraction of the tiles changed. Frames depend on their
+    predecessor, so encode() must be called from one thread in capture
+    order.
+    '''
+
+    def __init__(self, encoder, tile=32, keyframe_interval=50, threshold=0,
+                 max_fraction=0.5):
+        if tile % 16:
+            raise ValueError("tile size must be a multiple of 16")
+        self.encoder = encoder
+        self.tile = tile
+        self.keyframe_interval = keyframe_interval
+        self.threshold = threshold
+        self.max_fraction = max_fraction
+        self.shape = None
+        self.ref = None
+        self.frame = None
+        self.sent_scale = None  # scale of the last keyframe
+        self.since_keyframe = 0
+        self.keyframes = 0
+        self.deltas = 0
+        self.tiles_sent = 0
+
+    def __call__(self, img):
+        return self.encode(img)
+
+    def keyframe(self, img, scale):
+        # deltas only follow full resolution keyframes, so a scaled one
+        # needs no reference
+        if scale == 1.0:
+            self.ref[...] = self.frame
+        self.sent_scale = scale
+        self.since_keyframe = 0
+        self.keyframes += 1
+        return self.encoder.encode(img, scale)
+
+    def encode(self, img):
+        tile = self.tile
+        # read once, the rate controller may change it meanwhile
+        scale = self.encoder.scale
+        if img.shape != self.shape:
+            self.shape = img.shape
+            self.ref = numpy.zeros(padded_shape(img.shape, tile), img.dtype)
+            self.frame = numpy.zeros_like(self.ref)
+            self.since_keyframe = self.keyframe_interval
+        h, w = img.shape[:2]
+        self.frame[:h, :w] = img
+        self.since_keyframe += 1
+        if (self.since_keyframe >= self.keyframe_interval or
+                scale != 1.0 or self.sent_scale != 1.0):
+            return self.keyframe(img, scale)
+        changed = changed_tiles(self.frame, self.ref, tile, self.threshold)
+        if changed.mean() > self.max_fraction:
+            return self.keyframe(img, scale)
+
+        rows, cols = numpy.nonzero(changed)
+        count = len(rows)
+        self.deltas += 1
+        if count == 0:
+            # nothing changed, a header alone keeps the frame rate
+            return HEADER.pack(MAGIC, w, h, tile, 0, 0)
+        columns = max(1, int(numpy.ceil(numpy.sqrt(count))))
+        atlas_rows = -(-count // columns)
+        tiles = tile_view(self.frame, tile)[rows, cols]
+        tile_view(self.ref, tile)[rows, cols] = tiles
+        atlas = numpy.zeros((atlas_rows * columns,) + tiles.shape[1:],
+                            img.dtype)
+        atlas[:count] = tiles
+        atlas = atlas.reshape((atlas_rows, columns) + tiles.shape[1:])
+        atlas = atlas.swapaxes(1, 2).reshape(
+            (atlas_rows * tile, columns * tile) + tiles.shape[3:])
+        self.tiles_sent += count
+
+        places = numpy.empty((count, 2), dtype='>u2')
+        places[:, 0] = rows
+        places[:, 1] = cols
+        return b"".join((HEADER.pack(MAGIC, w, h, tile, count, columns),
+                         places.tobytes(),
+                         self.encoder.encode(atlas, 1.0).tobytes()))
+
+
+def is_delta(data):
+    '''whether data is a tile delta rather than a jpeg'''
+    return data[:2] == MAGIC
+
+
+class TileCompositor(object):
+    '''rebuild frames from keyframes and tile deltas on a canvas'''
+
+    def __init__(self, flags=cv2.IMREAD_UNCHANGED):
+        self.flags = flags
+        self.canvas = None  # last frame, padded to whole tiles for deltas
+        self.size = None  # (height, width) of the last keyframe
+        self.missing_keyframe = 0
+
+    def decode(self, data):
+        '''return the full frame for data, or None if it is undecodable or
+        a delta without a keyframe to apply it to'''
+        if not self.apply(data):
+            return None
+        h, w = self.size
+        return self.canvas[:h, :w].copy()
+
+    def apply(self, data):
+        '''bring the canvas up to date with data without returning the
+        frame; returns False if data is undecodable or a delta without a
+        keyframe to apply it to'''
+        data = memoryview(data)
+        if not is_delta(data):
+            img = cv2.imdecode(numpy.frombuffer(data, dtype=numpy.uint8),
+                               self.flags)
+            if img is None:
+                return False
+            self.canvas = img
+            self.size = img.shape[:2]
+            return True
+
+        magic, w, h, tile, count, columns = HEADER.unpack_from(data)
+        if self.size != (h, w):
+            self.missing_keyframe += 1
+            return False
+        canvas = self.canvas
+        if canvas.shape[:2] != padded_shape(self.size, tile):
+            canvas = numpy.zeros(padded_shape(canvas.shape, tile),
+                                 canvas.dtype)
+            canvas[:h, :w] = self.canvas[:h, :w]
+            self.canvas = canvas
+        if count == 0:
+            return True
+        offset = HEADER.size + 4 * count
+        places = numpy.frombuffer(data[HEADER.size:offset], dtype='>u2')
+        atlas = cv2.imdecode(numpy.frombuffer(data[offset:],
+                                              dtype=numpy.uint8), self.flags)
+        if atlas is None:
+            return False
+        atlas_rows = atlas.shape[0] // tile
+        tiles = atlas.reshape((atlas_rows, tile, columns, tile) +
+                              atlas.shape[2:]).swapaxes(1, 2)
+        tiles = tiles.reshape((atlas_rows * columns, tile, tile) +
+                              atlas.shape[2:])
+        places = places.reshape(count, 2)
+        tile_view(canvas, tile)[places[:, 0], places[:, 1]] = tiles[:count]
+        return True
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+
+    from capture import BACKENDS, create_backend, parse_region
+    from encode import JpegEncoder
+
+    ap = argparse.ArgumentParser()
+    sub = ap.add_subparsers(dest="command")
+    rec = sub.add_parser("record", help="capture a sequence to .npy")
+    rec.add_argument("path")
+    rec.add_argument("--backend", type=str, default="auto",
+                     choices=["auto"] + sorted(BACKENDS))
+    rec.add_argument("--region", type=str, default="0,52,300,412")
+    rec.add_argument("--rate", type=float, default=50)
+    rec.add_argument("--count", type=int, default=250)
+    bench = sub.add_parser("bench", help="full frames against tile deltas")
+    bench.add_argument("path", nargs="?", default=None,
+                       help="recorded .npy sequence; default synthetic")
+    bench.add_argument("--rate", type=float, default=50)
+    bench.add_argument("--quality", type=int, default=80)
+    bench.add_argument("--tile", type=int, default=32)
+    bench.add_argument("--keyframe", type=int, default=50)
+    args = ap.parse_args()
+
+    if args.command == "record":
+        backend = create_backend(args.backend, parse_region(args.region))
+        frames = []
+        for i in range(args.count):
+            frames.append(backend.grab())
+            time.sleep(1.0 / args.rate)
+        numpy.save(args.path, numpy.stack(frames))
+        print("recorded %u frames with %s" % (len(frames), backend.name))
+
+    elif args.command == "bench":
+        if args.path is not None:
+            frames = numpy.load(args.path, mmap_mode='r')
+        else:
+            backend = create_backend("synthetic", (0, 52, 300, 412))
+            frames = [backend.grab() for i in range(250)]
+        for name in ("full", "tiles"):
+            encoder = JpegEncoder(args.quality)
+            if name == "tiles":
+                encoder = TileEncoder(encoder, args.tile, args.keyframe)
+            compositor = TileCompositor()
+            total = 0
+            encode_s = decode_s = 0.0
+            error = 0.0
+            for img in frames:
+                img = numpy.ascontiguousarray(img)
+                t0 = time.time()
+                data = encoder.encode(img)
+                t1 = time.time()
+                out = compositor.decode(data)
+                t2 = time.time()
+                total += len(data)
+                encode_s += t1 - t0
+                decode_s += t2 - t1
+                error = max(error, float(cv2.absdiff(out, img).mean()))
+            n = len(frames)
+            print("%5s: %8.1f kByte/sec at %g FPS, %6.0f bytes/frame, "
+                  "encode %.2f ms decode %.2f ms, max mean error %.2f" % (
+                      name, total / 1024.0 / n * args.rate, args.rate,
+                      total / n, encode_s / n * 1e3, decode_s / n * 1e3,
+                      error))
+    else:
+        ap.print_help()